@@ -242,9 +242,8 @@ def Show():
     # TODO: Catch the error which results if no matches are found.
 
   # Mark messages as read if necessary
-  for MsgObj in ReadList:
-    # Mark as Read
-    Queue._addCache(MsgObj.msgid)
+  if ReadList:
+    Queue._addCacheList([MsgObj.msgid for MsgObj in ReadList])
     Queue._saveCache()
 
   # Any messages no longer "in process"?
@@ -280,9 +279,8 @@ def Show():
     elif Form["subcmd"].value == "last":
       FirstMsg = len(Msgs)
     elif Form["subcmd"].value == "allread":
-      for Msg in Msgs:
-        Queue._addCache(Msg)
-        Queue._saveCache()
+      Queue._addCacheList(Msgs)
+      Queue._saveCache()
   if FirstMsg >= len(Msgs):
     FirstMsg = len(Msgs) - \
                (len(Msgs) % int(PVars[("PendingList", "PagerSize")]) )
@@ -449,6 +447,9 @@ def Show():
     inProcessLine = 0
 
     nowTime = int(time.time())
+    # The headers we list come from the pending queue's metadata index,
+    # so messages are only read when something else is needed.
+    Metadata = Pending.Q.fetch_metadata(Msgs[FirstMsg:LastMsg])
     for Msg in Msgs[FirstMsg:LastMsg]:
       T["MsgID"] = Msg
       if Count % 2 == 0 and OddRowColor is not None:
@@ -458,13 +459,13 @@ def Show():
 
       # Print a single message record inside list loop
       try:
-        MsgObj = Pending.Message(Msg)
+        MsgObj = Pending.Message(Msg, metadata = Metadata.get(Msg))
       except (IOError, Errors.MessageError, \
               email.Errors.MessageError), ErrStr:
         continue
 
       # Message size
-      T["Size"] = CgiUtil.Size(MsgObj)
+      T["Size"] = CgiUtil.Size(MsgSize = MsgObj.getSize())
 
       # Find preferred date
       DateFormat = PVars[("PendingList", "DateFormat")]
@@ -489,17 +490,21 @@ def Show():
         )
       T["Date"] = ZeroSearch.sub(ZeroSub, Date)
 
-      # Character set
-      CharSet = CgiUtil.FindCharSet(MsgObj)
+      # Character set (only needed for raw 8-bit headers)
+      CharSet = None
+      for Header in ("subject", "from"):
+        if re.search("[\x80-\xff]", MsgObj.getHeader(Header) or ""):
+          CharSet = CgiUtil.FindCharSet(MsgObj)
+          break
 
       # Subject:
-      if not MsgObj.msgobj["subject"]:
+      if not MsgObj.getHeader("subject"):
         Subject = "None"
       else:
         # Try to decode internationalized headers
         value = ""
         try:
-          for decoded in email.Header.decode_header( MsgObj.msgobj["subject"] ):
+          for decoded in email.Header.decode_header( MsgObj.getHeader("subject") ):
             if decoded[1]:
               try:
                 value += Unicode.TranslateToUTF8(decoded[1], decoded[0], "strict")
@@ -509,7 +514,7 @@ def Show():
               value += Unicode.TranslateToUTF8(CharSet, decoded[0], "ignore")
         except email.errors.HeaderParseError:
           # just return the undecoded string if we can't decode it
-          value = MsgObj.msgobj["subject"]
+          value = MsgObj.getHeader("subject")
         Subject = value
         if len(Subject) > int(PVars[("PendingList", "CropSubject")]):
           Subject = \
@@ -520,13 +525,13 @@ def Show():
       T["Subject"] = Subject
 
       # From:
-      if not MsgObj.msgobj["from"]:
+      if not MsgObj.getHeader("from"):
         From = ""
       else:
         # Try to decode internationalized headers
         value = ""
         try:
-          for decoded in email.Header.decode_header( MsgObj.msgobj["from"] ):
+          for decoded in email.Header.decode_header( MsgObj.getHeader("from") ):
             if decoded[1]:
               try:
                 value += Unicode.TranslateToUTF8(decoded[1], decoded[0], "strict")
@@ -536,7 +541,7 @@ def Show():
               value += Unicode.TranslateToUTF8(CharSet, decoded[0], "ignore")
         except email.errors.HeaderParseError:
           # just return the undecoded string if we can't decode it
-          value = MsgObj.msgobj["from"]
+          value = MsgObj.getHeader("from")
         From = value
         Temp = Address.search(From)
         if Temp:
@@ -552,10 +557,10 @@ def Show():
       T["Sender"] = From
 
       # To:
-      if not MsgObj.msgobj["to"]:
+      if not MsgObj.getHeader("to"):
         To = ""
       else:
-        To = MsgObj.msgobj["to"]
+        To = MsgObj.getHeader("to")
         Temp = Address.search(To)
         if Temp:
           if PVars[("PendingList", "ShowAddr")] == "Name":
@@ -593,7 +598,7 @@ def Show():
           ReadArray.append(0)
 
         # Grab this specific header
-        SpamScoreHead = MsgObj.msgobj[SpamHeader]
+        SpamScoreHead = MsgObj.getHeader(SpamHeader)
 
         if not SpamScoreHead:
           SpamArray.append(0)
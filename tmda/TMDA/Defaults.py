@@ -579,6 +579,36 @@ if env_FILTER_OUTGOING:
 elif not 'FILTER_OUTGOING' in vars():
     FILTER_OUTGOING = os.path.join(DATADIR, 'filters', 'outgoing')
 
+# FILTER_CACHE
+# Set this variable to True if you want TMDA to save a compiled copy
+# of each parsed filter file next to the filter itself (e.g,
+# ~/.tmda/filters/incoming.cache).  The compiled copy is used instead
+# of re-parsing the filter as long as neither the filter, any file it
+# includes, the variables it interpolates, nor your configuration
+# files have changed.  This saves time with large or macro-heavy
+# filters.  TMDA must be able to write to the filter directory.  A
+# compiled copy which you don't own, or which others can write to, is
+# ignored.
+#
+# Default is False (turned off)
+if not 'FILTER_CACHE' in vars():
+    FILTER_CACHE = False
+
+# FILTER_STATS
+# Full pathname of a file in which to keep per-rule statistics for
+# your incoming and outgoing filters: how many times each rule was
+# tried, how many times it matched, and how long it took.  Use
+# `tmda-filter --rule-stats' to see which rules are the slowest.
+# Gathering statistics adds a little time to each delivery, so leave
+# this unset unless you are tuning your filters.
+#
+# Example:
+# FILTER_STATS = os.path.expanduser("~/.tmda/filter-stats")
+#
+# No default.
+if not 'FILTER_STATS' in vars():
+    FILTER_STATS = None
+
 # FILTER_BOUNCE_CC
 # An optional e-mail address which will be sent a copy of any message
 # that bounces because of a match in FILTER_INCOMING.
@@ -1117,7 +1147,8 @@ if not 'PENDING_CLEANUP_ODDS' in vars():
 
 # PENDING_CACHE
 # Path to the cache file used when tmda-pending is invoked with the
-# --cache option.
+# --cache option.  The file is a log of message ids, which is
+# periodically rewritten to hold just the PENDING_CACHE_LEN newest.
 #
 # Default is ~/.tmda/.pendingcache
 if not 'PENDING_CACHE' in vars():
@@ -30,12 +30,21 @@ Filter file syntax documented in htdocs/config-filter.html
 
 
 import os
+import pickle
 import re
+import stat
 import string
 import sys
+import time
 
 from . import Defaults
+from . import ListIndex
 from . import Util
+from . import Version
+
+
+# Bump this whenever the layout of the compiled filter cache changes.
+_CACHE_FORMAT = 4
 
 
 # exception classes
@@ -262,8 +271,8 @@ class FilterParser:
     arguments = {
         'from'         : None,
         'to'           : None,
-        'from-file'    : ('autocdb', 'autodbm', 'optional'),
-        'to-file'      : ('autocdb', 'autodbm', 'optional'),
+        'from-file'    : ('autocdb', 'autodbm', 'autoindex', 'optional'),
+        'to-file'      : ('autocdb', 'autodbm', 'autoindex', 'optional'),
         'from-cdb'     : ('optional',),
         'to-cdb'       : ('optional',),
         'from-dbm'     : ('optional',),
@@ -284,11 +293,27 @@ class FilterParser:
         }
 
 
-    def __init__(self, db_instance=None):
+    def __init__(self, db_instance=None, statsfile=None):
         self.db_instance = db_instance
+        # Per-rule statistics gathered by firstmatch, if statsfile is
+        # given.  They are added to statsfile by close().  See
+        # save_stats.
+        self.statsfile = statsfile
+        self.stats = None
+        if statsfile:
+            self.stats = {}
         self.macros = []
         self.files = []
         self.filterlist = []
+        # The rules in filterlist, ready for matching.  See Rule.
+        self.rules = []
+        # Files (and their signatures) and variables the parsed filter
+        # depends on.  Used to validate the compiled filter cache.
+        self.__depends = []
+        self.__variables = {}
+        # Read-only database handles kept open between firstmatch calls,
+        # keyed by (kind, pathname).  See __gethandle.
+        self.__handles = {}
 
 
     def __pushfile(self, file):
@@ -333,13 +358,81 @@ class FilterParser:
             exception.append(self.__file().lineno, errstr)
             raise exception
 
+        # Only the outermost filter read by a fresh parser is cached.
+        # Any included files are recorded as dependencies instead.
+        cachefile = None
+        if (Defaults.FILTER_CACHE and not self.files
+            and not self.filterlist and not self.macros):
+            cachefile = filename + '.cache'
+            if self.__loadcache(cachefile):
+                return
+
         try:
             fp = open(filename)
+            self.__depends.append((filename, _statsig(os.fstat(fp.fileno()))))
             self.__pushfile(_FilterFile(filename))
             self.__parse(fp)
             fp.close()
             self.__popfile()
         except IOError:
+            return
+        if cachefile:
+            self.__savecache(cachefile)
+
+
+    def __loadcache(self, cachefile):
+        """Load the compiled filter from cachefile.
+
+        Return true if the cache was loaded, or false if it doesn't
+        exist, is out-of-date, or isn't safe to load.  Unpickling can
+        run arbitrary code, so the cache must belong to us, and mustn't
+        be writable by anyone else.
+        """
+        try:
+            with open(cachefile, 'rb') as fp:
+                st = os.fstat(fp.fileno())
+                if (st.st_uid != os.geteuid()
+                    or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+                    return False
+                cache = pickle.load(fp)
+        except Exception:
+            return False
+        if (not isinstance(cache, dict)
+            or cache.get('format') != (_CACHE_FORMAT, Version.TMDA)):
+            return False
+        for (path, sig) in cache['depends']:
+            if _pathsig(path) != sig:
+                return False
+        for (var, sub) in cache['variables'].items():
+            try:
+                if self.__findvarsub(var) != sub:
+                    return False
+            except Error:
+                return False
+        self.macros = cache['macros']
+        self.filterlist = cache['filterlist']
+        self.rules = [ _makerule(rule, filename) for (rule, filename)
+                       in zip(self.filterlist, cache['filenames']) ]
+        self.__depends = cache['depends']
+        return True
+
+
+    def __savecache(self, cachefile):
+        """Save the compiled filter to cachefile, ignoring any errors."""
+        depends = self.__depends[:]
+        for config in (Defaults.GLOBAL_TMDARC, Defaults.TMDARC):
+            if config:
+                config = os.path.abspath(config)
+                depends.append((config, _pathsig(config)))
+        cache = { 'format'     : (_CACHE_FORMAT, Version.TMDA),
+                  'depends'    : depends,
+                  'variables'  : self.__variables,
+                  'macros'     : self.macros,
+                  'filterlist' : self.filterlist,
+                  'filenames'  : [ rule.filename for rule in self.rules ] }
+        try:
+            Util.pickleit(cache, cachefile)
+        except (EnvironmentError, pickle.PicklingError):
             pass
 
 
@@ -369,6 +462,8 @@ class FilterParser:
                     rule_line = self.__includefilter(rule_line)
                     if rule_line:
                         rule = self.__parserule(rule_line)
+                        self.rules.append(
+                            _makerule(rule, file.exception.filename))
                         self.filterlist.append(rule)
             except EOFError:
                 break
@@ -502,6 +597,7 @@ class FilterParser:
         if not sub:
             raise Error("${%s} not found in the Defaults "
                          "namespace nor the environment." % var)
+        self.__variables[var] = sub
         return sub
 
 
@@ -538,6 +634,9 @@ class FilterParser:
                 self.read(filename)
             elif not optional:
                 raise Error('"%s": file not found' % filename)
+            else:
+                # Its later appearance must invalidate a cached filter.
+                self.__depends.append((os.path.abspath(filename), None))
             rule_line = None
         return rule_line
 
@@ -686,15 +785,13 @@ class FilterParser:
 
     def __search_list(self, addrlist, keys, actions, source):
         """Search addrlist for match in field 1, optional action in 2."""
-        # This list comprehension splits each line in the list into
-        # two columns, lowercases the first column and stuffs the
-        # columns back together.  The result is the original list of
-        # lines from the file with the first field in each line
-        # lowercased.
-        addrlist = [' '.join(
-            (lambda f1, f2=None: f2 and [f1.lower(), f2]
-                                          or [f1.lower()])(*line.split(None, 1))) for line in addrlist]
-        found_match = Util.findmatch(addrlist, keys)
+        matcher = Util.AddressMatcher(_lowerkeys(addrlist))
+        return self.__search_matcher(matcher, keys, actions, source)
+
+
+    def __search_matcher(self, matcher, keys, actions, source):
+        """Search a compiled address list (a Util.AddressMatcher)."""
+        found_match = matcher.match(keys)
         if found_match:
             # The second column of the line may contain an
             # overriding action specification.
@@ -706,27 +803,71 @@ class FilterParser:
         return found_match
 
 
-    def __search_file(self, pathname, keys, actions, source):
+    def _search_file(self, pathname, keys, actions, source):
         """
         Search a text file for match in first column.
         """
-        return self.__search_list(Util.file_to_list(pathname),
-                                  keys,
-                                  actions,
-                                  source)
+        return self.__search_matcher(_listmatcher(pathname),
+                                     keys,
+                                     actions,
+                                     source)
+
+
+    def __gethandle(self, kind, pathname, opener, paths=None):
+        """
+        Return a read-only handle for pathname, opening it with opener
+        if it isn't already open.  The handle is reopened if any of
+        paths (default: pathname) has changed since it was opened.
+        """
+        sig = tuple([ _pathsig(path) for path in (paths or [pathname]) ])
+        key = (kind, pathname)
+        cached = self.__handles.get(key)
+        if cached:
+            if cached[0] == sig:
+                return cached[1]
+            del self.__handles[key]
+            _closehandle(cached[1])
+        handle = opener(pathname)
+        self.__handles[key] = (sig, handle)
+        return handle
+
+
+    def close(self):
+        """Close all database handles opened by firstmatch, and save
+        any statistics gathered."""
+        for (sig, handle) in self.__handles.values():
+            _closehandle(handle)
+        self.__handles.clear()
+        if self.stats:
+            try:
+                save_stats(self.statsfile, self.stats)
+            except EnvironmentError:
+                pass
+            self.stats.clear()
+
+
+    def _search_index(self, pathname, keys, actions, source):
+        """
+        Search a sorted list index built by ListIndex.build.
+        """
+        try:
+            index = self.__gethandle('index', pathname, ListIndex.ListIndex)
+        except ListIndex.Error as e:
+            raise Error(str(e))
+        return self.__search_matcher(index, keys, actions, source)
 
 
-    def __search_cdb(self, pathname, keys, actions, source):
+    def _search_cdb(self, pathname, keys, actions, source):
         """
         Search DJB's constant databases; see <http://cr.yp.to/cdb.html>.
         """
         import cdb
-        cdb = cdb.init(pathname)
+        db = self.__gethandle('cdb', pathname, cdb.init)
         found_match = 0
         for key in keys:
-            if key and key.lower() in cdb:
+            if key and key.lower() in db:
                 found_match = 1
-                cdb_value = cdb[key.lower()]
+                cdb_value = db[key.lower()]
                 # If there is an entry for this key,
                 # we consider it an overriding action
                 # specification.
@@ -737,32 +878,36 @@ class FilterParser:
         return found_match
 
 
-    def __search_dbm(self, pathname, keys, actions, source):
+    def _search_dbm(self, pathname, keys, actions, source):
         """
         Search a DBM-style database.
         """
         import dbm
-        dbm = dbm.open(pathname, 'r')
+        # Depending on the dbm implementation, the database lives in
+        # pathname itself or in files with these suffixes added.
+        paths = [ pathname + suffix for suffix in ('', '.db', '.dir', '.pag') ]
+        db = self.__gethandle('dbm', pathname,
+                              lambda path: dbm.open(path, 'r'), paths)
         found_match = 0
         for key in keys:
-            if key and key.lower() in dbm:
+            if key and key.lower() in db:
                 found_match = 1
-                dbm_value = dbm[key.lower()]
+                dbm_value = db[key.lower()].decode('utf-8')
                 # If there is an entry for this key,
                 # we consider it an overriding action
                 # specification.
                 if dbm_value:
                     actions.clear()
                     actions.update(self.__buildactions(dbm_value, source))
-                dbm.close()
                 break
         return found_match
 
 
-    def __autobuild_db(self, basename, extension,
+    def _autobuild_db(self, basename, extension,
                        surrogate, build_func, search_func, optional):
         """
-        Automatically build a CDB/DBM database if it's out-of-date.
+        Automatically build a CDB/DBM database or a list index if it's
+        out-of-date.
         """
         dbname = basename + extension
         try:
@@ -788,24 +933,11 @@ class FilterParser:
                         os.close(os.open(surrogate, os.O_CREAT, 0o600))
                 else:
                     dbname = basename
-                    search_func = self.__search_file
+                    search_func = self._search_file
         return (dbname, search_func)
 
 
-    def __extract_domains(self, keys):
-        """
-        Attempt to extract the domain name from each address in keys.
-        """
-        domains = {}
-        for k in keys:
-            try:
-                domains[k.split('@', 1)[1]] = None
-            except IndexError:
-                pass
-        return list(domains.keys())
-
-
-    def __create_sql_criteria(self, dbkeys, addresscolumn):
+    def _create_sql_criteria(self, dbkeys, addresscolumn):
         """Return condition string for insertion into SQL statement."""
         if not dbkeys:
             return ''
@@ -826,7 +958,7 @@ class FilterParser:
         return -1
 
 
-    def __search_sql(self, selectstmt, args, keys, actions, source, lineno):
+    def _search_sql(self, selectstmt, args, keys, actions, source, lineno):
         """Search SQL DB (Python DB API 2.0)."""
         found_match = 0
         dbkeys = keys
@@ -876,240 +1008,709 @@ class FilterParser:
         """Iterate over each rule in the list looking for a match.  As
         soon as a match is found exit, returning the corresponding
         action dictionary and matching line.
+
+        msg_body, msg_headers and msg_size may also be functions
+        returning those values, in which case each is only called (at
+        most once) if a rule needs it.
         """
-        line = None
-        found_match = None
-        for (source, args, match, actions, lineno) in self.filterlist:
-            source = source.lower()
-            # set up the keys for searching
-            if source.startswith('from') and senders:
-                keys = senders
-            elif source.startswith('to') and recipient:
-                keys = [recipient]
-            # Here starts the matching against the various rules
-            #
-            # regular 'from' or 'to' addresses
-            if source in ('from', 'to'):
-                found_match = Util.findmatch([match.lower()], keys)
-                if found_match:
-                    break
-            # 'from-file' or 'to-file', including autocdb functionality
-            if source in ('from-file', 'to-file'):
-                dbname = os.path.expanduser(match)
-                search_func = self.__search_file
-                keys += self.__extract_domains(keys)
-                # If we have an 'auto*' argument, ensure that the database
-                # is up-to-date.  If the 'optional' argument is also given,
-                # don't die if the file doesn't exist.
-                optional = 'optional' in args
-                if 'autocdb' in args:
-                    (dbname, search_func) = self.__autobuild_db(
-                        dbname, '.cdb', dbname + '.cdb',
-                        Util.build_cdb, self.__search_cdb, optional)
-                elif 'autodbm' in args:
-                    (dbname, search_func) = self.__autobuild_db(
-                        dbname, '.db', dbname + '.last_built',
-                        Util.build_dbm, self.__search_dbm, optional)
-                else:
-                    if not os.path.exists(dbname) and optional:
-                        search_func = None
-                try:
-                    if search_func:
-                        found_match = search_func(dbname, keys,
-                                                  actions, source)
-                except Error as e:
-                    raise MatchError(lineno, e._msg)
-                if found_match:
-                    break
-            # DBM-style databases.
-            if source in ('from-dbm', 'to-dbm'):
-                import dbm
-                match = os.path.expanduser(match)
-                keys += self.__extract_domains(keys)
-                try:
-                    found_match = self.__search_dbm(match, keys,
-                                                    actions, source)
-                except dbm.error as e:
-                    if 'optional' not in args:
-                        raise MatchError(lineno, str(e))
-                if found_match:
-                    break
-            # DJB's constant databases; see <http://cr.yp.to/cdb.html>.
-            if source in ('from-cdb', 'to-cdb'):
-                import cdb
-                match = os.path.expanduser(match)
-                keys += self.__extract_domains(keys)
-                try:
-                    found_match = self.__search_cdb(match, keys,
-                                                    actions, source)
-                except cdb.error as e:
-                    if 'optional' not in args:
-                        raise MatchError(lineno, str(e))
-                if found_match:
-                    break
-            # ezmlm subscriber directories.
-            if source in ('from-ezmlm', 'to-ezmlm'):
-                match = os.path.join(os.path.expanduser(match), 'subscribers')
-                ezmlm_list = []
-                try:
-                    # See ezmlm(5) for dir/subscribers format.
-                    for file in os.listdir(match):
-                        fp = open(os.path.join(match, file), 'r')
-                        subs = fp.read().split('\x00')
-                        for sub in subs:
-                            if sub:
-                                ezmlm_list.append(sub.split('T', 1)[1].lower())
-                    for key in keys:
-                        if key and key.lower() in ezmlm_list:
-                            found_match = 1
-                            break
-                except OSError:
-                    if 'optional' not in args:
-                        raise
-                if found_match:
-                    break
-            # Mailman configuration databases.
-            if source in ('from-mailman', 'to-mailman'):
-                match = os.path.expanduser(match)
-                try:
-                    mmdb_key = args['attr']
-                except KeyError:
-                    raise MatchError(lineno,
-                                     '"%s" missing -attr argument' % source)
-                # Find the Mailman configuration database.
-                # 'config.db' is a Python marshal used in MM 2.0, and
-                # 'config.pck' is a Python pickle used in MM 2.1.
-                try_open = 1  # Try to open file.
-                config_db = os.path.join(match, 'config.db')
-                config_pck = os.path.join(match, 'config.pck')
-                if os.path.exists(config_pck):
-                    dbfile = config_pck
-                    import pickle as Serializer
-                elif os.path.exists(config_db):
-                    dbfile = config_db
-                    import marshal as Serializer
-                elif 'optional' in args:
-                    # This is the case where neither of the Mailman
-                    # configuration databases exists.  If the -optional flag
-                    # was specified, don't bother trying to open a non-existent
-                    # file.
-                    try_open = 0
-                if try_open:
-                    mmdb_file = open(dbfile, 'r')
-                    mmdb_data = Serializer.load(mmdb_file)
-                    mmdb_file.close()
-                    mmdb_addylist = mmdb_data[mmdb_key]
-                    # Make sure mmdb_addylist is a list of e-mail addresses.
-                    if type(mmdb_addylist) is dict:
-                         mmdb_addylist = list(mmdb_data[mmdb_key].keys())
-                    for addy in keys:
-                        if addy and addy.lower() in mmdb_addylist:
-                            found_match = 1
-                            break
-                if found_match:
-                    break
-            # Generic SQL.  Expects a SELECT statement as the 'match' field.
-            # There are two "modes", depending on the presence of TMDA-style
-            # wildcards in the database.  See the filter source documentation
-            # for more information.
-            if source in ('from-sql', 'to-sql'):
-                selectstmt = match
-                keys += self.__extract_domains(keys)
-                addr_column = args.get('addr_column')
-                if 'wildcards' in args:
-                    if addr_column:
-                        raise MatchError(lineno,
-                                         "-addr_column and -wildcards " +
-                                         "cannot be used together")
-                elif not addr_column:
-                    raise MatchError(lineno, "-addr_column must be specified")
-                else:
-                    criteria = self.__create_sql_criteria(keys, addr_column)
-                    selectstmt = selectstmt.replace('%(criteria)s', criteria)
-                found_match = self.__search_sql(
-                    selectstmt, args, keys, actions, source, lineno)
-                if found_match:
-                    break
-            # A match is found if the command exits with a zero exit
-            # status.
-            if source == 'pipe-headers' and msg_headers:
-                (r, out, err) = Util.runcmd(match, msg_headers)
+        ctx = MatchContext(self, recipient, senders,
+                           msg_body, msg_headers, msg_size)
+        if self.stats is not None:
+            return self.__firstmatch_stats(ctx)
+        for rule in self.rules:
+            actions = rule.match(ctx)
+            if actions is not None:
+                return actions, rule.linestr(actions)
+        return {}, None
+
+
+    def __firstmatch_stats(self, ctx):
+        """firstmatch, counting and timing each rule it tries."""
+        for rule in self.rules:
+            key = (rule.filename, rule.lineno)
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [rule.linestr(rule.actions),
+                                           0, 0, 0.0]
+            start = time.perf_counter()
+            try:
+                actions = rule.match(ctx)
+            finally:
+                entry[1] += 1
+                entry[3] += time.perf_counter() - start
+            if actions is not None:
+                entry[2] += 1
+                return actions, rule.linestr(actions)
+        return {}, None
+
+
+    def firstmatch_many(self, messages):
+        """Match many messages against the filter, for example to check
+        a changed filter against a day's mail.
+
+        messages is an iterable of dictionaries with any of the keys
+        'recipient', 'senders', 'msg_body', 'msg_headers' and
+        'msg_size', which are passed to firstmatch.  Yield a
+        (message, actions, matching line) tuple for each message, in
+        order.  Address lists and expression files are loaded up front,
+        before the first message is matched.
+        """
+        for rule in self.rules:
+            rule.warm()
+        for message in messages:
+            (actions, line) = self.firstmatch(message.get('recipient'),
+                                              message.get('senders'),
+                                              message.get('msg_body'),
+                                              message.get('msg_headers'),
+                                              message.get('msg_size'))
+            yield message, actions, line
+
+
+class MatchContext:
+    """
+    The message being matched by firstmatch, shared by all of the rules
+    it tries.  Anything derived from the message is computed once, the
+    first time a rule needs it.
+    """
 
-                if r == 0:
-                    found_match = 1
-                    break
-                # raise an exception if the process exited due to
-                # a signal.
-                elif r < 0:
-                    raise Error('command "%s" abnormal exit signal %s (%s)' %
-                                (match, -r, err.strip()))
-            # A match is found if the command exits with a zero exit
-            # status.
-            if source == 'pipe' and msg_body and msg_headers:
-                (r, out, err) = Util.runcmd(match, msg_headers + '\n' +
-                                            msg_body)
-                if r == 0:
-                    found_match = 1
-                    break
-                # raise an exception if the process exited due to
-                # a signal.
-                elif r < 0:
-                    raise Error('command "%s" abnormal exit signal %s (%s)' %
-                                (match, -r, err.strip()))
-            if source in ('body', 'headers'):
-                if source == 'body' and msg_body:
-                    content = msg_body
-                elif source == 'headers' and msg_headers:
-                    content = msg_headers
-                else:
-                    content = None
-                re_flags = re.MULTILINE
-                if 'case' not in args:
-                    re_flags = re_flags | re.IGNORECASE
-                if content and re.search(match,content,re_flags):
-                    found_match = 1
-                    break
-            if source in ('body-file','headers-file'):
-                match = os.path.expanduser(match)
-                try:
-                    match_list = Util.file_to_list(match)
-                except IOError:
-                    if 'optional' not in args:
-                        raise
-                if source == 'body-file' and msg_body:
-                    content = msg_body
-                elif source == 'headers-file' and msg_headers:
-                    content = msg_headers
-                else:
-                    content = None
-                re_flags = re.MULTILINE
-                if 'case' not in args:
-                    re_flags = re_flags | re.IGNORECASE
-                for line in match_list:
-                    mo = self.matches.match(line)
-                    if mo:
-                        expr = mo.group(2) or mo.group(3)
-                        if content and re.search(expr,content,re_flags):
-                            found_match = 1
-                            break
-                if found_match:
-                    break
-            if source == 'size' and msg_size:
-                match_list = list(match)
-                operator = match_list[0] # first character should be < or >
-                bytesize = ''.join(match_list)[1:] # rest is the size
-                found_match = None
-                if operator == '<':
-                    found_match = int(msg_size) < int(bytesize)
-                elif operator == '>':
-                    found_match = int(msg_size) > int(bytesize)
-                if found_match:
-                    break
-        if found_match:
-            line = _rulestr(source, args, match, actions)
+    def __init__(self, parser, recipient, senders,
+                 msg_body, msg_headers, msg_size):
+        self.parser = parser
+        self.addresses = { 'from' : senders or [],
+                           'to'   : recipient and [recipient] or [] }
+        self.body = _once(msg_body)
+        self.headers = _once(msg_headers)
+        self.size = _once(msg_size)
+        self.__dbkeys = {}
+
+    def keys(self, direction):
+        """
+        Return the sender ('from') or recipient ('to') addresses.
+        """
+        return self.addresses[direction]
+
+    def dbkeys(self, direction):
+        """
+        Return the addresses followed by their domains, which is what
+        lists and databases are searched for.
+        """
+        dbkeys = self.__dbkeys.get(direction)
+        if dbkeys is None:
+            keys = self.addresses[direction]
+            dbkeys = self.__dbkeys[direction] = keys + _domains(keys)
+        return dbkeys
+
+
+class Rule:
+    """
+    A filter rule, ready to be matched against messages.  Built from a
+    (source, args, match, actions, lineno) tuple in filterlist by
+    _makerule, which picks the subclass for the rule's source.
+
+    match(ctx) returns the rule's actions (or the overriding actions
+    found in a list or database) if the rule matches the message in
+    ctx, a MatchContext, and None if it doesn't.
+    """
+
+    def __init__(self, source, args, match, actions, lineno):
+        self.source = source.lower()
+        self.args = args
+        self.field = match
+        self.actions = actions or {}
+        self.lineno = lineno
+        # from* and to* rules look up the sender or recipient addresses.
+        self.direction = self.source.split('-', 1)[0]
+
+    def warm(self):
+        """
+        Load anything the rule will need to match a message.
+        """
+        pass
+
+    def linestr(self, actions):
+        """
+        Return the rule as a string, for logging.
+        """
+        return _rulestr(self.source, self.args, self.field, actions)
+
+
+class AddressRule(Rule):
+    """from and to rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.matcher = Util.AddressMatcher([self.field.lower()])
+
+    def match(self, ctx):
+        if self.matcher.match(ctx.keys(self.direction)):
+            return self.actions
+
+
+class FileRule(Rule):
+    """from-file and to-file rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.dbname = os.path.expanduser(self.field)
+        self.optional = 'optional' in self.args
+
+    def warm(self):
+        for arg in ('autocdb', 'autodbm', 'autoindex'):
+            if arg in self.args:
+                return
+        try:
+            _listmatcher(self.dbname)
+        except EnvironmentError:
+            pass
+
+    def match(self, ctx):
+        parser = ctx.parser
+        dbname = self.dbname
+        search_func = parser._search_file
+        # If we have an 'auto*' argument, ensure that the database
+        # is up-to-date.  If the 'optional' argument is also given,
+        # don't die if the file doesn't exist.
+        if 'autocdb' in self.args:
+            (dbname, search_func) = parser._autobuild_db(
+                dbname, '.cdb', dbname + '.cdb',
+                Util.build_cdb, parser._search_cdb, self.optional)
+        elif 'autodbm' in self.args:
+            (dbname, search_func) = parser._autobuild_db(
+                dbname, '.db', dbname + '.last_built',
+                Util.build_dbm, parser._search_dbm, self.optional)
+        elif 'autoindex' in self.args:
+            (dbname, search_func) = parser._autobuild_db(
+                dbname, '.idx', dbname + '.idx',
+                ListIndex.build, parser._search_index, self.optional)
+        elif self.optional and not os.path.exists(dbname):
+            return None
+        if not search_func:
+            return None
+        actions = self.actions.copy()
+        try:
+            if search_func(dbname, ctx.dbkeys(self.direction),
+                           actions, self.source):
+                return actions
+        except Error as e:
+            raise MatchError(self.lineno, e._msg)
+
+
+class DbmRule(Rule):
+    """from-dbm and to-dbm rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.field = os.path.expanduser(self.field)
+
+    def match(self, ctx):
+        import dbm
+        actions = self.actions.copy()
+        try:
+            if ctx.parser._search_dbm(self.field, ctx.dbkeys(self.direction),
+                                      actions, self.source):
+                return actions
+        except dbm.error as e:
+            if 'optional' not in self.args:
+                raise MatchError(self.lineno, str(e))
+
+
+class CdbRule(Rule):
+    """from-cdb and to-cdb rules; see <http://cr.yp.to/cdb.html>."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.field = os.path.expanduser(self.field)
+
+    def match(self, ctx):
+        import cdb
+        actions = self.actions.copy()
+        try:
+            if ctx.parser._search_cdb(self.field, ctx.dbkeys(self.direction),
+                                      actions, self.source):
+                return actions
+        except cdb.error as e:
+            if 'optional' not in self.args:
+                raise MatchError(self.lineno, str(e))
+
+
+class EzmlmRule(Rule):
+    """from-ezmlm and to-ezmlm rules, matching subscriber directories."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.field = os.path.join(os.path.expanduser(self.field),
+                                  'subscribers')
+
+    def match(self, ctx):
+        ezmlm_list = []
+        try:
+            # See ezmlm(5) for dir/subscribers format.
+            for file in os.listdir(self.field):
+                fp = open(os.path.join(self.field, file), 'r')
+                subs = fp.read().split('\x00')
+                for sub in subs:
+                    if sub:
+                        ezmlm_list.append(sub.split('T', 1)[1].lower())
+        except OSError:
+            if 'optional' not in self.args:
+                raise
+        for key in ctx.keys(self.direction):
+            if key and key.lower() in ezmlm_list:
+                return self.actions
+
+
+class MailmanRule(Rule):
+    """from-mailman and to-mailman rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.field = os.path.expanduser(self.field)
+
+    def match(self, ctx):
+        try:
+            mmdb_key = self.args['attr']
+        except KeyError:
+            raise MatchError(self.lineno,
+                             '"%s" missing -attr argument' % self.source)
+        # Find the Mailman configuration database.
+        # 'config.db' is a Python marshal used in MM 2.0, and
+        # 'config.pck' is a Python pickle used in MM 2.1.
+        config_db = os.path.join(self.field, 'config.db')
+        config_pck = os.path.join(self.field, 'config.pck')
+        if os.path.exists(config_pck):
+            dbfile = config_pck
+            import pickle as Serializer
+        elif os.path.exists(config_db):
+            dbfile = config_db
+            import marshal as Serializer
+        elif 'optional' in self.args:
+            # This is the case where neither of the Mailman
+            # configuration databases exists.  If the -optional flag
+            # was specified, don't bother trying to open a non-existent
+            # file.
+            return None
+        mmdb_file = open(dbfile, 'r')
+        mmdb_data = Serializer.load(mmdb_file)
+        mmdb_file.close()
+        mmdb_addylist = mmdb_data[mmdb_key]
+        # Make sure mmdb_addylist is a list of e-mail addresses.
+        if type(mmdb_addylist) is dict:
+            mmdb_addylist = list(mmdb_data[mmdb_key].keys())
+        for addy in ctx.keys(self.direction):
+            if addy and addy.lower() in mmdb_addylist:
+                return self.actions
+
+
+class SqlRule(Rule):
+    """
+    from-sql and to-sql rules.  Expects a SELECT statement as the
+    'match' field.  There are two "modes", depending on the presence of
+    TMDA-style wildcards in the database.  See the filter source
+    documentation for more information.
+    """
+
+    def match(self, ctx):
+        selectstmt = self.field
+        keys = ctx.dbkeys(self.direction)
+        addr_column = self.args.get('addr_column')
+        if 'wildcards' in self.args:
+            if addr_column:
+                raise MatchError(self.lineno,
+                                 "-addr_column and -wildcards " +
+                                 "cannot be used together")
+        elif not addr_column:
+            raise MatchError(self.lineno, "-addr_column must be specified")
         else:
-            actions = {}
-        return actions, line
+            criteria = ctx.parser._create_sql_criteria(keys, addr_column)
+            selectstmt = selectstmt.replace('%(criteria)s', criteria)
+        actions = self.actions.copy()
+        if ctx.parser._search_sql(selectstmt, self.args, keys,
+                                  actions, self.source, self.lineno):
+            return actions
+
+
+class PipeHeadersRule(Rule):
+    """
+    pipe-headers rules.  A match is found if the command exits with a
+    zero exit status.
+    """
+
+    def match(self, ctx):
+        headers = ctx.headers()
+        if headers:
+            return _runpipe(self, headers)
+
+
+class PipeRule(Rule):
+    """
+    pipe rules.  A match is found if the command exits with a zero exit
+    status.
+    """
+
+    def match(self, ctx):
+        body = ctx.body()
+        headers = ctx.headers()
+        if body and headers:
+            return _runpipe(self, headers + '\n' + body)
+
+
+class RegexRule(Rule):
+    """body and headers rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        try:
+            self.regex = re.compile(self.field, _reflags(self.args))
+        except re.error as e:
+            raise Error('"%s": bad regular expression: %s' % (self.source, e))
+
+    def match(self, ctx):
+        content = _content(self.source, ctx)
+        if content and self.regex.search(content):
+            return self.actions
+
+
+class PatternFileRule(Rule):
+    """body-file and headers-file rules."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.field = os.path.expanduser(self.field)
+
+    def warm(self):
+        try:
+            _patternfile(self.field, _reflags(self.args))
+        except EnvironmentError:
+            pass
+
+    def match(self, ctx):
+        try:
+            patterns = _patternfile(self.field, _reflags(self.args))
+        except IOError:
+            if 'optional' not in self.args:
+                raise
+            return None
+        content = _content(self.source, ctx)
+        if content and patterns.search(content):
+            return self.actions
+
+
+class SizeRule(Rule):
+    """size rules, matching messages smaller (<) or larger (>) than a
+    number of bytes."""
+
+    def __init__(self, *rule):
+        Rule.__init__(self, *rule)
+        self.operator = self.field[:1] # first character should be < or >
+        try:
+            self.bytesize = int(self.field[1:]) # rest is the size
+        except ValueError:
+            raise Error('"%s": bad size: %s' % (self.source, self.field))
+
+    def match(self, ctx):
+        size = ctx.size()
+        if not size:
+            return None
+        if self.operator == '<' and int(size) < self.bytesize:
+            return self.actions
+        if self.operator == '>' and int(size) > self.bytesize:
+            return self.actions
+
+
+# The Rule subclass for each source.
+_ruleclasses = {
+    'from'          : AddressRule,
+    'to'            : AddressRule,
+    'from-file'     : FileRule,
+    'to-file'       : FileRule,
+    'from-dbm'      : DbmRule,
+    'to-dbm'        : DbmRule,
+    'from-cdb'      : CdbRule,
+    'to-cdb'        : CdbRule,
+    'from-ezmlm'    : EzmlmRule,
+    'to-ezmlm'      : EzmlmRule,
+    'from-mailman'  : MailmanRule,
+    'to-mailman'    : MailmanRule,
+    'from-sql'      : SqlRule,
+    'to-sql'        : SqlRule,
+    'pipe-headers'  : PipeHeadersRule,
+    'pipe'          : PipeRule,
+    'body'          : RegexRule,
+    'headers'       : RegexRule,
+    'body-file'     : PatternFileRule,
+    'headers-file'  : PatternFileRule,
+    'size'          : SizeRule,
+    }
+
+
+def _makerule(rule, filename=None):
+    """
+    Return the Rule for a (source, args, match, actions, lineno) tuple
+    read from filename.
+    """
+    rule = _ruleclasses[rule[0].lower()](*rule)
+    rule.filename = filename
+    return rule
+
+
+def load_stats(pathname):
+    """
+    Return the rule statistics saved in pathname by save_stats, as a
+    dictionary keyed by (filter filename, lineno).  Each value is a
+    [rule, evaluations, matches, seconds] list.
+    """
+    stats = {}
+    try:
+        fp = open(pathname, 'r')
+    except IOError:
+        return stats
+    with fp:
+        _readstats(fp, stats)
+    return stats
+
+
+def save_stats(pathname, stats):
+    """
+    Add stats (see load_stats) to the statistics in pathname.  The file
+    is locked while it is updated, so concurrent deliveries don't lose
+    each other's counts.
+    """
+    import fcntl
+    fd = os.open(pathname, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        total = {}
+        _readstats(fp, total)
+        for (key, (rule, evals, hits, seconds)) in stats.items():
+            entry = total.setdefault(key, [rule, 0, 0, 0.0])
+            entry[0] = rule
+            entry[1] += evals
+            entry[2] += hits
+            entry[3] += seconds
+        fp.seek(0)
+        fp.truncate()
+        for ((filename, lineno), (rule, evals, hits, seconds)) \
+                in sorted(total.items()):
+            fp.write('%s\t%d\t%d\t%d\t%.6f\t%s\n' %
+                     (filename, lineno, evals, hits, seconds,
+                      ' '.join(rule.split())))
+
+
+def _readstats(fp, stats):
+    """
+    Read the statistics in fp, written by save_stats, into stats.
+    Malformed lines are skipped.
+    """
+    for line in fp:
+        fields = line.rstrip('\n').split('\t', 5)
+        try:
+            (filename, lineno, evals, hits, seconds, rule) = fields
+            stats[(filename, int(lineno))] = [rule, int(evals), int(hits),
+                                              float(seconds)]
+        except ValueError:
+            continue
+
+
+def _content(source, ctx):
+    """
+    Return the part of the message searched by a body* or headers* rule.
+    """
+    if source.startswith('body'):
+        return ctx.body()
+    return ctx.headers()
+
+
+def _runpipe(rule, text):
+    """
+    Run the command of a pipe or pipe-headers rule with text as its
+    input.  Return the rule's actions if the command succeeded.
+    """
+    (r, out, err) = Util.runcmd(rule.field, text)
+    if r == 0:
+        return rule.actions
+    # raise an exception if the process exited due to a signal.
+    elif r < 0:
+        raise Error('command "%s" abnormal exit signal %s (%s)' %
+                    (rule.field, -r, err.strip()))
+
+
+def _domains(keys):
+    """
+    Attempt to extract the domain name from each address in keys.
+    """
+    domains = {}
+    for k in keys:
+        try:
+            domains[k.split('@', 1)[1]] = None
+        except (AttributeError, IndexError):
+            pass
+    return list(domains.keys())
+
+
+# Address lists used by from-file and to-file rules, keyed by absolute
+# pathname.  Each value is a (signature, Util.AddressMatcher) tuple.
+# Entries are only rebuilt when the file changes, so a long-running
+# process reads each list once.
+_listcache = {}
+
+
+# Expression files used by body-file and headers-file rules, keyed by
+# (absolute pathname, flags).  Each value is a (signature, PatternFile)
+# tuple, rebuilt only when the file changes.
+_patterncache = {}
+
+
+# Inline flags at the start of an expression apply to the whole
+# expression, so they can't be used inside an alternation.
+_globalflags = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+class PatternFile:
+    """
+    The regular expressions in a body-file or headers-file, compiled.
+
+    Expressions are fused into a single alternation so that the
+    message is scanned once rather than once per line.  Each
+    alternative is a named group which identifies the matching line.
+    Expressions with groups of their own (whose numbering would change
+    inside the alternation) or with global inline flags are searched
+    separately.
+    """
+
+    def __init__(self, exprs, flags):
+        self.exprs = exprs
+        fused = []
+        self.separate = []
+        for (index, expr) in enumerate(exprs):
+            regex = re.compile(expr, flags)
+            if regex.groups or _globalflags.match(expr):
+                self.separate.append((index, regex))
+            else:
+                fused.append('(?P<l%d>%s)' % (index, expr))
+        self.regex = None
+        if fused:
+            try:
+                self.regex = re.compile('|'.join(fused), flags)
+            except re.error:
+                # Fall back to searching each expression on its own.
+                self.separate = [(index, re.compile(expr, flags))
+                                 for (index, expr) in enumerate(exprs)]
+
+    def search(self, content):
+        """
+        Return an expression which matches content, or None.  When
+        several do, which one is returned isn't defined (it is that of
+        the leftmost match): rules only need to know whether any line
+        matched, and content is scanned just once.
+        """
+        if self.regex:
+            mo = self.regex.search(content)
+            if mo:
+                return self.exprs[int(mo.lastgroup[1:])]
+        for (index, regex) in self.separate:
+            if regex.search(content):
+                return self.exprs[index]
+        return None
+
+
+def _reflags(args):
+    """
+    Return the re flags for a body or headers rule with arguments args.
+    """
+    if 'case' in args:
+        return re.MULTILINE
+    return re.MULTILINE | re.IGNORECASE
+
+
+def _patternfile(pathname, flags):
+    """
+    Return a PatternFile for the expressions in pathname, re-reading the
+    file only if it changed since the last call.
+    """
+    pathname = os.path.abspath(pathname)
+    sig = _statsig(os.stat(pathname))
+    cached = _patterncache.get((pathname, flags))
+    if cached and cached[0] == sig:
+        return cached[1]
+    exprs = []
+    for line in Util.file_to_list(pathname):
+        mo = FilterParser.matches.match(line)
+        if mo:
+            exprs.append(mo.group(2) or mo.group(3))
+    patterns = PatternFile(exprs, flags)
+    _patterncache[(pathname, flags)] = (sig, patterns)
+    return patterns
+
+
+def _lowerkeys(addrlist):
+    """
+    Return addrlist with the first column of each line lowercased.
+    """
+    result = []
+    for line in addrlist:
+        fields = line.split(None, 1)
+        if not fields:
+            continue
+        fields[0] = fields[0].lower()
+        result.append(' '.join(fields))
+    return result
+
+
+def _listmatcher(pathname):
+    """
+    Return a Util.AddressMatcher for the address list in pathname,
+    re-reading the file only if it changed since the last call.
+    """
+    pathname = os.path.abspath(pathname)
+    sig = _statsig(os.stat(pathname))
+    cached = _listcache.get(pathname)
+    if cached and cached[0] == sig:
+        return cached[1]
+    matcher = Util.AddressMatcher(_lowerkeys(Util.file_to_list(pathname)))
+    _listcache[pathname] = (sig, matcher)
+    return matcher
+
+
+def _once(value):
+    """
+    Return a function returning value or, if value is a function, the
+    result of calling it.  value is called at most once.
+    """
+    if not callable(value):
+        return lambda: value
+    result = []
+    def get():
+        if not result:
+            result.append(value())
+        return result[0]
+    return get
+
+
+def _closehandle(handle):
+    """
+    Close a database handle, if it can be closed.
+    """
+    close = getattr(handle, 'close', None)
+    if close:
+        close()
+
+
+def _statsig(st):
+    """
+    Return a signature of a file's stat() result which changes whenever
+    the file is modified or replaced.
+    """
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _pathsig(path):
+    """
+    Return the signature of the file at path, or None if it doesn't exist.
+    """
+    try:
+        return _statsig(os.stat(path))
+    except OSError:
+        return None
 
 
 def _rulestr(source, args, match, actions):
@@ -0,0 +1,193 @@
+# -*- python -*-
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""
+Read-only sorted index files for address lists.
+
+An index is built from a text address list (the kind used by the
+from-file and to-file filter rules) and gives the same results as
+searching the text file, without needing the cdb or dbm modules.
+Addresses without wildcards are stored in a sorted table which is
+binary-searched through mmap, and the remaining wildcard lines are
+kept in a small side section.
+
+File layout (integers are unsigned 32-bit big-endian):
+
+  header     magic, number of keys, offset of the string heap,
+             offset and length of the wildcard section
+  table      one record per key, sorted by key: key offset, key
+             length, line number, action offset, action length
+  heap       UTF-8 keys and actions
+  wildcards  UTF-8 lines of the form 'lineno pattern [action]'
+"""
+
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+
+from . import Util
+
+
+logger = logging.getLogger('tmda.listindex')
+
+MAGIC = b'TMDAIDX1'
+
+_header = struct.Struct('>8sIIII')
+_record = struct.Struct('>IIIII')
+
+
+class Error(Exception):
+    """Exception raised for invalid index files."""
+    pass
+
+
+def build(filename, indexname=None):
+    """Build an index from a text file.
+
+    The index is written to a temporary file and renamed into place,
+    so readers never see a partial index.  Return True on success, or
+    log the reason and return False if the list can't be read or the
+    index can't be written.
+    """
+    if indexname is None:
+        indexname = filename + '.idx'
+    try:
+        exact = {}
+        wildcards = []
+        for (lineno, line) in enumerate(Util.file_to_list(filename)):
+            fields = line.split()
+            key = fields[0].lower()
+            if Util.is_literal_pattern(key):
+                # The first occurrence of a key wins, as in the text file.
+                if key not in exact:
+                    action = len(fields) > 1 and fields[1] or ''
+                    exact[key] = (lineno, action)
+            else:
+                wildcards.append('%d %s\n' % (lineno,
+                                              ' '.join([key] + fields[1:])))
+        records = sorted((key.encode('utf-8'), lineno, action.encode('utf-8'))
+                         for (key, (lineno, action)) in exact.items())
+        heap_offset = _header.size + len(records) * _record.size
+        table = bytearray()
+        heap = bytearray()
+        for (key, lineno, action) in records:
+            key_offset = heap_offset + len(heap)
+            heap += key
+            action_offset = heap_offset + len(heap)
+            heap += action
+            table += _record.pack(key_offset, len(key), lineno,
+                                  action_offset, len(action))
+        wild = ''.join(wildcards).encode('utf-8')
+        header = _header.pack(MAGIC, len(records), heap_offset,
+                              heap_offset + len(heap), len(wild))
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(indexname)
+                                       or os.curdir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(header)
+                fp.write(table)
+                fp.write(heap)
+                fp.write(wild)
+            os.chmod(tmpname, Util.getfilemode(filename))
+            os.rename(tmpname, indexname)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+    except (OSError, ValueError, struct.error) as e:
+        # The caller falls back to searching the text file.
+        logger.warning("Can't build list index %s: %s", indexname, e)
+        return False
+    return True
+
+
+class ListIndex:
+    """A memory-mapped index built by build().
+
+    Provides the same match() interface as Util.AddressMatcher.
+    """
+
+    def __init__(self, indexname):
+        self.indexname = indexname
+        with open(indexname, 'rb') as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, self.count, heap_offset,
+             wild_offset, wild_length) = _header.unpack_from(self.map)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            self.map.close()
+            raise Error('"%s": not a TMDA list index' % indexname)
+        # The wildcard section is small, so it is parsed right away.
+        wild = self.map[wild_offset:wild_offset+wild_length].decode('utf-8')
+        self.wild_linenos = []
+        patterns = []
+        for line in wild.splitlines():
+            (lineno, pattern) = line.split(' ', 1)
+            self.wild_linenos.append(int(lineno))
+            patterns.append(pattern)
+        self.wildcards = None
+        if patterns:
+            self.wildcards = Util.AddressMatcher(patterns)
+
+    def close(self):
+        self.map.close()
+
+    def lookup(self, key):
+        """Binary search the table for key (a lowercased address).
+        Return a (lineno, result) tuple or None."""
+        key = key.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (key_offset, key_length, lineno,
+             action_offset, action_length) = _record.unpack_from(
+                self.map, _header.size + mid * _record.size)
+            midkey = self.map[key_offset:key_offset+key_length]
+            if midkey < key:
+                lo = mid + 1
+            elif midkey > key:
+                hi = mid
+            else:
+                action = self.map[action_offset:action_offset+action_length]
+                return (lineno, action.decode('utf-8') or 1)
+        return None
+
+    def search(self, address):
+        """Return the result for a single lowercased address, or None."""
+        found = self.lookup(address)
+        if self.wildcards:
+            index = self.wildcards.find(address)
+            if index is not None:
+                lineno = self.wild_linenos[index]
+                if not found or lineno < found[0]:
+                    found = (lineno, self.wildcards.results[index])
+        if found:
+            return found[1]
+
+    def match(self, addrs):
+        """See Util.AddressMatcher.match."""
+        for address in addrs:
+            if address:
+                result = self.search(address.lower())
+                if result:
+                    return result
@@ -24,9 +24,15 @@
 """Pending messages functions."""
 
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from email.utils import parseaddr
+import functools
 import os
+import pickle
+import smtplib
 import sys
+import threading
 import time
 
 from . import Defaults
@@ -40,6 +46,173 @@ Q = Queue()
 Q = Q.init()
 
 
+class PendingCache:
+    """The ids of pending messages that have already been seen (see
+    PENDING_CACHE), most recently added first.  Only the newest maxlen
+    ids are kept.
+
+    The file is a log with one id per line, or the id prefixed with '-'
+    once it has been removed.  save() appends whatever has changed since
+    the cache was loaded, and only rewrites the file, with just the ids
+    in the cache, once the log has grown to twice maxlen lines."""
+
+    def __init__(self, filename, maxlen):
+        self.filename = filename
+        self.maxlen = maxlen
+        self._ids = OrderedDict()
+        # Log lines not yet written, and the number in the file.
+        self._log = []
+        self._loglen = 0
+        self._compact = False
+
+    def load(self):
+        """Read the cache from disk, and return it."""
+        try:
+            fp = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return self
+        with fp:
+            data = fp.read()
+        if data[:1] in (b'(', b'\x80'):
+            # A list pickled by older versions, newest first.
+            for msgid in reversed(pickle.loads(data)):
+                self._ids[msgid] = None
+            self._compact = True
+        else:
+            lines = data.decode('ascii', 'replace').split()
+            for line in lines:
+                if line.startswith('-'):
+                    self._ids.pop(line[1:], None)
+                else:
+                    self._ids[line] = None
+            self._loglen = len(lines)
+        self._trim()
+        return self
+
+    def __contains__(self, msgid):
+        return msgid in self._ids
+
+    def __iter__(self):
+        return reversed(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _trim(self):
+        while len(self._ids) > self.maxlen:
+            self._ids.popitem(last=False)
+
+    def add(self, msgid):
+        """Add msgid to the cache.  Returns false if it was already
+        there."""
+        if msgid in self._ids:
+            return False
+        self._ids[msgid] = None
+        self._log.append(msgid)
+        self._trim()
+        return True
+
+    def add_many(self, msgids):
+        """Add each of msgids to the cache, and return the number that
+        weren't already there."""
+        added = 0
+        for msgid in msgids:
+            if self.add(msgid):
+                added += 1
+        return added
+
+    def remove(self, msgid):
+        if msgid in self._ids:
+            del self._ids[msgid]
+            self._log.append('-' + msgid)
+
+    def save(self):
+        """Write any changes to disk."""
+        if self._compact or self._loglen + len(self._log) > 2 * self.maxlen:
+            tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o600)
+            with os.fdopen(fd, 'w') as fp:
+                fp.writelines([msgid + '\n' for msgid in self._ids])
+            os.replace(tmpname, self.filename)
+            self._loglen = len(self._ids)
+            self._compact = False
+        elif self._log:
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, ''.join([line + '\n' for line in self._log])
+                         .encode('ascii'))
+            finally:
+                os.close(fd)
+            self._loglen += len(self._log)
+        self._log = []
+
+
+class ListAppends:
+    """Appends to list files (PENDING_*_APPEND) collected while
+    disposing of messages, so that each file is written just once."""
+
+    def __init__(self):
+        self.files = OrderedDict()
+
+    def add(self, address, filename):
+        self.files.setdefault(filename, []).append(address)
+
+    def flush(self):
+        for (filename, addresses) in self.files.items():
+            Util.append_many_to_file(addresses, filename)
+        self.files.clear()
+
+
+class Reinjector:
+    """Reinjects released messages from a pool of threads.  With the
+    'smtp' MAIL_TRANSPORT, each thread keeps its own connection to the
+    SMTP server.  At most twice as many messages as there are threads
+    are waiting to be sent at once."""
+
+    def __init__(self, jobs):
+        self.executor = ThreadPoolExecutor(jobs)
+        self.slots = threading.BoundedSemaphore(jobs * 2)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.results = []
+
+    def _send(self, msgstr, envrecip, envsender):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None and Defaults.MAIL_TRANSPORT == 'smtp':
+            from . import SMTP
+            connection = self.local.connection = SMTP.Connection()
+            with self.lock:
+                self.connections.append(connection)
+        Util.sendmail(msgstr, envrecip, envsender, connection=connection)
+
+    def submit(self, msgid, msgstr, envrecip, envsender):
+        """Queue a message to be sent, waiting if too many already are."""
+        self.slots.acquire()
+        future = self.executor.submit(self._send, msgstr, envrecip,
+                                      envsender)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.results.append((msgid, future))
+
+    def finish(self):
+        """Wait for all messages to be sent, close the connections, and
+        return a list of (msgid, exception) pairs, where exception is
+        None if the message was sent."""
+        self.executor.shutdown(wait=True)
+        results = [(msgid, future.exception())
+                   for (msgid, future) in self.results]
+        for connection in self.connections:
+            # The messages have been sent; a connection which can't be
+            # closed cleanly doesn't matter.
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        return results
+
+
 class Queue:
     """A simple pending queue."""
 
@@ -55,7 +228,8 @@ class Queue:
                   threshold = None,
                   verbose = 1,
                   younger = None,
-                  pretend = None ):
+                  pretend = None,
+                  jobs = None ):
 
         self.msgs = msgs
         self.cache = cache
@@ -69,6 +243,7 @@ class Queue:
         self.verbose = verbose
         self.younger = younger
         self.pretend = pretend
+        self.jobs = jobs
 
         self.stdout = sys.stdout
 
@@ -130,20 +305,25 @@ class Queue:
     def _loadCache(self):
         """Load the message cache from disk."""
         if self.cache:
-            if os.path.exists(Defaults.PENDING_CACHE):
-                self.msgcache = Util.unpickle(Defaults.PENDING_CACHE)
-            else:
-                self.msgcache = []
+            self.msgcache = PendingCache(Defaults.PENDING_CACHE,
+                                         Defaults.PENDING_CACHE_LEN).load()
+
+    def _inCache(self, msgid):
+        """Return true if the message is in the cache."""
+        return self.cache and msgid in self.msgcache
 
     def _addCache(self, msgid):
         """Add a message to the cache."""
         if self.cache:
-            if msgid in self.msgcache:
+            if not self.msgcache.add(msgid):
                 return 0
-            else:
-                self.msgcache.insert(0, msgid)
         return 1
 
+    def _addCacheList(self, msgids):
+        """Add several messages to the cache."""
+        if self.cache:
+            self.msgcache.add_many(msgids)
+
     def _delCache(self, msgid):
         """Remove a message from the cache."""
         if self.cache:
@@ -154,10 +334,7 @@ class Queue:
     def _saveCache(self):
         """Save the cache on disk."""
         if self.cache:
-            # Trim tail entries off if necessary, and then save the
-            # cache in ASCII format.
-            self.msgcache = self.msgcache[:Defaults.PENDING_CACHE_LEN]
-            Util.pickleit(self.msgcache, Defaults.PENDING_CACHE, 0)
+            self.msgcache.save()
 
     ## Threshold (-Y and -O options)
     def checkTreshold(self, msgid):
@@ -166,7 +343,11 @@ class Queue:
             threshold_secs = Util.seconds(self.threshold)
             now = '%d' % time.time()
             min_time = int(now) - int(threshold_secs)
-            msg_time = int(msgid.split('.')[0])
+            try:
+                msg_time = int(msgid.split('.')[0])
+            except ValueError:
+                # not a message id; let Message() complain about it
+                return 1
             if (self.younger and msg_time < min_time) or \
                (self.older and msg_time > min_time):
                 # skip this message
@@ -177,6 +358,13 @@ class Queue:
         """Dispose the message."""
         if self.dispose is None or self.dispose == 'pass':
             return 0
+        if self.jobs and not self.pretend:
+            # Bulk disposal: reinject from a pool of threads, and
+            # collect list appends; see _finishBulk().
+            if self.reinjector is None:
+                self.reinjector = Reinjector(self.jobs)
+            M.list_appends = self.list_appends
+            M.reinject = functools.partial(self.reinjector.submit, M.msgid)
         if not self.pretend:
             if self.dispose == 'release':
                 M.release()
@@ -208,47 +396,81 @@ class Queue:
         """Pure virtual method to be overriden by inherited classes."""
         pass
 
+    def wanted(self, msgid):
+        """Return true if the message passes the checks that can be
+        made from its id alone (threshold and cache)."""
+        return self.checkTreshold(msgid) and not self._inCache(msgid)
+
+    def _finishBulk(self):
+        """Write the list appends collected during a bulk disposal,
+        and wait for and report on its reinjections."""
+        self.list_appends.flush()
+        if self.reinjector is None:
+            return
+        for (msgid, error) in self.reinjector.finish():
+            if error is None:
+                self.cPrint('reinjected ', msgid)
+            else:
+                self.failed.append(msgid)
+                # Leave it out of the cache, so --cache brings it up
+                # again next time.
+                self._delCache(msgid)
+                self.Print('%s %s failed: %s' % (self.dispose, msgid, error))
+        self.reinjector = None
+
     ## Main loop
     def mainLoop(self):
         """Process all the messages."""
 
         self.total = len(self.msgs)
         self.count = 0
+        # The ids of messages whose bulk disposal failed.
+        self.failed = []
+        self.list_appends = ListAppends()
+        self.reinjector = None
 
         self._loadCache()
+        # Skip messages using their ids before anything is read, and get
+        # what's needed to list the rest from the metadata index, rather
+        # than parsing each of them.
+        metadata = Q.fetch_metadata([msgid for msgid in self.msgs
+                                     if self.wanted(msgid)])
 
-        for msgid in self.msgs:
-            self.count = self.count + 1
-            try:
-                M = Message(msgid, self.command_recipient)
-            except Errors.MessageError as obj:
-                self.cPrint(obj)
-                continue
-
-            if not self.checkTreshold(M.msgid):
-                continue
-            if not self._addCache(M.msgid):
-                continue
-
-            # Pass over the message if it lacks X-TMDA-Recipient and we
-            # aren't using `-R'.
-            if not M.getConfirmAddress():
-                self.cPrint("can't determine recipient address, skipping", M.msgid)
-                continue
-
-            if not self.processMessage(M):
-                break
-
-            # Optionally dispose of the message
-            message = '%s %s' % (self.dispose, M.msgid)
-            if self.pretend:
-                message = message + ' (not)'
-            if self.dispose:
-                self.cPrint('\n', message)
-            if not self.disposeMessage(M):
-                continue
-
-            self.endProcessMessage(M)
+        try:
+            for msgid in self.msgs:
+                self.count = self.count + 1
+                if not self.wanted(msgid):
+                    continue
+                try:
+                    M = Message(msgid, self.command_recipient,
+                                metadata=metadata.get(msgid))
+                except Errors.MessageError as obj:
+                    self.cPrint(obj)
+                    continue
+
+                self._addCache(M.msgid)
+
+                # Pass over the message if it lacks X-TMDA-Recipient and
+                # we aren't using `-R'.
+                if not M.getConfirmAddress():
+                    self.cPrint("can't determine recipient address, skipping", M.msgid)
+                    continue
+
+                if not self.processMessage(M):
+                    break
+
+                # Optionally dispose of the message
+                message = '%s %s' % (self.dispose, M.msgid)
+                if self.pretend:
+                    message = message + ' (not)'
+                if self.dispose:
+                    self.cPrint('\n', message)
+                if not self.disposeMessage(M):
+                    continue
+
+                self.endProcessMessage(M)
+        finally:
+            self._finishBulk()
 
         self._saveCache()
 
@@ -266,7 +488,8 @@ class InteractiveQueue(Queue):
                   threshold = None,
                   verbose = 1,
                   younger = None,
-                  pretend = None ):
+                  pretend = None,
+                  jobs = None ):
 
         Queue.__init__(self,
                        msgs,
@@ -280,7 +503,8 @@ class InteractiveQueue(Queue):
                        threshold,
                        verbose,
                        younger,
-                       pretend)
+                       pretend,
+                       jobs)
 
 
     def initQueue(self):
@@ -352,28 +576,74 @@ class InteractiveQueue(Queue):
 
 
 class Message:
-    """A simple pending message class"""
+    """A simple pending message class
+
+    If metadata (a record from the queue's metadata index) is given,
+    the message itself is only fetched from the queue when something
+    other than the indexed headers and size is needed."""
     msg_size = 0
     bytes = 'bytes'
     confirm_accept_address = None
-    def __init__(self, msgid, recipient = None, fullParse = False):
+    _msgobj = None
+    # Set by Queue for bulk disposal: a ListAppends to collect list
+    # appends in, and a function to reinject released messages with.
+    list_appends = None
+    reinject = None
+    def __init__(self, msgid, recipient = None, fullParse = False,
+                 metadata = None):
         self.msgid = msgid
-        if not Q.find_message(self.msgid):
-            raise Errors.MessageError('%s not found!' % self.msgid)
-        self.msgobj = Q.fetch_message(self.msgid, fullParse=fullParse)
+        self.fullParse = fullParse
+        self.metadata = metadata
+        if metadata is None:
+            self._getMsgobj()
+        else:
+            self.msg_size = metadata['size']
         self.recipient = recipient
         if self.recipient is None:
-            self.recipient = self.msgobj.get('x-tmda-recipient')
-        self.return_path = parseaddr(self.msgobj.get('return-path'))[1]
-        self.x_primary_address = parseaddr(self.msgobj.get('x-primary-address'))[1]
+            self.recipient = self.getHeader('x-tmda-recipient')
+        self.return_path = parseaddr(self.getHeader('return-path'))[1]
+        self.x_primary_address = parseaddr(
+            self.getHeader('x-primary-address'))[1]
         self.append_address = Util.confirm_append_address(
             self.x_primary_address, self.return_path)
 
+    def _getMsgobj(self):
+        """Fetch the message from the queue if that's not been done."""
+        if self._msgobj is None:
+            if not Q.find_message(self.msgid):
+                raise Errors.MessageError('%s not found!' % self.msgid)
+            self._msgobj = Q.fetch_message(self.msgid,
+                                           fullParse=self.fullParse)
+        return self._msgobj
+
+    msgobj = property(_getMsgobj)
+
+    def getHeader(self, hdr):
+        """Return the value of a header, from the metadata if it's
+        indexed there."""
+        if self.metadata is not None:
+            headers = self.metadata['headers']
+            if hdr.lower() in headers:
+                return headers[hdr.lower()]
+        return self.msgobj.get(hdr)
+
+    def getSize(self):
+        """Return the length of the message."""
+        if not self.msg_size:
+            self.msg_size = len(self.show())
+        return self.msg_size
+
+    def _appendToFile(self, address, filename):
+        if self.list_appends is not None:
+            self.list_appends.add(address, filename)
+        else:
+            Util.append_to_file(address, filename)
+
     def release(self):
         """Release a message from the pending queue."""
         from . import Cookie
         if Defaults.PENDING_RELEASE_APPEND:
-            Util.append_to_file(self.append_address,
+            self._appendToFile(self.append_address,
                                 Defaults.PENDING_RELEASE_APPEND)
         if Defaults.DB_PENDING_RELEASE_APPEND and Defaults.DB_CONNECTION:
             _username = Defaults.USERNAME.lower()
@@ -409,12 +679,15 @@ class Message:
             del self.msgobj['X-TMDA-CGI']
             self.msgobj['X-TMDA-CGI'] = cgi_header
         # Reinject the message to the original envelope recipient.
-        Util.sendmail(self.show(), self.recipient, self.return_path)
+        if self.reinject is not None:
+            self.reinject(self.show(), self.recipient, self.return_path)
+        else:
+            Util.sendmail(self.show(), self.recipient, self.return_path)
 
     def delete(self):
         """Delete a message from the pending queue."""
         if Defaults.PENDING_DELETE_APPEND:
-            Util.append_to_file(self.append_address,
+            self._appendToFile(self.append_address,
                                 Defaults.PENDING_DELETE_APPEND)
         if Defaults.DB_PENDING_DELETE_APPEND and Defaults.DB_CONNECTION:
             _username = Defaults.USERNAME.lower()
@@ -433,7 +706,7 @@ class Message:
         if (Defaults.PENDING_WHITELIST_APPEND or
             (Defaults.DB_PENDING_WHITELIST_APPEND and Defaults.DB_CONNECTION)):
             if Defaults.PENDING_WHITELIST_APPEND:
-                Util.append_to_file(self.append_address,
+                self._appendToFile(self.append_address,
                                     Defaults.PENDING_WHITELIST_APPEND)
             if Defaults.DB_PENDING_WHITELIST_APPEND and Defaults.DB_CONNECTION:
                 _username = Defaults.USERNAME.lower()
@@ -457,7 +730,7 @@ class Message:
         if (Defaults.PENDING_BLACKLIST_APPEND or
             (Defaults.DB_PENDING_BLACKLIST_APPEND and Defaults.DB_CONNECTION)):
             if Defaults.PENDING_BLACKLIST_APPEND:
-                Util.append_to_file(self.append_address,
+                self._appendToFile(self.append_address,
                                     Defaults.PENDING_BLACKLIST_APPEND)
             if Defaults.DB_PENDING_BLACKLIST_APPEND and Defaults.DB_CONNECTION:
                 _username = Defaults.USERNAME.lower()
@@ -492,14 +765,14 @@ class Message:
         for hdr in Defaults.TERSE_SUMMARY_HEADERS:
             if hdr in ('from_name', 'from_address'):
                 from_name, from_address = parseaddr(
-                    self.msgobj.get('from'))
+                    self.getHeader('from'))
                 if hdr == 'from_name':
                     terse_hdrs.append(from_name
                                       or from_address or 'None')
                 elif hdr == 'from_address':
                     terse_hdrs.append(from_address or 'None')
             else:
-                terse_hdrs.append(self.msgobj.get(hdr))
+                terse_hdrs.append(self.getHeader(hdr))
 
         if date:
             terse_hdrs.insert(0,self.getDate())
@@ -528,10 +801,8 @@ class Message:
 
     def summary(self, count = 0, total = 0, mailto = 0):
         """Return summary header information."""
-        if not self.msg_size:
-            self.msg_size = len(self.show())
-            if  self.msg_size == 1:
-                self.bytes =    self.bytes[:-1]
+        if self.getSize() == 1:
+            self.bytes = 'byte'
         str = self.msgid + " ("
         if total:
             str += "%s of %s / " % (count, total)
@@ -540,7 +811,7 @@ class Message:
         for hdr in Defaults.SUMMARY_HEADERS:
             str += "%s %s: %s\n" % ('  >>',
                                  hdr.capitalize()[:4].rjust(4),
-                                 Util.decode_header(self.msgobj.get(hdr)))
+                                 Util.decode_header(self.getHeader(hdr)))
 
         if mailto and self.getConfirmAddress():
             str+= '<mailto:%s>' % self.confirm_accept_address
@@ -30,9 +30,11 @@ from glob import glob
 
 
 import fcntl
+import logging
 import os
 import signal
 import socket
+import sqlite3
 import stat
 import time
 
@@ -40,9 +42,13 @@ import time
 from .. import Defaults
 from .. import Errors
 from .. import Util
+from .Metadata import MetadataIndex
 from .Queue import Queue
 
 
+logger = logging.getLogger('tmda.queue')
+
+
 def alarm_handler(signum, frame):
     """Handle an alarm."""
     print('Signal handler called with signal', signum)
@@ -58,10 +64,71 @@ def unlock_file(fp):
 
 
 
+class MaildirIndex:
+    """A persistent mapping of message ids to the names of their files
+    relative to the Maildir (e.g, 'new/1159387731.4602.host'), kept in
+    an SQLite database in the Maildir.
+
+    The index is only a hint.  Entries can be missing or out of date
+    (e.g, once a MUA has moved a message to cur/), so callers must check
+    the file is really there, and fall back to searching the Maildir.
+    If the database can't be used, the index simply appears empty.
+    The database is shared with the queue's metadata index."""
+
+    FILENAME = MetadataIndex.FILENAME
+
+    def __init__(self, maildir):
+        self.path = os.path.join(maildir, self.FILENAME)
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            exists = os.path.exists(self.path)
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            if not exists:
+                os.chmod(self.path, 0o600)
+            conn.execute('CREATE TABLE IF NOT EXISTS messages ('
+                         'id TEXT PRIMARY KEY, '
+                         'filename TEXT NOT NULL)')
+            self._conn = conn
+        return self._conn
+
+    def get(self, mailid):
+        """Return the file name recorded for mailid, or None."""
+        try:
+            row = self._connect().execute(
+                'SELECT filename FROM messages WHERE id = ?',
+                (mailid,)).fetchone()
+        except (sqlite3.Error, OSError):
+            return None
+        if row is None:
+            return None
+        return row[0]
+
+    def set(self, mailid, filename):
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?)',
+                (mailid, filename))
+        except (sqlite3.Error, OSError) as e:
+            # Lookups fall back to searching the Maildir.
+            logger.warning("can't update %s: %s", self.path, e)
+
+    def delete(self, mailid):
+        try:
+            self._connect().execute('DELETE FROM messages WHERE id = ?',
+                                    (mailid,))
+        except (sqlite3.Error, OSError):
+            pass
+
+
+
 class MaildirQueue(Queue):
     def __init__(self):
         Queue.__init__(self)
         self.format = "maildir"
+        self._index = MaildirIndex(Defaults.PENDING_DIR)
 
 
     def exists(self):
@@ -123,6 +190,8 @@ class MaildirQueue(Queue):
             except OSError:
                 # in case of concurrent cleanups
                 pass
+            self._index.delete('.'.join(msg.split('.')[:2]))
+            self._metadata.delete('.'.join(msg.split('.')[:2]))
 
 
     def fetch_ids(self):
@@ -145,53 +214,74 @@ class MaildirQueue(Queue):
         msg['X-TMDA-Recipient'] = recipient
         # Write message
         time, pid = mailid.split('.')
-        self.__deliver_maildir(Util.msg_as_string(msg), time, pid,
-                               Defaults.PENDING_DIR)
+        text = Util.msg_as_string(msg)
+        filename = self.__deliver_maildir(text, time, pid,
+                                          Defaults.PENDING_DIR)
+        # The message is safely stored now.  The indexes only save work
+        # later, so their set() methods log any database errors rather
+        # than fail the delivery.
+        self._index.set(mailid, os.path.join('new', filename))
+        self._index_message(mailid, msg, text)
         del msg['X-TMDA-Recipient']
 
 
+    def _locate(self, mailid):
+        """Return the full path of the message's file, or None if it
+        isn't in the queue.
+
+        The name insert_message() gave the file and the one in the index
+        are tried first; only if neither exists are new/ and cur/
+        searched, and the index brought up to date."""
+        candidates = [os.path.join('new', '%s.%s' % (mailid,
+                                                      socket.gethostname()))]
+        indexed = self._index.get(mailid)
+        if indexed and indexed not in candidates:
+            candidates.append(indexed)
+        for name in candidates:
+            path = os.path.join(Defaults.PENDING_DIR, name)
+            if os.path.exists(path):
+                return path
+        for subdir in ('new', 'cur'):
+            found = glob(os.path.join(Defaults.PENDING_DIR, subdir,
+                                      mailid + '.*'))
+            if found:
+                self._index.set(mailid, os.path.relpath(found[0],
+                                                        Defaults.PENDING_DIR))
+                # A MUA that moves a message to cur/ also sets its flags.
+                info = os.path.basename(found[0]).split(':2,', 1)
+                if len(info) == 2:
+                    self._metadata.set_flags(mailid, info[1])
+                return found[0]
+        if indexed:
+            self._index.delete(mailid)
+        return None
+
+
     def fetch_message(self, mailid, fullParse=False):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                msg = Util.msg_from_file(open(m, 'rb'),fullParse=fullParse, isBytes=True)
-                return msg
-        else:
+        path = self._locate(mailid)
+        if path is None:
             # couldn't find message, defer and retry until we find it
-            raise IOError( "couldn't locate %s, will retry" % m)
+            raise IOError( "couldn't locate %s, will retry" % mailid)
+        return Util.msg_from_file(open(path, 'rb'), fullParse=fullParse,
+                                  isBytes=True)
 
 
     def delete_message(self, mailid):
-        msgs = (glob(os.path.join(Defaults.PENDING_DIR, 'new/')
-                     + '1*.[0-9]*.*')) + \
-                     (glob(os.path.join(Defaults.PENDING_DIR, 'cur/')
-                           + '1*.[0-9]*.*'))
-        for m in msgs:
-            if mailid in m:
-                os.unlink(m)
+        path = self._locate(mailid)
+        if path is not None:
+            os.unlink(path)
+        self._index.delete(mailid)
+        self._metadata.delete(mailid)
 
 
     def find_message(self, mailid):
-        cwd = os.getcwd()
-        os.chdir(Defaults.PENDING_DIR)
-        msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-
         for i in range(5):
-            for m in msgs:
-                if mailid in m:
-                    os.chdir(cwd)
-                    return True
-            else:
-                # retry 5 times in case a MUA moved/renamed the
-                # message to cur/ in a non-atomic way.
-                time.sleep(0.1)
-                msgs = glob('new/1*.[0-9]*.*') + glob('cur/1*.[0-9]*.*')
-                continue
+            if self._locate(mailid):
+                return True
+            # retry 5 times in case a MUA moved/renamed the
+            # message to cur/ in a non-atomic way.
+            time.sleep(0.1)
         # give up; message is not there
-        os.chdir(cwd)
         return False
 
 
@@ -207,6 +297,8 @@ class MaildirQueue(Queue):
 
         maildir is the destination Maildir.
 
+        Returns the name of the new file in maildir/new.
+
         Based on code from getmail
         Copyright (C) 2001 Charles Cazabon, and licensed under the GNU
         General Public License version 2.
@@ -273,4 +365,5 @@ class MaildirQueue(Queue):
         # Cancel the alarm.
         signal.alarm(0)
         signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        return filename
 
@@ -0,0 +1,171 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Metadata index for the pending queue.
+
+Listing the pending queue (tmda-pending, tmda-cgi) only needs a few
+headers and the size of each message.  Rather than open and parse
+every message to get them, they are kept in an SQLite database in
+PENDING_DIR, updated as messages are inserted and deleted.
+
+A record is a dictionary with these keys:
+
+headers is a dictionary of the indexed headers (see HEADERS), keyed by
+lower-case header name.  Missing headers have a value of None.
+
+size is the length of the message's text.
+
+flags are the Maildir info flags of the message's file (e.g, 'S'
+once a MUA has seen it), or '' if there are none.
+"""
+
+
+import logging
+import os
+import sqlite3
+
+
+logger = logging.getLogger('tmda.queue')
+
+# The indexed headers, and the columns they're kept in.
+HEADERS = (('x-tmda-recipient', 'recipient'),
+           ('return-path', 'return_path'),
+           ('x-primary-address', 'x_primary_address'),
+           ('from', 'from_header'),
+           ('to', 'to_header'),
+           ('subject', 'subject'),
+           ('date', 'date'))
+
+COLUMNS = ['id'] + [column for (hdr, column) in HEADERS] + ['size', 'flags']
+
+
+def make_record(msg, size, flags=''):
+    """Return the index record for msg, an email.message object whose
+    text is size characters long."""
+    headers = {}
+    for (hdr, column) in HEADERS:
+        value = msg.get(hdr)
+        if value is not None:
+            value = str(value)
+        headers[hdr] = value
+    return {'headers': headers, 'size': size, 'flags': flags}
+
+
+class MetadataIndex:
+    """The metadata records of the messages in a pending queue.
+
+    The database lives in the queue's directory, and is shared with
+    MaildirQueue's file name index.  Like that index, this one is only
+    a cache of what's in the messages themselves: callers must be
+    prepared for records to be missing or to describe messages that
+    are no longer there.  Other than in set_many(), errors
+    from the database are ignored (set() logs them), and a database
+    that can't be used simply appears empty."""
+
+    FILENAME = '.tmda-index.db'
+
+    def __init__(self, queuedir):
+        self.path = os.path.join(queuedir, self.FILENAME)
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            exists = os.path.exists(self.path)
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            if not exists:
+                os.chmod(self.path, 0o600)
+            conn.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                         'id TEXT PRIMARY KEY, ' +
+                         ''.join(['%s TEXT, ' % column
+                                  for (hdr, column) in HEADERS]) +
+                         'size INTEGER NOT NULL, '
+                         "flags TEXT NOT NULL DEFAULT '')")
+            self._conn = conn
+        return self._conn
+
+    def _row(self, mailid, record):
+        return ([mailid] + [record['headers'][hdr] for (hdr, column) in HEADERS]
+                + [record['size'], record['flags']])
+
+    def _record(self, row):
+        headers = {}
+        for (i, (hdr, column)) in enumerate(HEADERS):
+            headers[hdr] = row[i + 1]
+        return {'headers': headers, 'size': row[-2], 'flags': row[-1]}
+
+    def fetch(self):
+        """Return a dictionary mapping the id of every indexed message
+        to its record."""
+        try:
+            rows = self._connect().execute(
+                'SELECT %s FROM metadata' % ', '.join(COLUMNS)).fetchall()
+        except (sqlite3.Error, OSError):
+            return {}
+        return dict([(row[0], self._record(row)) for row in rows])
+
+    def set(self, mailid, record):
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO metadata VALUES (%s)'
+                % ', '.join(['?'] * len(COLUMNS)),
+                self._row(mailid, record))
+        except (sqlite3.Error, OSError) as e:
+            # Messages missing from the index are parsed when listed.
+            logger.warning("can't update %s: %s", self.path, e)
+
+    def set_many(self, records, delete=(), clear=False):
+        """Add or replace many records (a dictionary keyed by message
+        id) in a single transaction.  The records of the ids in delete,
+        or every record if clear is true, are removed first, in the same
+        transaction."""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if clear:
+                conn.execute('DELETE FROM metadata')
+            else:
+                conn.executemany('DELETE FROM metadata WHERE id = ?',
+                                 [(mailid,) for mailid in delete])
+            conn.executemany(
+                'INSERT OR REPLACE INTO metadata VALUES (%s)'
+                % ', '.join(['?'] * len(COLUMNS)),
+                [self._row(mailid, record)
+                 for (mailid, record) in records.items()])
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def set_flags(self, mailid, flags):
+        try:
+            self._connect().execute(
+                'UPDATE metadata SET flags = ? WHERE id = ?',
+                (flags, mailid))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def delete(self, mailid):
+        try:
+            self._connect().execute('DELETE FROM metadata WHERE id = ?',
+                                    (mailid,))
+        except (sqlite3.Error, OSError):
+            pass
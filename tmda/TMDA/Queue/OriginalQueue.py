@@ -96,6 +96,7 @@ class OriginalQueue(Queue):
             except OSError:
                 # in case of concurrent cleanups
                 pass
+            self._metadata.delete(msg[:-len('.msg')])
 
     def fetch_ids(self):
         return [i.rstrip('.msg') for i in self._pending_msgs()]
@@ -111,18 +112,20 @@ class OriginalQueue(Queue):
         fcontents = Util.msg_as_string(msg)
         fpath = os.path.join(Defaults.PENDING_DIR, fname)
         Util.writefile(fcontents, fpath)
+        self._index_message(mailid, msg, fcontents)
         del msg['X-TMDA-Recipient']
 
 
     def fetch_message(self, mailid, fullParse=False):
         fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
-        msg = Util.msg_from_file(file(fpath, 'rb'), fullParse=fullParse, isBytes=True)
+        msg = Util.msg_from_file(open(fpath, 'rb'), fullParse=fullParse, isBytes=True)
         return msg
 
 
     def delete_message(self, mailid):
         fpath = os.path.join(Defaults.PENDING_DIR, mailid + '.msg')
         os.unlink(fpath)
+        self._metadata.delete(mailid)
 
 
     def find_message(self, mailid):
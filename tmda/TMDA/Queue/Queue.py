@@ -27,13 +27,18 @@ seperated by a dot, e.g, "1159383896.4198".  This infomration
 currently comes from a timestamp and the Python process id.
 """
 
+import sqlite3
+
 from .. import Defaults
 from .. import Errors
+from .. import Util
+from .Metadata import MetadataIndex, make_record
 
 
 class Queue:
     def __init__(self):
         self.format = "not defined"
+        self._metadata = MetadataIndex(Defaults.PENDING_DIR)
 
     # Subclasses are expected to override the following methods since
     # their implementation is specific to the format of the queue.
@@ -113,7 +118,99 @@ class Queue:
         pass
 
 
-    # Subclasses should not override this method.
+    # Subclasses should not override the following methods.  They use
+    # the metadata index, which subclasses must keep up to date with
+    # _index_message() and self._metadata.delete().
+
+    def fetch_metadata(self, mailids):
+        """
+        Return a dictionary mapping each of mailids that's in the queue
+        to its metadata record (see TMDA.Queue.Metadata).
+
+        Records come from the metadata index; messages missing from it
+        are parsed, and added to it.  Index records of messages that are
+        no longer in the queue are removed.
+        """
+        present = set(self.fetch_ids())
+        records = self._metadata.fetch()
+        stale = [mailid for mailid in records if mailid not in present]
+        for mailid in stale:
+            del records[mailid]
+        result = {}
+        parsed = {}
+        for mailid in mailids:
+            if mailid in records:
+                result[mailid] = records[mailid]
+            elif mailid in present:
+                record = self._parse_metadata(mailid)
+                if record is not None:
+                    parsed[mailid] = result[mailid] = record
+        if parsed or stale:
+            try:
+                self._metadata.set_many(parsed, delete=stale)
+            except (sqlite3.Error, OSError):
+                # The index is only a cache.
+                pass
+        return result
+
+
+    def rebuild_index(self):
+        """
+        Rebuild the metadata index from the messages in the queue, and
+        return the number of messages indexed.
+        """
+        records = {}
+        for mailid in self.fetch_ids():
+            record = self._parse_metadata(mailid)
+            if record is not None:
+                records[mailid] = record
+        try:
+            self._metadata.set_many(records, clear=True)
+        except (sqlite3.Error, OSError) as e:
+            raise Errors.QueueError(
+                "Can't rebuild the metadata index %s: %s"
+                % (self._metadata.path, e))
+        return len(records)
+
+
+    def verify_index(self):
+        """
+        Compare the metadata index with the messages in the queue.
+        Returns a tuple of three sorted lists of mailids: messages
+        missing from the index, index records of messages no longer in
+        the queue, and records that don't match their message.
+        """
+        present = set(self.fetch_ids())
+        records = self._metadata.fetch()
+        missing = sorted(present.difference(records))
+        stale = sorted(set(records).difference(present))
+        changed = []
+        for mailid in sorted(present.intersection(records)):
+            record = self._parse_metadata(mailid)
+            if record is None:
+                continue
+            # Flags aren't part of the message, so can't be checked.
+            record['flags'] = records[mailid]['flags']
+            if record != records[mailid]:
+                changed.append(mailid)
+        return (missing, stale, changed)
+
+
+    def _parse_metadata(self, mailid):
+        """Return the metadata record of a message by parsing it, or
+        None if it has gone."""
+        try:
+            msg = self.fetch_message(mailid)
+        except (IOError, OSError, Errors.MessageError):
+            return None
+        return make_record(msg, len(Util.msg_as_string(msg)))
+
+
+    def _index_message(self, mailid, msg, text, flags=''):
+        """Record a newly inserted message in the metadata index.  msg
+        is the message object, text is the text written to the queue."""
+        self._metadata.set(mailid, make_record(msg, len(text), flags))
+
 
     def init(self):
         qformat = Defaults.PENDING_QUEUE_FORMAT
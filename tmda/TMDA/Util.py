@@ -22,7 +22,7 @@
 """General purpose functions."""
 
 
-from io import StringIO
+from io import BytesIO, StringIO, UnsupportedOperation
 import pickle
 import email
 import email.utils
@@ -158,6 +158,15 @@ def getgrouplist(username):
     return gids
 
 
+def switch_user(username):
+    """Permanently change UID and GID to username.  Requires a real or
+    effective UID of root."""
+    os.seteuid(0)
+    os.setgid(getgid(username))
+    os.setgroups(getgrouplist(username))
+    os.setuid(getuid(username))
+
+
 def getfilemode(path):
     """Return the octal number of the bit pattern for the file
     permissions on path."""
@@ -217,13 +226,15 @@ def getvdomainprepend(address, vdomainsfile):
     return ret_prepend
 
 
-def getvuserhomedir(user, domain, script):
-    """Return the home directory of a qmail virtual domain user."""
+def getvuserhomedir(user, domain, script, env=None, prefix=()):
+    """Return the home directory of a qmail virtual domain user.  The
+    script is run with environment env (by default, ours), and through
+    the command prefix (a list) if one is given."""
     cmd = "%s %s %s" % (script, user, domain)
-    fpin = os.popen(cmd)
-    vuserhomedir = fpin.read()
-    fpin.close()
-    return vuserhomedir.strip()
+    if prefix:
+        cmd = list(prefix) + ['/bin/sh', '-c', cmd]
+    (r, vuserhomedir, stderrdata) = runcmd(cmd, stdout=PIPE, env=env)
+    return vuserhomedir.decode().strip()
 
 
 def getuserparams(login):
@@ -305,6 +316,8 @@ def unixdate(timesecs=None):
     return ' '.join(asctime_list)
 
 
+_msgid_count = 0
+
 def make_msgid(timesecs=None, pid=None):
     """Return an rfc2822 compliant Message-ID: string, composed of
     seconds since the epoch in UTC + process id + 'TMDA' + FQDN. e.g:
@@ -320,6 +333,12 @@ def make_msgid(timesecs=None, pid=None):
     if not pid:
         from . import Defaults
         pid = Defaults.PID
+        # Long-running processes (e.g, tmda-ofmipd's injection workers)
+        # can make several IDs a second, so number all but the first.
+        global _msgid_count
+        if _msgid_count:
+            pid = '%s.%d' % (pid, _msgid_count)
+        _msgid_count += 1
     idhost = os.environ.get('TMDAIDHOST') or \
              os.environ.get('QMAILIDHOST') or \
              gethostname()
@@ -354,18 +373,28 @@ def file_to_list(filename):
     return result
 
 
-def runcmd(cmd, instr=None, stdout=None, stderr=None):
+def runcmd(cmd, instr=None, stdout=None, stderr=None, env=None):
     """Run a command, wait for it to complete, and return a tuple of
     (return value, stdout text, stderr text). instr is a string to
-    pass as input. stdout and stderr can take the same forms as their
-    subprocess.Popen equivalents.
+    pass as input, or a binary file to read it from; a file with a
+    descriptor becomes the command's stdin directly. stdout, stderr
+    and env can take the same forms as their subprocess.Popen
+    equivalents.
     """
     use_shell = False
     if isinstance(cmd, str):
         use_shell = True
 
-    process = subprocess.Popen(cmd, stdin=PIPE, stdout=stdout, stderr=stderr,
-                               shell=use_shell)
+    stdin = PIPE
+    if hasattr(instr, 'read'):
+        try:
+            instr.fileno()
+            stdin, instr = instr, None
+        except UnsupportedOperation:
+            instr = instr.read()
+
+    process = subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                               shell=use_shell, env=env)
     if type(instr) == str:
         instr = bytes(instr, 'utf-8')
     (stdoutdata, stderrdata) = process.communicate(instr)
@@ -373,11 +402,11 @@ def runcmd(cmd, instr=None, stdout=None, stderr=None):
     return (process.returncode, stdoutdata, stderrdata)
 
 
-def runcmd_checked(cmd, instr=None, stdout=None, stderr=None):
+def runcmd_checked(cmd, instr=None, stdout=None, stderr=None, env=None):
     """Version of runcmd that doesn't return the exit code or
     signal, but raises an exception for errors and signals.
     """
-    (r, stdoutdata, stderrdata) = runcmd(cmd, instr, stdout, stderr)
+    (r, stdoutdata, stderrdata) = runcmd(cmd, instr, stdout, stderr, env)
     if r > 0:
         raise Exception('command %r exited with error %d' % (cmd, r))
     if r < 0:
@@ -396,7 +425,14 @@ def writefile(contents, fullpathname):
 
 def append_to_file(s, fullpathname):
     """Append a string to a text file if it isn't already in there."""
-    bare = bytes(s.expandtabs().split('#')[0].strip().lower(), 'utf-8')
+    append_many_to_file([s], fullpathname)
+
+
+def append_many_to_file(strings, fullpathname):
+    """Append each of a list of strings to a text file if it isn't
+    already in there (or earlier in the list), reading the file once
+    and writing to it at most once."""
+    present = set()
     if os.path.exists(fullpathname):
         for inline in open(fullpathname, 'rb'):
             line = inline.strip().lower()
@@ -406,11 +442,18 @@ def append_to_file(s, fullpathname):
             line = line.expandtabs()
             line = line.split(b'#', 1)[0]
             line = line.strip()
-            if bare == line:
-                # Already there
-                return
-    with open(fullpathname, 'a+') as f:
-        f.write(s.strip() + '\n')
+            present.add(line)
+    lines = []
+    for s in strings:
+        bare = bytes(s.expandtabs().split('#')[0].strip().lower(), 'utf-8')
+        if bare in present:
+            # Already there
+            continue
+        present.add(bare)
+        lines.append(s.strip() + '\n')
+    if lines:
+        with open(fullpathname, 'a+') as f:
+            f.write(''.join(lines))
 
 
 def pager(str):
@@ -551,7 +594,7 @@ def msg_as_string(msg, maxheaderlen=False, mangle_from_=False, unixfrom=False):
     return fp.getvalue()
 
 
-def sendmail(msgstr, envrecip, envsender):
+def sendmail(msgstr, envrecip, envsender, connection=None):
     """Send e-mail via direct SMTP, or by opening a pipe to the
     sendmail program.
 
@@ -560,6 +603,9 @@ def sendmail(msgstr, envrecip, envsender):
     envrecip is the envelope recipient address.
 
     envsender is the envelope sender address.
+
+    connection is an optional SMTP.Connection to send with, which is
+    left open, if MAIL_TRANSPORT is 'smtp'.
     """
     from . import Defaults
     # Sending mail with a null envelope sender address <> is not done
@@ -591,6 +637,9 @@ def sendmail(msgstr, envrecip, envsender):
                '-f', envsender, '--', envrecip)
         runcmd_checked(cmd, msgstr)
     elif Defaults.MAIL_TRANSPORT == 'smtp':
+        if connection is not None:
+            connection.sendmail(envsender, envrecip, msgstr)
+            return
         from . import SMTP
         server = SMTP.Connection()
         server.sendmail(envsender, envrecip, msgstr)
@@ -653,6 +702,42 @@ def body_as_raw_string(msg):
     return msgtext[idx+2:]
 
 
+class MessageText:
+    """The text of a message, as given by msg_as_string(),
+    headers_as_raw_string() and body_as_raw_string().
+
+    Nothing is computed until it is first asked for, and the message
+    is serialized at most once.  The message is parsed from raw (the
+    message as bytes) rather than taken from an existing Message
+    object, so the results stay the same however that object is later
+    modified."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.__text = None
+        self.__separator = None
+
+    def as_string(self):
+        if self.__text is None:
+            msg = msg_from_file(BytesIO(self.raw), isBytes=True)
+            self.__text = msg_as_string(msg)
+        return self.__text
+
+    def __index(self):
+        if self.__separator is None:
+            self.__separator = self.as_string().index('\n\n')
+        return self.__separator
+
+    def headers_as_raw_string(self):
+        return self.as_string()[:self.__index()+1]
+
+    def body_as_raw_string(self):
+        return self.as_string()[self.__index()+2:]
+
+    def size(self):
+        return len(self.as_string())
+
+
 
 def rename_headers(msg, old, new):
     """Rename all occurances of a message header in a Message object.
@@ -705,7 +790,7 @@ def build_cdb(filename):
         tmpname = os.path.split(tempfile.mktemp())[1]
         cdb = cdb.cdbmake(cdbname, cdbname + '.' + tmpname)
         for line in file_to_list(filename):
-            key, value = (line.split() + [''])[:1]
+            key, value = (line.split() + [''])[:2]
             cdb.add(key.lower(), value)
         cdb.finish()
     except:
@@ -724,7 +809,7 @@ def build_dbm(filename):
         tmpname = tempfile.mktemp()
         db = dbm.open(tmpname, 'n')
         for line in file_to_list(filename):
-            key, value = (line.split() + [''])[:1]
+            key, value = (line.split() + [''])[:2]
             db[key.lower()] = value
         db.close()
         for f in glob.glob(tmpname + '*'):
@@ -755,12 +840,14 @@ def pickleit(object, file, proto=2):
 
     default is 2, since we must support Python 2.3 and above.
     """
-    tempfile.tempdir = os.path.dirname(file)
-    tmpname = tempfile.mkstemp()[1]
-    fp = open(tmpname, 'wb')
-    pickle.dump(object, fp, proto)
-    fp.close()
-    os.rename(tmpname, file)
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(file) or os.curdir)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(object, fp, proto)
+        os.rename(tmpname, file)
+    except:
+        os.unlink(tmpname)
+        raise
     return
 
 
@@ -787,35 +874,209 @@ def db_insert(db, insert_sql, params):
         cursor.close()
 
 
+def _fnmatch_address(p, address):
+    """Return true if the pattern p (the first field of an address
+    list line) matches address."""
+    # Handle special @=domain.dom syntax.
+    try:
+        at = p.rindex('@')
+        atequals = p[at+1] == '='
+    except (ValueError, IndexError):
+        atequals = None
+    if atequals:
+        p1 = p[:at+1] + p[at+2:]
+        p2 = p[:at+1] + '*.' + p[at+2:]
+        return (fnmatch.fnmatch(address,p1)
+                or fnmatch.fnmatch(address,p2))
+    return fnmatch.fnmatch(address,p)
+
+
+def _findmatch_linear(list, address):
+    """Return the result of the first pattern in list matching address
+    (already lowercased), or None.  See findmatch."""
+    for p in list:
+        stringparts = p.split()
+        if _fnmatch_address(stringparts[0], address):
+            try:
+                return stringparts[1]
+            except IndexError:
+                return 1
+
+
+def is_literal_pattern(p):
+    """Return true if the address pattern p contains no wildcards (and
+    no @=domain.dom syntax), i.e, it only matches itself."""
+    at = p.rfind('@')
+    if at >= 0 and p[at+1:at+2] == '=':
+        return False
+    return not AddressMatcher._wildcards.search(p)
+
+
+class _DomainNode:
+    """One label of the reverse-domain trie used by AddressMatcher."""
+
+    __slots__ = ('children', 'domain', 'subdomains')
+
+    def __init__(self):
+        self.children = {}
+        # local part -> pattern index, for entries matching exactly
+        # this domain (local@domain.dom)
+        self.domain = {}
+        # local part -> pattern index, for entries matching this
+        # domain and all of its subdomains (local@=domain.dom)
+        self.subdomains = {}
+
+
+class AddressMatcher:
+    """A compiled form of a list of address patterns, as accepted by
+    findmatch.
+
+    Patterns without wildcards are kept in a dictionary, patterns of
+    the form user@domain.dom, *@domain.dom, user@=domain.dom and
+    *@=domain.dom are kept in a reverse-domain trie, and the remaining
+    wildcard patterns are compiled into a single regular expression.
+    Matching returns the same result as findmatch would, i.e, the
+    first matching pattern in list order wins.
+    """
+
+    _wildcards = re.compile(r'[*?[]')
+
+    def __init__(self, list):
+        self.patterns = list
+        self.exact = {}
+        self.trie = _DomainNode()
+        alternatives = []
+        self.results = []
+        for p in list:
+            stringparts = p.split()
+            if not stringparts:
+                self.results.append(None)
+                continue
+            index = len(self.results)
+            self.results.append(len(stringparts) > 1 and stringparts[1] or 1)
+            p = stringparts[0]
+            at = p.rfind('@')
+            atequals = at >= 0 and p[at+1:at+2] == '='
+            if atequals:
+                local, domain = p[:at], p[at+2:]
+                if self.__add_domain(local, domain, index, True):
+                    continue
+                alternatives.append((index, p[:at+1] + domain))
+                alternatives.append((index, p[:at+1] + '*.' + domain))
+            elif is_literal_pattern(p):
+                self.exact.setdefault(p, index)
+            elif at >= 0 and self.__add_domain(p[:at], p[at+1:], index, False):
+                continue
+            else:
+                alternatives.append((index, p))
+        # Python's alternation is ordered, so the first alternative that
+        # matches the whole address is the earliest pattern.
+        self.regex = None
+        self.groups = {}
+        if alternatives:
+            parts = []
+            for (i, (index, p)) in enumerate(alternatives):
+                parts.append('(?P<p%d>%s)' % (i, fnmatch.translate(p)))
+                self.groups['p%d' % i] = index
+            self.regex = re.compile('|'.join(parts))
+
+    def __add_domain(self, local, domain, index, subdomains):
+        """Add a pattern to the domain trie if it fits there."""
+        if ('@' in local or self._wildcards.search(domain)
+            or (local != '*' and self._wildcards.search(local))):
+            return False
+        node = self.trie
+        for label in reversed(domain.split('.')):
+            node = node.children.setdefault(label, _DomainNode())
+        if subdomains:
+            node.subdomains.setdefault(local, index)
+        else:
+            node.domain.setdefault(local, index)
+        return True
+
+    def __search_trie(self, local, domain):
+        """Return the indices of the trie entries matching local@domain."""
+        found = []
+        node = self.trie
+        for label in reversed(domain.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return found
+            for key in (local, '*'):
+                if key in node.subdomains:
+                    found.append(node.subdomains[key])
+        for key in (local, '*'):
+            if key in node.domain:
+                found.append(node.domain[key])
+        return found
+
+    def find(self, address):
+        """Return the position in the pattern list of the first pattern
+        matching a single lowercased address, or None."""
+        if address.count('@') > 1:
+            # The trie can't decide which '@' a wildcard should span.
+            for (index, p) in enumerate(self.patterns):
+                stringparts = p.split()
+                if stringparts and _fnmatch_address(stringparts[0], address):
+                    return index
+            return None
+        found = []
+        if address in self.exact:
+            found.append(self.exact[address])
+        if '@' in address:
+            local, domain = address.split('@', 1)
+            found.extend(self.__search_trie(local, domain))
+        if self.regex:
+            mo = self.regex.match(address)
+            if mo:
+                found.append(self.groups[mo.lastgroup])
+        if found:
+            return min(found)
+        return None
+
+    def search(self, address):
+        """Return the result for a single lowercased address, or None."""
+        index = self.find(address)
+        if index is not None:
+            return self.results[index]
+
+    def match(self, addrs):
+        """Determine whether any of the passed e-mail addresses match,
+        trying the addresses in order.  Return the second field of the
+        matching pattern if it exists, 1 if it doesn't, or None if
+        nothing matched."""
+        for address in addrs:
+            if address:
+                result = self.search(address.lower())
+                if result:
+                    return result
+
+
+# AddressMatchers built by findmatch, keyed by the id of their list.
+# Each entry keeps the list alive, so that its id isn't reused, and a
+# copy of it, in case it has been changed since.
+_matchercache = {}
+
 def findmatch(list, addrs):
     """Determine whether any of the passed e-mail addresses match a
     Unix shell-style wildcard pattern contained in list.  The
     comparison is case-insensitive.  Also, return the second half of
-    the string if it exists (for exp and ext addresses only)."""
-    for address in addrs:
-        if address:
-            address = address.lower()
-            for p in list:
-                stringparts = p.split()
-                p = stringparts[0]
-                # Handle special @=domain.dom syntax.
-                try:
-                    at = p.rindex('@')
-                    atequals = p[at+1] == '='
-                except (ValueError, IndexError):
-                    atequals = None
-                if atequals:
-                    p1 = p[:at+1] + p[at+2:]
-                    p2 = p[:at+1] + '*.' + p[at+2:]
-                    match = (fnmatch.fnmatch(address,p1)
-                             or fnmatch.fnmatch(address,p2))
-                else:
-                    match = fnmatch.fnmatch(address,p)
-                if match:
-                    try:
-                        return stringparts[1]
-                    except IndexError:
-                        return 1
+    the string if it exists (for exp and ext addresses only).
+
+    list may also be an AddressMatcher built from such a list.  The
+    matcher built from a plain list is reused as long as the same,
+    unchanged list is passed."""
+    if not isinstance(list, AddressMatcher):
+        cached = _matchercache.get(id(list))
+        if cached and cached[0] is list and cached[1] == list:
+            matcher = cached[2]
+        else:
+            matcher = AddressMatcher(list)
+            if len(_matchercache) >= 16:
+                _matchercache.clear()
+            _matchercache[id(list)] = (list, list[:], matcher)
+        list = matcher
+    return list.match(addrs)
 
 
 def wraptext(text, column=70):
@@ -919,6 +1180,7 @@ def filter_match(filename, recip, sender=None):
     filter = FilterParser.FilterParser(Defaults.DB_CONNECTION)
     filter.read(filename)
     (actions, matchline) = filter.firstmatch(recip, [sender])
+    filter.close()
     # print the results
     checking_msg = 'Checking ' + filename
     print(checking_msg)
@@ -934,6 +1196,136 @@ def filter_match(filename, recip, sender=None):
         print('Sorry, no matching lines.')
 
 
+_quoted_from = re.compile(b'>+From ')
+
+def iter_messages(paths):
+    """Yield a (name, envelope sender, message bytes) tuple for each
+    message in paths.
+
+    Each path may be a message file, an mbox file, a Maildir, or a
+    directory of message files.  The envelope sender is taken from the
+    mbox From_ line or, failing that, the Return-Path header, and is
+    None if neither is present.  Quoted '>From ' lines in an mbox are
+    unquoted, as in the mboxrd format."""
+    for path in paths:
+        if os.path.isdir(path):
+            subdirs = [os.path.join(path, sub) for sub in ('cur', 'new')]
+            if not all(map(os.path.isdir, subdirs)):
+                subdirs = [path]
+            for subdir in subdirs:
+                for name in sorted(os.listdir(subdir)):
+                    filename = os.path.join(subdir, name)
+                    if os.path.isfile(filename):
+                        with open(filename, 'rb') as fp:
+                            yield filename, None, fp.read()
+            continue
+        with open(path, 'rb') as fp:
+            if fp.read(5) != b'From ':
+                fp.seek(0)
+                yield path, None, fp.read()
+                continue
+            fp.seek(0)
+            count = 0
+            lines = sender = None
+            for line in fp:
+                if line.startswith(b'From ') and (lines is None or
+                                                  not lines or
+                                                  lines[-1] in (b'\n',
+                                                                b'\r\n')):
+                    if lines is not None:
+                        count += 1
+                        yield ('%s:%d' % (path, count), sender,
+                               b''.join(lines[:-1]))
+                    fields = line.split()
+                    sender = len(fields) > 1 and fields[1].decode(
+                        'ascii', 'replace') or None
+                    lines = []
+                elif _quoted_from.match(line):
+                    lines.append(line[1:])
+                else:
+                    lines.append(line)
+            if lines is not None:
+                count += 1
+                yield '%s:%d' % (path, count), sender, b''.join(lines)
+
+
+def filter_batch(filename, paths, recip=None, out=None, statsfile=None):
+    """Match every message in paths (see iter_messages) against the
+    filter in filename, writing one JSON object per message to out
+    (default stdout).  Rule statistics are only kept (see FILTER_STATS)
+    if a statsfile is given, so that trying out a filter doesn't mix
+    into the statistics of real deliveries.
+
+    The filter is parsed once.  The sender is the envelope sender (see
+    iter_messages) and the recipient is recip if given, or else taken
+    from the RECIPIENT_HEADER, Delivered-To, X-Original-To or To
+    header."""
+    import json
+    from email.utils import parseaddr
+    from . import Defaults
+    from . import FilterParser
+    if out is None:
+        out = sys.stdout
+    filter = FilterParser.FilterParser(Defaults.DB_CONNECTION, statsfile)
+    filter.read(filename)
+
+    def messages():
+        for (name, sender, raw) in iter_messages(paths):
+            msg = msg_from_file(BytesIO(raw), isBytes=True)
+            if sender is None:
+                sender = parseaddr(msg.get('return-path'))[1]
+            if sender == '<>':
+                sender = ''
+            recipient = recip
+            for hdr in (Defaults.RECIPIENT_HEADER, 'delivered-to',
+                        'x-original-to', 'to'):
+                if recipient:
+                    break
+                if hdr:
+                    recipient = parseaddr(msg.get(hdr))[1]
+            senders = [sender.lower()]
+            xp = parseaddr(msg.get('x-primary-address'))[1]
+            append = confirm_append_address(xp, sender)
+            if append and append.lower() not in senders:
+                senders.append(append)
+            text = MessageText(raw)
+            yield { 'name'        : name,
+                    'recipient'   : recipient,
+                    'senders'     : senders,
+                    'msg_body'    : text.body_as_raw_string,
+                    'msg_headers' : text.headers_as_raw_string,
+                    'msg_size'    : text.size }
+
+    try:
+        for (message, actions, line) in filter.firstmatch_many(messages()):
+            (action, option) = actions.get('incoming', (None, None))
+            out.write(json.dumps({ 'message'   : message['name'],
+                                   'recipient' : message['recipient'],
+                                   'sender'    : message['senders'][0],
+                                   'action'    : action,
+                                   'option'    : option,
+                                   'rule'      : line }) + '\n')
+    finally:
+        filter.close()
+
+
+def filter_stats(statsfile):
+    """Print the rule statistics in statsfile (see FILTER_STATS),
+    slowest rules first."""
+    from . import FilterParser
+    stats = FilterParser.load_stats(statsfile)
+    if not stats:
+        print('No rule statistics in', statsfile)
+        return
+    print('%10s %9s %9s %9s  %s' % ('Time (s)', 'Avg (ms)', 'Tried',
+                                    'Matched', 'Rule'))
+    entries = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    for ((filename, lineno), (rule, evals, hits, seconds)) in entries:
+        print('%10.3f %9.3f %9d %9d  %s:%d: %s' %
+              (seconds, evals and 1000 * seconds / evals, evals, hits,
+               filename, lineno, rule))
+
+
 def CanRead( file, uid = None, gid = None, raiseError = 1 ):
     try:
         return CanMode( file, MODE_READ, uid, gid )
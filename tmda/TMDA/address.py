@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.11
 #
 # Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
 #
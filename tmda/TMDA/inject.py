@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.11
 #
 # Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
 #
@@ -92,6 +92,7 @@ from . import FilterParser
 from . import Util
 
 from email.utils import formataddr, getaddresses, parseaddr
+from io import BytesIO
 import socket
 
 
@@ -103,11 +104,6 @@ if opts.filter_match:
     Util.filter_match(Defaults.FILTER_OUTGOING, recip, sender)
     sys.exit()
 
-msgout = Util.msg_from_file(sys.stdin.buffer, isBytes=True)
-orig_msgout_as_string = Util.msg_as_string(msgout)
-orig_msgout_size = len(orig_msgout_as_string)
-orig_msgout_body_as_raw_string = Util.body_as_raw_string(msgout)
-
 def message_format(fsa, ffn, type):
     # "angles" is the default MESSAGE_FROM_STYLE
     if type == 'address':
@@ -192,6 +188,7 @@ def inject_message(resending,
                    full_name,
                    msg,
                    orig_msgout_body_as_raw_string,
+                   orig_msgout_size,
                    actions,
                    log_msg):
     """Hand the message off to sendmail."""
@@ -280,11 +277,16 @@ def inject_message(resending,
     Util.purge_headers(msg, nice_headers.keys())
 
 
-######
-# Main
-######
+def tag_and_send(msgdata, address_list=None):
+    """Tag the message in msgdata (bytes) and send a copy to each
+    address in address_list.  If address_list is empty, the recipients
+    are taken from $QMAILRCPTS or from the message headers.
 
-def main():
+    This is the whole of tmda-inject minus the command line, so it can
+    also be run in-process (e.g, by tmda-ofmipd's injection workers)."""
+    msgout = Util.msg_from_file(BytesIO(msgdata), isBytes=True)
+    orig_msgout_size = len(Util.msg_as_string(msgout))
+    orig_msgout_body_as_raw_string = Util.body_as_raw_string(msgout)
 
     x_tmda_over = None
     actions = None
@@ -305,8 +307,8 @@ def main():
         from_address = Defaults.USERNAME + '@' + Defaults.HOSTNAME
 
     # If recipients were provided as arguments, use them.
-    if args:
-        address_list = args
+    if address_list:
+        address_list = list(address_list)
     # If running through qfilter, get recipient list from QMAILRCPTS.
     elif 'QMAILRCPTS' in os.environ:
         address_list = os.environ['QMAILRCPTS'].lower().split('\n')[:-1]
@@ -419,10 +421,12 @@ def main():
             pass
         else:
             # Without `X-TMDA', we need to parse the outgoing filter file.
-            outfilter = FilterParser.FilterParser(Defaults.DB_CONNECTION)
+            outfilter = FilterParser.FilterParser(Defaults.DB_CONNECTION,
+                                                  Defaults.FILTER_STATS)
             outfilter.read(Defaults.FILTER_OUTGOING)
             (actions, matching_line) = outfilter.firstmatch(address,
                                                             [from_address])
+            outfilter.close()
             log_msg = matching_line
         if not actions:
             actions = {
@@ -438,8 +442,17 @@ def main():
                        fullname,
                        msgout,
                        orig_msgout_body_as_raw_string,
+                       orig_msgout_size,
                        actions,
                        log_msg)
+
+
+######
+# Main
+######
+
+def main():
+    tag_and_send(sys.stdin.buffer.read(), args)
     if opts.qfilter:
         sys.exit(99)
     else:
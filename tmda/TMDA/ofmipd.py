@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.11
 #
 # Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
 #
@@ -29,13 +29,23 @@ import os
 import signal
 import socket
 import sys
-import asynchat
-import asyncore
+import asyncio
 import base64
+import concurrent.futures
+import functools
+import hashlib
+import io
+import pickle
 import random
+import select
 import time
 import re
 import logging
+import shutil
+import sqlite3
+import ssl
+import tempfile
+import threading
 
 logger = logging.getLogger('tmda.ofmipd')
 logger.setLevel(logging.DEBUG)
@@ -48,6 +58,14 @@ ipauthmapfile = None  # /etc/ipauthmap or ~/.tmda/ipauthmap
 opts = None
 _authenticator = None
 ssl_context = None
+inject_pool = None
+session_slots = None
+message_executor = None
+auth_executor = None
+hostname_cache = None
+rate_limiter = None
+remote_auth_timeout = None
+remote_auth_pool_size = 0
 
 # Classes
 
@@ -181,6 +199,61 @@ class ChainAuthenticator(Authenticator):
         return '%s(%r)' % (self.__class__.__name__, self._auths)
 
 
+class CachingAuthenticator(Authenticator):
+    """A special-case authenticator that remembers successful plain_checks
+    by another authenticator for ttl seconds, so that clients which
+    reconnect every few seconds to submit mail don't cause a full check
+    (e.g, a login to a remote IMAP server) each time.
+
+    Only a salted hash of each username, password and local address is
+    kept, never the password itself.  Failures aren't cached, and neither
+    are CRAM-MD5 responses, which are only good for one ticket."""
+
+    def __init__(self, auth, ttl):
+        Authenticator.__init__(self)
+
+        self._auth = auth
+        self._ttl = ttl
+        self._salt = os.urandom(16)
+        self._entries = {}
+        self._next_sweep = 0
+        self._lock = threading.Lock()
+
+    def plain_check(self, username, password, localip):
+        key = self._key(username, password, localip)
+        now = time.time()
+        if self._entries.get(key, 0) > now:
+            logger.info('Authentication succeeded for user %r using %r',
+                        username, self)
+            return True
+        with self._lock:
+            if now >= self._next_sweep:
+                for k, expires in list(self._entries.items()):
+                    if expires <= now:
+                        del self._entries[k]
+                self._next_sweep = now + self._ttl
+        success = self._auth.plain_check(username, password, localip)
+        if success:
+            self._entries[key] = now + self._ttl
+        return success
+
+    def cram_md5_check(self, username, ticket, response):
+        return self._auth.cram_md5_check(username, ticket, response)
+
+    def _has_passwords(self):
+        return self._auth.has_cram_md5()
+
+    def _key(self, *credentials):
+        h = hashlib.sha256(self._salt)
+        for item in credentials:
+            h.update(bytes(str(item), 'utf-8') + b'\0')
+        return h.digest()
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self._auth,
+                               self._ttl)
+
+
 class FileAuthenticator(Authenticator):
     def __init__(self, filename):
         Authenticator.__init__(self)
@@ -190,6 +263,7 @@ class FileAuthenticator(Authenticator):
             raise IOError('authfile "%s" must be chmod 400 or 600!', filename)
 
         self._filename = filename
+        self._loaded = (None, {})
 
     def _get_password(self, username):
         return self._authdict().get(username.lower())
@@ -198,6 +272,17 @@ class FileAuthenticator(Authenticator):
         return True
 
     def _authdict(self):
+        """Return the dictionary of username:password pairs from the
+        authentication file, reading it again only if it has changed
+        since the last time."""
+        version = file_version(self._filename)
+        (loaded_version, authdict) = self._loaded
+        if version != loaded_version:
+            authdict = self._read_authdict()
+            self._loaded = (version, authdict)
+        return authdict
+
+    def _read_authdict(self):
         """Iterate over a tmda-ofmipd authentication file, and return a
         dictionary containing username:password pairs.  Username is
         returned in lowercase."""
@@ -217,8 +302,8 @@ class FileAuthenticator(Authenticator):
 
 
 class PamAuthenticator(Authenticator):
-    # XXX There's a significant problem here if the PAM service imposes a
-    # delay on failure. This would block all connected clients. Linux-PAM
+    # XXX If the PAM service imposes a delay on failure, each failed
+    # attempt ties up one of the --auth-threads for that long. Linux-PAM
     # has a way to control this, but it's not in Python PAM.
     # A work-around would be to use a PAM service that does not impose a
     # failure delay (e.g., uses pam_unix with the nodelay option).
@@ -286,11 +371,15 @@ class CheckpwAuthenticator(Authenticator):
 
 
 class RemoteAuthenticator(Authenticator):
+    """Base class for authenticators which check the username and
+    password with a remote server.  The remote_auth_timeout applies to
+    each operation with that server."""
+
     def __init__(self, host, port):
         Authenticator.__init__(self)
         self._host = host
         self._port = port
-        self._authmap = None
+        self._authmap = (None, {})
 
     def remote_address(self, localip):
         address = self._host
@@ -300,15 +389,33 @@ class RemoteAuthenticator(Authenticator):
             # This is a feature that seems to be undocumented. It allows
             # remote authentication address:port to be based on the address
             # for the interface that receives the connection.
-            if self._authmap is None:
-                addrdict = self._addrdict(ipauthmapfile)
-            (address, port) = addrdict.get(localip, ('127.0.0.1', None))
+            (address, port) = self._ipauthmap().get(localip,
+                                                    ('127.0.0.1', None))
 
         if port is None:
             port = self._port
 
         return (address, port)
 
+    def _ipauthmap(self):
+        """Return the mappings in ipauthmapfile (see _addrdict), reading
+        it again only if it has changed since the last time."""
+        try:
+            version = file_version(ipauthmapfile)
+        except OSError:
+            version = None
+        (loaded_version, authmap) = self._authmap
+        if version != loaded_version:
+            authmap = self._addrdict(ipauthmapfile)
+            self._authmap = (version, authmap)
+        return authmap
+
+    def _timeout_args(self):
+        """Keyword arguments for the imaplib/poplib constructors."""
+        if remote_auth_timeout is None:
+            return {}
+        return {'timeout': remote_auth_timeout}
+
     @staticmethod
     def _addrdict(filename):
         '''Read IP address mappings from a file. Each line defines a mapping
@@ -388,7 +495,7 @@ class ImapAuthenticator(RemoteAuthenticator):
             IMAP = imaplib.IMAP4
         (host, port) = self.remote_address(localip)
         try:
-            imap = IMAP(host, port)
+            imap = IMAP(host, port, **self._timeout_args())
             imap.login(username, password)
             imap.logout()
             return True
@@ -412,7 +519,7 @@ class Pop3Authenticator(RemoteAuthenticator):
 
         (host, port) = self.remote_address(localip)
         try:
-            pop = poplib.POP3(host, port)
+            pop = poplib.POP3(host, port, **self._timeout_args())
             if self._use_apop:
                 pop.apop(username, password)
             else:
@@ -445,26 +552,88 @@ class LdapAuthenticator(RemoteAuthenticator):
 
         RemoteAuthenticator.__init__(self, host, port)
         self._dn = dn
+        self._pool = ConnectionPool()
 
     def _plain_check(self, username, password, localip):
         import ldap
 
-        (host, port) = self.remote_address(localip)
+        # An LDAP connection can be bound again as another user, so
+        # connections are kept for reuse, up to remote_auth_pool_size per
+        # server.  A pooled connection that has gone stale is discarded
+        # and the check repeated on a new one.
+        address = self.remote_address(localip)
+        while True:
+            ldap_obj = self._pool.get(address)
+            pooled = ldap_obj is not None
+            try:
+                if not pooled:
+                    ldap_obj = self._connect(ldap, *address)
+                ldap_obj.simple_bind_s(self._dn % username, password)
+                success = True
+            except ldap.INVALID_CREDENTIALS:
+                logger.debug('ldap authentication failure details:',
+                             exc_info=True)
+                success = False
+            except ldap.LDAPError:
+                logger.debug('ldap authentication failure details:',
+                             exc_info=True)
+                self._unbind(ldap_obj)
+                if pooled:
+                    continue
+                return False
+            if not self._pool.put(address, ldap_obj, remote_auth_pool_size):
+                self._unbind(ldap_obj)
+            return success
+
+    @staticmethod
+    def _connect(ldap, host, port):
+        ldap_obj = ldap.initialize('ldap://%s:%s' % (host, port))
+        if remote_auth_timeout is not None:
+            ldap_obj.set_option(ldap.OPT_NETWORK_TIMEOUT, remote_auth_timeout)
+            ldap_obj.set_option(ldap.OPT_TIMEOUT, remote_auth_timeout)
+        return ldap_obj
+
+    @staticmethod
+    def _unbind(ldap_obj):
+        if ldap_obj is None:
+            return
         try:
-            ldap_obj = ldap.initialize('ldap://%s:%s' % (host, port))
-            ldap_obj.simple_bind_s(self._dn % username, password)
             ldap_obj.unbind_s()
-            return True
-        except ldap.LDAPError:
-            logger.debug('ldap authentication failure details:', exc_info=True)
-
-        return False
+        except Exception:
+            pass
 
     def __repr__(self):
         name = self.__class__.__name__
         return '%s(%r, %r, %r)' % (name, self._host, self._port, self._dn)
 
 
+class ConnectionPool(object):
+    """Idle connections to remote servers, keyed by (host, port).  It may
+    be used from several threads at once."""
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return an idle connection to key, or None if there is none."""
+        with self._lock:
+            conns = self._idle.get(key)
+            if conns:
+                return conns.pop()
+        return None
+
+    def put(self, key, conn, maxidle):
+        """Keep conn for reuse, unless there already are maxidle idle
+        connections to key.  Return True if conn was kept."""
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) >= maxidle:
+                return False
+            conns.append(conn)
+            return True
+
+
 class AuthOptions(object):
     _opt_map = {
         '-A'         : CheckpwAuthenticator,
@@ -531,35 +700,156 @@ class AuthOptions(object):
         else:
             return ChainAuthenticator(self._auths)
 
+    def cached_authenticator(self, ttl):
+        """Like authenticator(), but with successful checks cached for ttl
+        seconds if ttl is positive."""
+        auth = self.authenticator()
+        if auth is not None and ttl > 0:
+            auth = CachingAuthenticator(auth, ttl)
+        return auth
+
+
+class SMTPSession(object):
+    """An SMTP session on an asyncio stream.  run() reads the client's
+    lines, feeding them to found_terminator(), which dispatches to the
+    smtp_* command methods; those reply with push()."""
 
-class SMTPSession(asynchat.async_chat):
     COMMAND = 0
     DATA = 1
     AUTH = 2
 
-    ac_in_buffer_size = 16384
-
-    def __init__(self, conn, process_msg_func):
-        # Base class __init__ calls
-
-        asynchat.async_chat.__init__(self, conn)
+    # Sessions which are currently open.  Forked children use this to
+    # let go of the client connections.
+    sessions = set()
 
+    def __init__(self, reader, writer, process_msg_func):
         # Save our own __init__ parameters
 
-        self.__conn = conn
+        self._reader = reader
+        self._writer = writer
+        self.__conn = writer.get_extra_info('socket')
         self.__process_msg_func = process_msg_func
 
         # Initialize object state
 
-        self.set_terminator(b'\r\n')
+        self._closing = False
+        self._callbacks = []
         self.init_static_state()
         self.init_dynamic_state()
+        SMTPSession.sessions.add(self)
 
         # Debug tracing
 
         logger.info('New session %r for %r connected to %r', self, self.__peer,
                     self._local)
 
+    async def run(self):
+        """Process the session until the client quits or disconnects."""
+        error = None
+        try:
+            await self.flush()
+            self.start()
+            while not self._closing:
+                await self.flush()
+                if self.__state == self.DATA:
+                    self.found_data(await self.read_data())
+                else:
+                    line = await self.read_line()
+                    if line is None:
+                        self.push('500 Line too long')
+                        continue
+                    self.collect_incoming_data(line)
+                    self.found_terminator()
+            await self.flush()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # The client went away.
+            pass
+        except ssl.SSLError as e:
+            error = e
+        except Exception as e:
+            logger.exception('Error in SMTP session %r', self)
+            error = e
+        self.handle_close(error)
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+    async def read_line(self):
+        """Return the next line from the client, without the CRLF, or
+        None if it was longer than the StreamReader's limit (64 KiB),
+        which is far more than any command needs (RFC 5321, Section
+        4.5.3.1.4).  An overlong line is thrown away as it arrives."""
+        overlong = False
+        while True:
+            try:
+                line = await self._reader.readuntil(b'\r\n')
+            except asyncio.LimitOverrunError as e:
+                await self._reader.readexactly(e.consumed)
+                overlong = True
+                continue
+            if overlong:
+                return None
+            return line[:-2]
+
+    def discard_buffered(self):
+        """Throw away whatever has been received from the client but
+        not read yet, returning True if there was anything."""
+        # StreamReader has no public way to get at its buffer.
+        buffered = self._reader._buffer
+        if not buffered:
+            return False
+        del buffered[:]
+        return True
+
+    async def read_data(self):
+        """Return the message data up to the terminating '.' line as a
+        binary file, positioned at the start, with the transparency dots
+        removed (RFC 2821, Section 4.5.2) and LF line endings.  The data
+        is kept in memory up to opts.spool_size bytes, and in a temporary
+        file beyond that."""
+        spool = io.BytesIO()
+        start = True
+        while True:
+            try:
+                chunk = await self._reader.readuntil(b'\r\n')
+                end = True
+            except asyncio.LimitOverrunError as e:
+                # Part of an overlong line, which goes to the spool as
+                # it arrives rather than being held until its end.
+                chunk = await self._reader.readexactly(e.consumed)
+                end = False
+            if start:
+                if chunk == b'.\r\n':
+                    break
+                if chunk.startswith(b'.'):
+                    chunk = chunk[1:]
+            if end:
+                chunk = chunk[:-2] + b'\n'
+            start = end
+            spool.write(chunk)
+            if isinstance(spool, io.BytesIO) and spool.tell() > opts.spool_size:
+                spool = spool_to_disk(spool)
+        spool.seek(0)
+        return spool
+
+    async def flush(self):
+        """Wait until the replies pushed so far have been sent, then run
+        the callbacks queued by push_callback()."""
+        await self._writer.drain()
+        while self._callbacks:
+            result = self._callbacks.pop(0)()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def push_callback(self, function):
+        """Call function (a plain function or a coroutine function) once
+        the replies pushed so far have been sent."""
+        self._callbacks.append(function)
+
+    def close_when_done(self):
+        self._closing = True
+
     def handle_close(self, error=None):
         if error is None:
             err_info = ('', '')
@@ -567,10 +857,11 @@ class SMTPSession(asynchat.async_chat):
             err_info = (' with error ', repr(error))
         logger.debug('Closing session %r%s%s.', self, *err_info)
 
-        asynchat.async_chat.handle_close(self)
+        self._writer.close()
+        SMTPSession.sessions.discard(self)
 
-        logger.debug('Socket map following session close: %r',
-                     asyncore.socket_map)
+        logger.debug('Sessions open following session close: %d',
+                     len(SMTPSession.sessions))
 
     def init_static_state(self):
         """Initialize 'static state' - that state which is associated
@@ -588,15 +879,10 @@ class SMTPSession(asynchat.async_chat):
         if opts.one_session and 'TCPREMOTEIP' in os.environ:
             self.__peerip = os.environ['TCPREMOTEIP']
             self.__peername = os.environ.get('TCPREMOTEHOST', None)
-            if not self.__peername:
-                self.__peername = socket.getfqdn(self.__peerip)
             self.__peerport = os.environ['TCPREMOTEPORT']
             self.__peer = (self.__peerip, self.__peerport)
 
             self._localip = os.environ['TCPLOCALIP']
-            self._localname = os.environ.get('TCPLOCALHOST', None)
-            if not self._localname:
-                self._localname = socket.getfqdn(self._localip)
             self._localport = os.environ['TCPLOCALPORT']
             self._local = (self._localip, self._localport)
         else:
@@ -609,15 +895,22 @@ class SMTPSession(asynchat.async_chat):
                 self.__peer = self.__conn.getpeername()
                 self.__peerip = self.__peer[0]
                 self.__peerport = self.__peer[1]
-            self.__peername = socket.getfqdn(self.__peerip)
+            self.__peername = None
             self._local = self.__conn.getsockname()
             self._localip = self._local[0]
-            self._localname = socket.getfqdn(self._localip)
             self._localport = self._local[1]
 
-        # Set the TCPLOCALIP environment variable to support
-        # VPopMail's reverse IP domain mapping.
-        os.environ['TCPLOCALIP'] = self._localip
+        # Look up the client's host name in the background; it is only
+        # needed for the Received header, once a message arrives.
+        self.__peername_lookup = None
+        if not self.__peername and hostname_cache:
+            self.__peername_lookup = hostname_cache.lookup(self.__peerip)
+
+        # The environment for processing this session's messages.  It
+        # can't be left in os.environ, which all sessions share.
+        # TCPLOCALIP supports VPopMail's reverse IP domain mapping.
+        self._environ = {'TCPLOCALIP': self._localip}
+        self.__helo = None
 
     def init_dynamic_state(self):
         """Initialize 'dynamic state' - that state which must be flushed
@@ -641,7 +934,6 @@ class SMTPSession(asynchat.async_chat):
         self.__state = self.COMMAND
         self.__mailfrom = None
         self.__rcpttos = []
-        self.__data = ''
 
     def _is_loopback(self, addr):
         '''Return True if addr is a loopback address.'''
@@ -680,7 +972,6 @@ class SMTPSession(asynchat.async_chat):
     def valid_command(self, cmd, arg):
         return True
 
-    # Overrides base class for convenience
     def push(self, msg):
         line = msg
         if type(line) == type(''):
@@ -688,14 +979,11 @@ class SMTPSession(asynchat.async_chat):
         elif type(line) != type(b''):
             raise Exception("Bad argument type to push()! Need str or bytes, got %r." % type(line))
         logger.debug('S: %r', line)
-        asynchat.async_chat.push(self, line + b'\r\n')
+        self._writer.write(line + b'\r\n')
 
-    # Implementation of base class abstract method
     def collect_incoming_data(self, data):
-        #self.__line.append(data.decode('ASCII', 'ignore'))
         self.__line.append(data)
 
-    # Implementation of base class abstract method
     def found_terminator(self):
         line = b''.join(self.__line)
         logger.debug('C: %r', line)
@@ -715,41 +1003,6 @@ class SMTPSession(asynchat.async_chat):
                 return
             method(arg)
             return
-        elif self.__state == self.DATA:
-            # Remove extraneous carriage returns and de-transparency according
-            # to RFC 2821, Section 4.5.2.
-            data = []
-            for text in line.split('\r\n'):
-                if text.startswith('.'):
-                    data.append(text[1:])
-                else:
-                    data.append(text)
-            self.__data = NEWLINE.join(data)
-
-            overquota = False
-            if opts.throttlescript:
-                (overquota, out, err) = Util.runcmd(
-                    '%s %s' % (opts.throttlescript, self.__auth_username))
-
-            if overquota:
-                status = '450 Outgoing mail quota exceeded'
-            else:
-                try:
-                    self.__process_msg_func(self.__peer,
-                                            self.__mailfrom,
-                                            self.__rcpttos,
-                                            self.__data,
-                                            self.__auth_username)
-                    status = '250 Ok'
-                except:
-                    logger.exception("process_message raised an exception")
-                    raise
-
-            self.__rcpttos = []
-            self.__mailfrom = None
-            self.__state = self.COMMAND
-            self.set_terminator(b'\r\n')
-            self.push(status)
         elif self.__state == self.AUTH:
             if line == '*':
                 # client canceled the authentication attempt
@@ -765,6 +1018,100 @@ class SMTPSession(asynchat.async_chat):
             self.push('451 Internal confusion')
             return
 
+    def found_data(self, data):
+        """Process the message in data (see read_data()) in the
+        background, and reply once that's done.  Meanwhile, this session
+        won't read any further commands, but the other sessions carry
+        on."""
+        logger.debug('C: <message data, %d bytes>', data.seek(0, io.SEEK_END))
+        data.seek(0)
+        self.push_callback(functools.partial(self.process_data,
+                                             self.__mailfrom,
+                                             self.__rcpttos,
+                                             data))
+
+        self.__rcpttos = []
+        self.__mailfrom = None
+        self.__state = self.COMMAND
+
+    async def process_data(self, mailfrom, rcpttos, data):
+        if self.__helo is not None:
+            await self.resolve_peername()
+            # Put the Received header string in the environment for
+            # tmda-inject to add later.
+            self._environ['TMDA_OFMIPD_RECEIVED'] = self.received_header()
+        loop = asyncio.get_running_loop()
+        try:
+            status = await loop.run_in_executor(message_executor,
+                                                self.process_message,
+                                                mailfrom, rcpttos, data)
+        finally:
+            data.close()
+        self.push(status)
+
+    def process_message(self, mailfrom, rcpttos, data):
+        """Check the sender's quota and process the message, returning
+        the reply to send.  This runs in a message_executor thread."""
+        size = data.seek(0, io.SEEK_END)
+        data.seek(0)
+        if rate_limiter:
+            if rate_limiter.bytes and size > rate_limiter.bytes:
+                return '552 Message exceeds the outgoing mail quota'
+            try:
+                if not rate_limiter.allow(self.__auth_username, size):
+                    return '450 Outgoing mail quota exceeded'
+            except sqlite3.Error:
+                logger.exception('Error checking the rate limit')
+                return '451 Error checking the outgoing mail quota'
+
+        overquota = False
+        if opts.throttlescript:
+            (overquota, out, err) = Util.runcmd(
+                '%s %s' % (opts.throttlescript, self.__auth_username))
+
+        if overquota:
+            return '450 Outgoing mail quota exceeded'
+        try:
+            self.__process_msg_func(self.__peer,
+                                    mailfrom,
+                                    rcpttos,
+                                    data,
+                                    self.__auth_username,
+                                    dict(self._environ))
+        except:
+            logger.exception("process_message raised an exception")
+            return '451 Error processing message'
+        return '250 Ok'
+
+    async def resolve_peername(self):
+        """Wait for the client's host name, if it is being looked up,
+        for at most opts.reverse_dns_timeout seconds."""
+        if self.__peername_lookup is None:
+            return
+        try:
+            self.__peername = await asyncio.wait_for(
+                asyncio.shield(self.__peername_lookup),
+                opts.reverse_dns_timeout)
+        except asyncio.TimeoutError:
+            logger.info('Reverse DNS lookup of %s timed out', self.__peerip)
+        self.__peername_lookup = None
+
+    def received_header(self):
+        """Return the Received header string for tmda-inject to add."""
+        rh = []
+        rh.append('from %s' % (self.__helo))
+        pname = self.__peername or self.__peerip
+        if ((self.__helo.lower() != pname.lower())
+            and (pname.lower() != self.__peerip)):
+            rh.append('(%s [%s])' % (pname, self.__peerip))
+        else:
+            rh.append('(%s)' % (self.__peerip))
+        if self.__helo_extra:
+            rh.append(self.__helo_extra)
+        rh.append('by %s (tmda-ofmipd) with ESMTP;' % (FQDN))
+        rh.append(self.__helo_date)
+        return ' '.join(rh)
+
     # factored
     def __getaddr(self, keyword, arg):
         address = None
@@ -858,25 +1205,45 @@ class SMTPSession(asynchat.async_chat):
 
     def auth_notify_succeed(self):
         self.push('235 AUTH successful')
-        os.environ['LOGIN'] = self.__auth_username
+        self._environ['LOGIN'] = self.__auth_username
         self.__smtpauth = 1
 
     def auth_verify(self, sasl=None):
+        # Checking the credentials can take a while (e.g, with a remote
+        # authenticator), so it is done in an auth_executor thread.  The
+        # session won't read anything more from the client until the
+        # result is in.
         if sasl is None:
             sasl = self.__auth_sasl
-        verify = 0
-        if sasl == 'plain':
-            verify = self.verify_plain(self.__auth_resp1)
-        elif sasl == 'cram-md5':
-            verify = self.verify_cram_md5(self.__auth_resp1,
-                                          self.__auth_cram_md5_ticket)
-        elif sasl == 'login':
-            verify = self.verify_login(self.__auth_resp1, self.__auth_resp2)
+        self.push_callback(functools.partial(self.auth_verify_async, sasl,
+                                             self.__auth_resp1,
+                                             self.__auth_resp2))
+        self.auth_reset_state()
+
+    async def auth_verify_async(self, sasl, resp1, resp2):
+        loop = asyncio.get_running_loop()
+        verify = await loop.run_in_executor(auth_executor, self.auth_check,
+                                            sasl, resp1, resp2)
         if verify == 1:
             self.auth_notify_succeed()
         else:
             self.auth_notify_fail(verify)
-        self.auth_reset_state()
+
+    def auth_check(self, sasl, resp1, resp2):
+        """Check the client's AUTH responses, returning 1 for success, or
+        0 or 501 for failure.  This runs in an auth_executor thread."""
+        verify = 0
+        try:
+            if sasl == 'plain':
+                verify = self.verify_plain(resp1)
+            elif sasl == 'cram-md5':
+                verify = self.verify_cram_md5(resp1,
+                                              self.__auth_cram_md5_ticket)
+            elif sasl == 'login':
+                verify = self.verify_login(resp1, resp2)
+        except Exception:
+            logger.exception('Error checking authentication')
+        return verify
 
     def auth_challenge(self):
         if self.__auth_resp1 is None:
@@ -913,21 +1280,11 @@ class SMTPSession(asynchat.async_chat):
             self.push('250-' + r)
         self.push('250 ' + responses[-1])
 
-        # Put a Received header string in the environment for tmda-inject
-        # to add later.
-        rh = []
-        rh.append('from %s' % (arg))
-        pname = self.__peername
-        if (arg.lower() != pname.lower()) and (pname.lower() != self.__peerip):
-            rh.append('(%s [%s])' % (pname, self.__peerip))
-        else:
-            rh.append('(%s)' % (self.__peerip))
-        extra = self.recv_header_extra()
-        if extra:
-            rh.append(extra)
-        rh.append('by %s (tmda-ofmipd) with ESMTP;' % (FQDN))
-        rh.append(Util.make_date())
-        os.environ['TMDA_OFMIPD_RECEIVED'] = ' '.join(rh)
+        # Remember what goes into the Received header; see
+        # received_header().
+        self.__helo = arg
+        self.__helo_date = Util.make_date()
+        self.__helo_extra = self.recv_header_extra()
 
     def smtp_NOOP(self, arg):
         if arg:
@@ -977,7 +1334,6 @@ class SMTPSession(asynchat.async_chat):
         # Resets the sender, recipients, and data, but not the greeting
         self.__mailfrom = None
         self.__rcpttos = []
-        self.__data = ''
         self.__state = self.COMMAND
         self.push('250 Ok')
 
@@ -989,7 +1345,6 @@ class SMTPSession(asynchat.async_chat):
             self.push('501 Syntax: DATA')
             return
         self.__state = self.DATA
-        self.set_terminator(b'\r\n.\r\n')
         self.push('354 End data with <CR><LF>.<CR><LF>')
 
     def smtp_AUTH(self, arg):
@@ -1017,48 +1372,6 @@ class SMTPSession(asynchat.async_chat):
 
 # SSL Support
 
-# SSL-capable socket wrapper class. The more similar this is to Python 2.6
-# SSLSockets, the better.
-class SSLSocket(object):
-    def __init__(self, sock, ssl_context):
-        self._ssl_context = ssl_context
-        self._sock = sock
-        self._ssl_conn = None
-
-    def do_handshake(self):
-        import OpenSSL.SSL as SSL
-
-        if self._ssl_conn is None:
-            self._ssl_conn = SSL.Connection(self._ssl_context, self._sock)
-            self._ssl_conn.set_accept_state()
-
-    def want_write(self):
-        if self._ssl_conn is not None:
-            return self._ssl_conn.want_write()
-        return False
-
-    # Socket methods
-
-    def __getattr__(self, name):
-        if self._ssl_conn is not None:
-            return getattr(self._ssl_conn, name)
-        else:
-            return getattr(self._sock, name)
-
-
-class CallbackProducer(object):
-    """
-    A producer for async_chat that produces no data, but calls a provided
-    function instead.
-    """
-    def __init__(self, function):
-        self._function = function
-
-    def more(self):
-        self._function()
-        return b''
-
-
 class SecureSMTPSession(SMTPSession):
     _start_ssl_values = (
         'immediate',      # An SSL connection
@@ -1068,24 +1381,47 @@ class SecureSMTPSession(SMTPSession):
         'done',           # STARTTLS finished
     )
 
-    def __init__(self, conn, ssl_context, process_msg_func, start_ssl):
-        self._ssl_sock = SSLSocket(conn, ssl_context)
+    # Handshakes done by this process, and how many of them resumed an
+    # earlier session (see --ssl-tickets).
+    handshakes = 0
+    resumed = 0
+
+    def __init__(self, reader, writer, ssl_context, process_msg_func,
+                 start_ssl):
+        self._ssl_context = ssl_context
         if start_ssl not in self._start_ssl_values:
             raise ValueError('invalid start_ssl argument')
         self._ssl_state = start_ssl
 
-        SMTPSession.__init__(self, self._ssl_sock, process_msg_func)
+        SMTPSession.__init__(self, reader, writer, process_msg_func)
 
         if self._ssl_state == 'immediate':
-            self.start_ssl()
+            # Handshake before the greeting.
+            self.push_callback(self.start_ssl)
         elif self._ssl_state == 'localoptional':
             if self._is_loopback(self._localip):
                 self._ssl_state = 'optional'
             else:
                 self._ssl_state = 'required'
 
-    def start_ssl(self):
-        self._ssl_sock.do_handshake()
+    async def start_ssl(self):
+        # Nothing read before the handshake may be taken as having come
+        # over TLS.
+        self.discard_buffered()
+        await self._writer.start_tls(self._ssl_context)
+        ssl_object = self._writer.get_extra_info('ssl_object')
+        SecureSMTPSession.handshakes += 1
+        if ssl_object.session_reused:
+            SecureSMTPSession.resumed += 1
+        logger.debug('TLS handshake for %r: %s, %s, %s session',
+                     self, ssl_object.version(), ssl_object.cipher()[0],
+                     'resumed' if ssl_object.session_reused else 'new')
+        logger.debug('TLS handshakes: %d, resumed: %d (%.0f%%); '
+                     'session cache: %r',
+                     SecureSMTPSession.handshakes, SecureSMTPSession.resumed,
+                     100.0 * SecureSMTPSession.resumed /
+                     SecureSMTPSession.handshakes,
+                     self._ssl_context.session_stats())
 
     # Overrides from SMTPSession
 
@@ -1118,30 +1454,6 @@ class SecureSMTPSession(SMTPSession):
 
         return SMTPSession.valid_command(self, cmd, arg)
 
-    # Overrides from asyncore.dispatcher
-
-    def readable(self):
-        # Reading could be necessary at any time, for SSL protocol negotiation.
-        return True
-
-    def writable(self):
-        return self._ssl_sock.want_write() or SMTPSession.writable(self)
-
-    def handle_error(self):
-        import OpenSSL.SSL as SSL
-
-        e = sys.exc_info()[1]
-        if isinstance(e, (SSL.WantReadError, SSL.WantWriteError)):
-            # These non-errors happen frequently, just indicating that the
-            # underlying SSL layer needs to do reading or writing on the socket
-            # for protocol purposes, blocking general communication in the
-            # interim.
-            pass
-        elif isinstance(e, SSL.Error):
-            self.handle_close(e)
-        else:
-            SMTPSession.handle_error(self)
-
     # SMTP commands
 
     def smtp_STARTTLS(self, arg):
@@ -1154,173 +1466,718 @@ class SecureSMTPSession(SMTPSession):
         if arg:
             self.push('501 Syntax error (no parameters allowed)')
             return
-        # XXX There's a chance that the callbacks could happen before the
-        # response is sent, which would be bad. It looks like this can't
-        # actually happen based on the async_chat implementation. A method
-        # that doesn't rely on implementation details would be better.
+        if self.discard_buffered():
+            # Commands pipelined after STARTTLS would otherwise run
+            # after the handshake, as though they had been sent over
+            # TLS (CVE-2011-0411).
+            self.push('554 No commands may follow STARTTLS')
+            return
+        # The callbacks run once the response has been sent.
         self.push('220 Ready to start TLS')
-        self.push_with_producer(CallbackProducer(self.start_ssl))
-        self.push_with_producer(CallbackProducer(self.init_dynamic_state))
+        self.push_callback(self.start_ssl)
+        self.push_callback(self.init_dynamic_state)
         self._ssl_state = 'done'
 
 
-class SMTPServer(asyncore.dispatcher):
+class SMTPServer(object):
     """Run an SMTP server daemon - accept new socket connections and
     process SMTP sessions on each connection."""
+
+    # Servers which have been created.  Forked children use this to let
+    # go of the listening sockets.
+    servers = []
+
     def __init__(self, localaddr, session_factory, family=socket.AF_INET):
         self._localaddr = localaddr
         self._session_factory = session_factory
-        asyncore.dispatcher.__init__(self)
-        self.create_socket(family, socket.SOCK_STREAM)
+        # Bind right away, so that this can be done before switching
+        # user and daemonizing; the event loop comes later.
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
         # try to re-use a server port if possible
-        self.set_reuse_addr()
-        self.bind(localaddr)
-        self.listen(5)
-        logger.info('Listening on %s:%d', *localaddr)
-
-    def readable(self):
-        if len(asyncore.socket_map) > opts.connections:
-            # too many simultaneous connections
-            return 0
-        else:
-            return 1
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(localaddr)
+        self.socket.listen(socket.SOMAXCONN)
+        SMTPServer.servers.append(self)
+        logger.info('Listening on %s:%d', *localaddr[:2])
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_accept,
+                                            sock=self.socket)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_accept(self, reader, writer):
+        # If there are already opts.connections active sessions, wait for
+        # one to finish.  The client doesn't get a greeting until then.
+        async with session_slots:
+            try:
+                sess = self._session_factory(reader, writer)
+            except:
+                # Default handle_error terminates the server. Let's not do
+                # that.
+                logger.warning('Error in SMTPServer:', exc_info=True)
+                writer.close()
+                return
+            await sess.run()
 
-    def handle_accept(self):
-        conn = self.accept()[0]
-        sess = self._session_factory(conn)
-        # Make sure the session handles its own errors.
+
+class InjectForker(object):
+    """A helper process which forks InjectWorkers on request.
+
+    Forking a multi-threaded process is unsafe: the child only has the
+    thread which forked, and any lock another thread held at the time
+    (e.g, in logging or the memory allocator) stays locked forever.  So
+    the workers are forked by this process instead, which is itself
+    forked before the server starts any threads, and which never starts
+    any.  It exits once the server closes its end of the connection."""
+
+    def __init__(self):
+        parent, child = socket.socketpair(socket.AF_UNIX,
+                                          socket.SOCK_SEQPACKET)
+        self.pid = os.fork()
+        if self.pid == 0:
+            parent.close()
+            status = 0
+            try:
+                self._serve(child)
+            except:
+                logger.exception('Error in tmda-inject forker')
+                status = -1
+            os._exit(status)
+        child.close()
+        self._sock = parent
+
+    def _serve(self, sock):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Let the kernel reap the workers.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        release_sockets()
+        while True:
+            (request, fds, flags, addr) = socket.recv_fds(sock, 65536, 1)
+            if not request:
+                return
+            conn = socket.socket(fileno=fds[0])
+            (setup, argv, timeout) = pickle.loads(request)
+            if os.fork() == 0:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                sock.close()
+                status = 0
+                try:
+                    InjectWorker.serve(conn, setup, argv, timeout)
+                except:
+                    logger.exception('Error in tmda-inject worker')
+                    status = -1
+                os._exit(status)
+            conn.close()
+
+    def start(self, sock, setup, argv, timeout):
+        """Start a worker which serves requests on sock, a connected
+        socket.  setup must be picklable, so it can't be a lambda or a
+        nested function.  This may be called from several threads at
+        once; each request is a single datagram."""
+        socket.send_fds(self._sock, [pickle.dumps((setup, argv, timeout))],
+                        [sock.fileno()])
+
+    def close(self):
+        self._sock.close()
         try:
-            sess.start()
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class InjectWorker(object):
+    """A pre-forked process which runs tmda-inject in-process on behalf
+    of a single user.
+
+    The child does the per-user setup once (switching UID, setting $HOME,
+    and importing TMDA.inject, which reads the user's configuration), and
+    then serves messages sent to it over a socketpair until the parent
+    closes its end or it has been idle for more than timeout seconds.
+    It is forked by forker, an InjectForker."""
+
+    def __init__(self, forker, setup, argv, timeout=None):
+        self.messages = 0
+        self.lastused = time.time()
+        parent, child = socket.socketpair()
+        try:
+            forker.start(child, setup, argv, timeout)
         except:
-            sess.handle_error()
+            parent.close()
+            raise
+        finally:
+            child.close()
+        self._sock = parent
+        self._file = parent.makefile('rwb')
 
-    def handle_error(self):
-        # Default handle_error terminates the server. Let's not do that.
-        logger.warning('Error in SMTPServer:', exc_info=True)
+    @staticmethod
+    def serve(sock, setup, argv, timeout):
+        """The worker's side: run setup, then serve messages on sock."""
+        sendmail_cmd = setup()
+        if sendmail_cmd is None:
+            # TMDA.inject processes sys.argv when it is imported, which is
+            # also when the user's configuration file gets read.
+            sys.argv = argv
+            from . import inject
+        sock.settimeout(timeout)
+        f = sock.makefile('rwb')
+        while True:
+            # Each request starts with a byte carrying the descriptor of
+            # the message's spool file, if it has one.
+            try:
+                (marker, fds, flags, addr) = socket.recv_fds(sock, 1, 1)
+                if not marker:
+                    return
+                (environ, mailfrom, rcpttos, data) = pickle.load(f)
+            except (EOFError, socket.timeout):
+                return
+            if fds:
+                data = os.fdopen(fds[0], 'rb')
+            else:
+                data = io.BytesIO(data)
+            os.environ.update(environ)
+            try:
+                if sendmail_cmd is None:
+                    inject.tag_and_send(data.read(), rcpttos)
+                else:
+                    Util.runcmd_checked(sendmail_cmd +
+                                        ['-f', mailfrom, '-i', '--'] + rcpttos,
+                                        data)
+                error = None
+            except SystemExit as e:
+                error = e.code or None
+            except Exception as e:
+                logger.exception('Error running injection command')
+                error = repr(e)
+            data.close()
+            pickle.dump(error, f)
+            f.flush()
+
+    def alive(self):
+        # An idle worker never sends anything, so if the connection is
+        # readable, the worker has closed its end.
+        try:
+            return not select.select([self._sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def inject(self, environ, mailfrom, rcpttos, data):
+        """Hand a message (a binary file, positioned at the start) to the
+        worker and wait for the result.  A message spooled to disk is
+        passed as a file descriptor rather than copied."""
+        try:
+            fds = [data.fileno()]
+            data = None
+        except io.UnsupportedOperation:
+            fds = []
+            data = data.read()
+        try:
+            socket.send_fds(self._sock, [b'M'], fds)
+            pickle.dump((environ, mailfrom, rcpttos, data), self._file)
+            self._file.flush()
+            error = pickle.load(self._file)
+        except (EOFError, socket.error):
+            error = 'worker exited'
+        self.messages += 1
+        self.lastused = time.time()
+        if error is not None:
+            raise IOError('tmda-inject failed: %s' % (error,))
+
+    def close(self):
+        """Close the connection; the worker exits when it notices."""
+        self._file.close()
+        self._sock.close()
+
+
+class InjectPool(object):
+    """Idle InjectWorkers, keyed by authenticated user.
+
+    A worker is recycled after it has processed maxmessages messages, or
+    after it has been idle for maxidle seconds.  The latter is also the
+    longest it takes for changes to a user's TMDA configuration to be
+    noticed.
+
+    The pool may be used from several threads at once."""
+
+    def __init__(self, maxmessages, maxidle):
+        self.maxmessages = maxmessages
+        self.maxidle = maxidle
+        self._idle = {}
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._forker = None
+
+    def start(self):
+        """Start the process which forks the workers.  This must be
+        called before the process starts any threads (see
+        InjectForker)."""
+        self._forker = InjectForker()
+
+    def _retire(self, worker):
+        self._workers.discard(worker)
+        worker.close()
+
+    def _expire(self):
+        now = time.time()
+        for key, workers in list(self._idle.items()):
+            for worker in workers[:]:
+                if now - worker.lastused >= self.maxidle or not worker.alive():
+                    workers.remove(worker)
+                    self._retire(worker)
+            if not workers:
+                del self._idle[key]
+
+    def inject(self, key, setup, argv, environ, mailfrom, rcpttos, data):
+        """Inject a message using one of key's workers, starting a new
+        one with setup and argv if none is idle.  setup is called in the
+        worker, and must be picklable (see InjectForker.start); it returns None to run tmda-inject, or a sendmail command
+        (a list) to pass the message through unaltered.  environ is
+        added to the worker's environment for this message."""
+        with self._lock:
+            self._expire()
+            workers = self._idle.get(key)
+            if workers:
+                worker = workers.pop()
+            else:
+                # The pool retires idle workers itself; the worker's own
+                # timeout only matters if no more messages arrive to
+                # trigger that, so give it some slack.
+                worker = InjectWorker(self._forker, setup, argv,
+                                      self.maxidle + 60)
+                self._workers.add(worker)
+        try:
+            worker.inject(environ, mailfrom, rcpttos, data)
+        except:
+            with self._lock:
+                self._retire(worker)
+            raise
+        with self._lock:
+            if worker.messages >= self.maxmessages:
+                self._retire(worker)
+            else:
+                self._idle.setdefault(key, []).append(worker)
+
+    def close(self):
+        with self._lock:
+            for worker in self._workers:
+                worker.close()
+            self._workers.clear()
+            self._idle.clear()
+            if self._forker:
+                self._forker.close()
+                self._forker = None
+
+
+class HostnameCache(object):
+    """Reverse DNS lookups of client addresses.  They are run in the
+    event loop's default executor, so that a slow or broken resolver
+    only holds up the sessions waiting for that name.  Each result
+    (the address itself if it has no name) is kept for ttl seconds,
+    and sessions looking up the same address share a single query."""
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._entries = {}
+        self._next_sweep = 0
+
+    def lookup(self, ip):
+        """Return an asyncio future for the host name of ip.  This must
+        be called from the event loop."""
+        now = time.time()
+        if now >= self._next_sweep:
+            for key, (expires, future) in list(self._entries.items()):
+                if expires <= now:
+                    del self._entries[key]
+            self._next_sweep = now + self._ttl
+        entry = self._entries.get(ip)
+        if entry and entry[0] > now:
+            return entry[1]
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, socket.getfqdn, ip)
+        self._entries[ip] = (now + self._ttl, future)
+        return future
+
+
+class RateLimiter(object):
+    """Per-user limits on the number of messages and bytes sent.  Each is
+    a token bucket holding up to the limit, which refills at the rate of
+    the limit per period seconds; a limit of 0 means no limit.
+
+    The buckets are kept in an SQLite database, so the limits hold across
+    all tmda-ofmipd processes using the same file.  It may be used from
+    several threads at once."""
+
+    def __init__(self, filename, messages, nbytes, period):
+        self.filename = filename
+        self.messages = messages
+        self.bytes = nbytes
+        self.period = period
+        self._conn = None
+        self._pid = None
+        self._next_purge = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # A forked child can't use its parent's connection.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'username TEXT PRIMARY KEY, '
+                         'messages REAL NOT NULL, '
+                         'bytes REAL NOT NULL, '
+                         'updated REAL NOT NULL)')
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _refill(self, tokens, limit, elapsed):
+        if not limit:
+            return 0
+        return min(limit, tokens + elapsed * limit / self.period)
+
+    def allow(self, username, size):
+        """Take a message of size bytes from username's allowance and
+        return True, or return False if that would exceed it."""
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT messages, bytes, updated '
+                                   'FROM buckets WHERE username = ?',
+                                   (username,)).fetchone()
+                if row is None:
+                    (messages, nbytes) = (self.messages, self.bytes)
+                else:
+                    elapsed = max(0, now - row[2])
+                    messages = self._refill(row[0], self.messages, elapsed)
+                    nbytes = self._refill(row[1], self.bytes, elapsed)
+                allowed = ((not self.messages or messages >= 1) and
+                           (not self.bytes or nbytes >= size))
+                if allowed:
+                    messages -= 1
+                    nbytes -= size
+                conn.execute('INSERT OR REPLACE INTO buckets '
+                             'VALUES (?, ?, ?, ?)',
+                             (username, messages, nbytes, now))
+                if now >= self._next_purge:
+                    # A bucket untouched for a whole period is full, the
+                    # same as having no row at all.
+                    conn.execute('DELETE FROM buckets WHERE updated < ?',
+                                 (now - self.period,))
+                    self._next_purge = now + self.period
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        return allowed
 
 
 # Utility functions
 
+def file_version(filename):
+    """Return a value which changes whenever filename is modified or
+    replaced."""
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def spool_to_disk(spool):
+    """Move the contents of the in-memory spool (a BytesIO) to a new
+    temporary file, and return that, positioned at the end."""
+    f = tempfile.TemporaryFile(dir=opts.spool_dir)
+    f.write(spool.getbuffer())
+    spool.close()
+    return f
+
+
 def b64_encode(s):
     """base64 encoding without the trailing newline."""
-    return base64.encodestring(bytes(s, 'ascii'))[:-1]
+    return base64.encodebytes(bytes(s, 'ascii'))[:-1]
 
 
 def b64_decode(s):
     """base64 decoding."""
-    return base64.decodestring(bytes(s, 'ascii'))
+    return base64.decodebytes(bytes(s, 'ascii'))
 
 
-def process_message_fail(peer, mailfrom, rcpttos, data, auth_username):
+def process_message_fail(peer, mailfrom, rcpttos, data, auth_username,
+                         environ):
     """Debug class which prevents the mail from actually being accepted."""
     raise "Test Exception"
 
 
-def process_message_vdomain(peer, mailfrom, rcpttos, data, auth_username):
+# The directory TMDA is imported from.
+tmda_libdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def runas_cmd(username):
+    """Return the command prefix which runs a command as username, for
+    use when running as root.  See TMDA.runas.  Run it with an
+    environment from runas_environ()."""
+    # The helper starts with a real UID of 0, so Python runs isolated
+    # (-I): neither the working directory nor PYTHON* variables can
+    # put modules ahead of this copy of TMDA.
+    code = ('import sys; sys.path.insert(0, %r); '
+            'from TMDA import runas; runas.main()' % tmda_libdir)
+    return [sys.executable, '-I', '-c', code, username]
+
+
+def runas_environ(environ, **extra):
+    """Return the environment for a command run through runas_cmd():
+    the session's environ and extra, with only enough of the server's
+    own environment to find programs and TMDA."""
+    env = {'PATH': os.environ.get('PATH', os.defpath),
+           'PYTHONPATH': tmda_libdir}
+    env.update(extra)
+    env.update(environ)
+    return env
+
+
+def pure_proxy_cmd(cfgfile, mailfrom=None, rcpttos=()):
+    """Return the sendmail command line to pass a message through
+    unaltered if --pure-proxy was specified and the TMDA config file is
+    missing, otherwise None."""
+    if opts.pure_proxy and not os.path.exists(cfgfile):
+        cmd = os.environ.get('TMDA_SENDMAIL_PROGRAM') or '/usr/sbin/sendmail'
+        if mailfrom is None:
+            return [cmd]
+        return [cmd, '-f', mailfrom, '-i', '--'] + rcpttos
+    return None
+
+
+def vdomain_user(auth_username):
+    """Return the system user in charge of auth_username's virtual
+    domain.  This is for VMailMgr, where each virtual domain is a system
+    (/etc/passwd) user."""
+    # The 'prepend' is the system user in charge of this virtual domain.
+    prepend = Util.getvdomainprepend(auth_username, opts.vdomainspath)
+    if not prepend:
+        domain = auth_username.split('@', 1)[-1]
+        logger.error('Error: "%s" is not a virtual domain', domain)
+        raise IOError('"%s" is not a virtual domain' % domain)
+    return prepend
+
+
+def setup_vdomain_user(auth_username, environ, runas=()):
+    """Point $HOME in environ at auth_username's virtual user home
+    directory and return the path to their TMDA config file.  environ
+    is also the environment the vhome script is run with, using the
+    command prefix runas if given (see runas_cmd)."""
+    user, domain = (auth_username.split('@', 1) + [''])[:2]
+    vhomedir = Util.getvuserhomedir(user, domain, opts.vhomescript, environ,
+                                    runas)
+    logger.info('vuser homedir: "%s"', vhomedir)
+    # This is so "~" will work in the .tmda/* files.
+    environ['HOME'] = vhomedir
+    return os.path.join(vhomedir, '.tmda', 'config')
+
+
+def setup_vdomain_worker(auth_username, environ):
+    """InjectPool setup for a virtual domain user."""
+    # The worker is a process of its own, so this is the place for the
+    # session's environment.
+    os.environ.update(environ)
+    if running_as_root:
+        prepend = vdomain_user(auth_username)
+        Util.switch_user(prepend)
+        # For VMailMgr's utilities.
+        os.environ['HOME'] = Util.gethomedir(prepend)
+    return pure_proxy_cmd(setup_vdomain_user(auth_username, os.environ))
+
+
+def process_message_vdomain(peer, mailfrom, rcpttos, data, auth_username,
+                            environ):
     """This proxy is used only for virtual domain support in a qmail +
     (VPopMail or VMailMgr) environment.  It needs to behave differently from
     the standard TMDA proxy in that authenticated users are not system
     (/etc/passwd) users."""
-    # Set up partial tmda-inject command line.
-    inject_cmd = [sys.executable, '-m', 'TMDA.inject'] + rcpttos
-    userinfo = auth_username.split('@', 1) + ['']
-    user, domain = userinfo[:2]
-    # If running as uid 0, fork in preparation for running the tmda-inject
-    # process and change UID and GID to the virtual domain user.  This is
-    # for VMailMgr, where each virtual domain is a system (/etc/passwd)
-    # user.
-    if running_as_root:
-        pid = os.fork()
-        if pid != 0:
-            rpid, status = os.wait()
-            # Did tmda-inject succeed?
-            if status != 0:
-                raise IOError('tmda-inject failed!')
-            return
-        else:
-            # The 'prepend' is the system user in charge of this virtual
-            # domain.
-            prepend = Util.getvdomainprepend(auth_username,
-                                             opts.vdomainspath)
-            if not prepend:
-                logger.error('Error: "%s" is not a virtual domain', domain)
-                sys.exit(-1)
-            os.seteuid(0)
-            os.setgid(Util.getgid(prepend))
-            os.setgroups(Util.getgrouplist(prepend))
-            os.setuid(Util.getuid(prepend))
-            # For VMailMgr's utilities.
-            os.environ['HOME'] = Util.gethomedir(prepend)
-    # From here on, we're either in the child (pid == 0) or we're not
-    # running as root, so we haven't forked.
-    vhomedir = Util.getvuserhomedir(user, domain, opts.vhomescript)
-    logger.info('vuser homedir: "%s"', vhomedir)
-    # This is so "~" will work in the .tmda/* files.
-    os.environ['HOME'] = vhomedir
-    # change inject_cmd to pass the message through if
-    # --pure-proxy was specified and the .tmda/config file is
-    # missing.
-    cfgfile = os.path.join(vhomedir, '.tmda', 'config')
-    if opts.pure_proxy and not os.path.exists(cfgfile):
-        cmd = os.environ.get('TMDA_SENDMAIL_PROGRAM') or '/usr/sbin/sendmail'
-        inject_cmd = [cmd, '-f', mailfrom, '-i', '--'] + rcpttos
-    try:
-        Util.runcmd_checked(inject_cmd, data)
-    except Exception:
-        logger.exception('Error running injection command')
+    if inject_pool:
+        setup = functools.partial(setup_vdomain_worker, auth_username,
+                                  environ)
+        inject_pool.inject(auth_username, setup, [program], environ,
+                           mailfrom, rcpttos, data)
+        return
+
+    def inject():
+        # If running as uid 0, run the vhome script and tmda-inject as
+        # the virtual domain user.
+        runas = []
         if running_as_root:
-            sys.exit(-1)
+            prepend = vdomain_user(auth_username)
+            runas = runas_cmd(prepend)
+            # HOME is for VMailMgr's utilities.
+            env = runas_environ(environ, HOME=Util.gethomedir(prepend))
+        else:
+            env = dict(os.environ, **environ)
+        cfgfile = setup_vdomain_user(auth_username, env, runas)
+        # Pass the message through if --pure-proxy was specified and the
+        # .tmda/config file is missing.
+        inject_cmd = (pure_proxy_cmd(cfgfile, mailfrom, rcpttos) or
+                      [sys.executable, '-m', 'TMDA.inject'] + rcpttos)
+        Util.runcmd_checked(runas + inject_cmd, data, env=env)
+
     if running_as_root:
-        # Should never get here!
-        sys.exit(0)
+        inject()
+    else:
+        try:
+            inject()
+        except Exception:
+            logger.exception('Error running injection command')
 
 
-def process_message_sysuser(peer, mailfrom, rcpttos, data, auth_username):
+def setup_sysuser_worker(auth_username, homedir, cfgfile):
+    """InjectPool setup for a system user."""
+    os.environ['HOME'] = homedir
+    if running_as_root:
+        Util.switch_user(auth_username)
+    return pure_proxy_cmd(cfgfile)
+
+
+def process_message_sysuser(peer, mailfrom, rcpttos, data, auth_username,
+                            environ):
     """Using this server for outgoing smtpd, the authenticated user
     will have his mail tagged using his TMDA config file."""
     configdir = opts.configdir or '~' + auth_username
     tmda_configdir = os.path.join(os.path.expanduser(configdir), '.tmda')
     tmda_configfile = os.path.join(tmda_configdir, 'config')
-    if opts.pure_proxy and not os.path.exists(tmda_configfile):
-        cmd = os.environ.get('TMDA_SENDMAIL_PROGRAM') or '/usr/sbin/sendmail'
-        inject_cmd = [cmd, '-f', mailfrom, '-i', '--'] + rcpttos
-    else:
+    # gethomedir() is no good in unit tests.
+    homedir = os.environ.get('TMDA_TEST_HOME') or Util.gethomedir(auth_username)
+
+    if inject_pool:
+        setup = functools.partial(setup_sysuser_worker, auth_username,
+                                  homedir, tmda_configfile)
+        inject_pool.inject(auth_username, setup,
+                           [program, '-c', tmda_configfile], environ,
+                           mailfrom, rcpttos, data)
+        return
+
+    inject_cmd = pure_proxy_cmd(tmda_configfile, mailfrom, rcpttos)
+    if inject_cmd is None:
         inject_cmd = [sys.executable, '-m', 'TMDA.inject']
         inject_cmd += ['-c', tmda_configfile] + rcpttos
 
     # Set HOME so "~" will always work in the .tmda/* files.
-    # gethomedir() is no good in unit tests.
-    os.environ['HOME'] = os.environ.get('TMDA_TEST_HOME', Util.gethomedir(auth_username))
-
-    # If running as uid 0, fork the tmda-inject process, and
-    # then change UID and GID to the authenticated user.
+    # If running as uid 0, run tmda-inject as the authenticated user.
     if running_as_root:
-        pid = os.fork()
-        if pid == 0:
-            os.seteuid(0)
-            os.setgid(Util.getgid(auth_username))
-            os.setgroups(Util.getgrouplist(auth_username))
-            os.setuid(Util.getuid(auth_username))
-            try:
-                Util.runcmd_checked(inject_cmd, data)
-            except Exception:
-                logger.exception('Error running injection command')
-                sys.exit(-1)
-            sys.exit(0)
-        else:
-            rpid, status = os.wait()
-            # Did tmda-inject succeed?
-            if status != 0:
-                raise IOError('tmda-inject failed!')
+        inject_cmd = runas_cmd(auth_username) + inject_cmd
+        env = runas_environ(environ, HOME=homedir)
     else:
-        # no need to fork
-        Util.runcmd_checked(inject_cmd, data)
-
-
-def create_smtp_session_from_stdin(session_factory):
+        env = dict(os.environ, HOME=homedir, **environ)
+    Util.runcmd_checked(inject_cmd, data, env=env)
+
+
+def release_sockets():
+    """Let go of the listening sockets and client connections inherited
+    from the server, e.g, so that a client isn't kept waiting for the
+    connection to close after QUIT.  The descriptors are pointed at
+    /dev/null rather than closed, as the event loop still refers to
+    them."""
+    socks = [server.socket for server in SMTPServer.servers]
+    socks += [sess._writer.get_extra_info('socket')
+              for sess in SMTPSession.sessions]
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for sock in socks:
+        if sock is not None and sock.fileno() >= 0:
+            os.dup2(devnull, sock.fileno())
+    os.close(devnull)
+
+
+async def create_smtp_session_from_stdin(session_factory):
     conn = socket.fromfd(0, socket.AF_INET, socket.SOCK_STREAM)
-    sess = session_factory(conn)
-    sess.start()
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+
+    async def connected(reader, writer):
+        try:
+            await session_factory(reader, writer).run()
+        finally:
+            finished.set_result(None)
+
+    # Like asyncio.start_server() does for accepted connections, so that
+    # the session sees the same server-side streams.
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader, connected)
+    await loop.connect_accepted_socket(lambda: protocol, conn)
+    await finished
+
+
+async def run_servers():
+    global session_slots
+    session_slots = asyncio.Semaphore(opts.connections)
+    await asyncio.gather(*[server.serve() for server in SMTPServer.servers])
+
+
+def start_worker():
+    """Fork a worker process which serves connections on the listening
+    sockets, and return its PID."""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            if inject_pool:
+                inject_pool.start()
+            asyncio.run(run_servers())
+        except KeyboardInterrupt:
+            pass
+        except:
+            logger.exception('Error in worker process')
+            status = 1
+        finally:
+            if inject_pool:
+                inject_pool.close()
+        os._exit(status)
+    return pid
+
+
+def supervise_workers(count):
+    """Run count worker processes, all accepting connections on the same
+    listening sockets, and start a new one whenever one exits.  They log
+    to the supervisor's output, each line tagged with the PID."""
+    for handler in logger.handlers:
+        handler.setFormatter(logging.Formatter('[%(process)d] %(message)s'))
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    # The rate limits have to be shared between the workers.
+    tmpdir = None
+    if rate_limiter and not opts.rate_limit_db:
+        tmpdir = tempfile.mkdtemp(prefix='tmda-ofmipd-')
+        rate_limiter.filename = os.path.join(tmpdir, 'ratelimit.db')
+
+    workers = {}
+    try:
+        for i in range(count):
+            workers[start_worker()] = time.time()
+        logger.info('Started %d workers', count)
+        while True:
+            (pid, status) = os.wait()
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            logger.warning('Worker %d exited with status %d; restarting it',
+                           pid, os.waitstatus_to_exitcode(status))
+            # Don't fork in a tight loop if workers fail straight away.
+            if time.time() - started < 1:
+                time.sleep(1)
+            workers[start_worker()] = time.time()
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def sig_handler(sig_num, frame):
@@ -1339,8 +2196,6 @@ defaultauthports = {'imap': 143,
                     # 'pop3s': 995,
                     }
 
-NEWLINE = '\n'
-
 
 # Runtime global variables
 
@@ -1437,6 +2292,14 @@ congroup.add_option("-C", "--connections",
 active connections, defer acceptance of new connections until one
 finishes. NUM must be a positive integer. Default: 20""")
 
+congroup.add_option("-w", "--workers",
+                    type="int", default=1, metavar="NUM", dest="workers",
+                    help= \
+"""Accept connections in NUM worker processes, to make use of several
+CPUs.  The main process only starts the workers, and starts a new one
+whenever one exits.  --connections applies to each worker separately.
+Default: 1 (accept connections in the main process)""")
+
 congroup.add_option("-1", "--one-session",
                     action="store_true", default=False, dest="one_session",
                     help= \
@@ -1462,6 +2325,106 @@ sends.  The script is passed a login name whenever a user tries to
 send mail.  If the script returns a 0, the message is allowed.  For
 any other value, the message is rejected.""")
 
+congroup.add_option("--rate-limit-messages",
+                    type="int", default=0, metavar="NUM",
+                    dest="rate_limit_messages",
+                    help= \
+"""Let each user send at most NUM messages per --rate-limit-period;
+any more are rejected with a temporary error (450) until the user's
+allowance has built up again.  Default: 0 (no limit)""")
+
+congroup.add_option("--rate-limit-bytes",
+                    type="int", default=0, metavar="BYTES",
+                    dest="rate_limit_bytes",
+                    help= \
+"""Let each user send at most BYTES bytes of messages per
+--rate-limit-period, like --rate-limit-messages.  A message larger than
+BYTES is rejected outright (552).  Default: 0 (no limit)""")
+
+congroup.add_option("--rate-limit-period",
+                    type="int", default=3600, metavar="SECONDS",
+                    dest="rate_limit_period",
+                    help= \
+"""The period of --rate-limit-messages and --rate-limit-bytes.  A user's
+allowance is restored gradually over this time, rather than all at once
+at the end of it.  Default: 3600""")
+
+congroup.add_option("--rate-limit-db",
+                    metavar="FILE", dest="rate_limit_db",
+                    help= \
+"""Keep the users' rate limit allowances in the SQLite database FILE,
+which is created if necessary.  Other tmda-ofmipd processes using the
+same FILE share the allowances.  The file must be writable by the user
+tmda-ofmipd runs as (see --username).  The default is to keep them in
+memory, for this process only.""")
+
+congroup.add_option("--message-threads",
+                    type="int", default=4, metavar="NUM",
+                    dest="message_threads",
+                    help= \
+"""Process up to NUM received messages (running the throttle script and
+injecting them) at the same time, in background threads, so that one
+slow message doesn't hold up the other connections. Default: 4""")
+
+congroup.add_option("--spool-size",
+                    type="int", default=1048576, metavar="BYTES",
+                    dest="spool_size",
+                    help= \
+"""Keep up to BYTES bytes of each incoming message in memory; larger
+messages are written to a temporary file. Default: 1048576""")
+
+congroup.add_option("--spool-dir",
+                    metavar="DIR", dest="spool_dir",
+                    help= \
+"""Create the temporary files for large incoming messages (see
+--spool-size) in DIR. The default is the system's temporary directory
+(e.g, $TMPDIR or /tmp).""")
+
+congroup.add_option("--no-reverse-dns",
+                    action="store_false", default=True, dest="reverse_dns",
+                    help= \
+"""Don't look up the host names of connecting clients; the Received
+header added to outgoing messages shows only the client's IP address.
+This option might be useful if reverse DNS lookups are slow.""")
+
+congroup.add_option("--reverse-dns-ttl",
+                    type="int", default=3600, metavar="SECONDS",
+                    dest="reverse_dns_ttl",
+                    help= \
+"""Remember the host name looked up for a client address for SECONDS
+seconds. Default: 3600""")
+
+congroup.add_option("--reverse-dns-timeout",
+                    type="float", default=5, metavar="SECONDS",
+                    dest="reverse_dns_timeout",
+                    help= \
+"""Stop waiting for a client's host name once a message has been
+received after SECONDS seconds, and leave the name out of the Received
+header. Default: 5""")
+
+congroup.add_option("--inject-pool",
+                    action="store_true", default=False, dest="inject_pool",
+                    help= \
+"""Inject messages using a pool of pre-forked worker processes, one or
+more per authenticated user, rather than starting a new tmda-inject
+process for every message.  Each worker reads the user's TMDA
+configuration once, so changes to it take effect only once the worker
+has been recycled (see --inject-max-messages and --inject-max-idle).""")
+
+congroup.add_option("--inject-max-messages",
+                    type="int", default=100, metavar="NUM",
+                    dest="inject_max_messages",
+                    help= \
+"""Recycle an injection worker after it has processed NUM messages.
+Only used with --inject-pool.  Default: 100""")
+
+congroup.add_option("--inject-max-idle",
+                    type="int", default=300, metavar="SECONDS",
+                    dest="inject_max_idle",
+                    help= \
+"""Recycle an injection worker after it has been idle for SECONDS
+seconds.  Only used with --inject-pool.  Default: 300""")
+
 congroup.add_option("--ssl",
                     action="store_true", default=False, dest="ssl",
                     help= \
@@ -1518,6 +2481,16 @@ are given in the OpenSSL manual page ciphers(1). The default is %default. Using
 !SSLv2 somewhere in the string is recommended to disable SSL2, which is a
 deprecated and insecure protocol.""")
 
+congroup.add_option("--ssl-tickets",
+                    type="int", default=2, metavar="NUM", dest="ssl_tickets",
+                    help= \
+"""Issue NUM TLS 1.3 session tickets after each full handshake, which
+let a client that reconnects resume its session with a much cheaper
+handshake. The worker processes of --workers accept each other's
+tickets. Use 0 to turn session tickets off altogether (for TLS 1.2 too);
+then only TLS 1.2 clients can resume, and only with the process which
+did the full handshake, from its session cache. Default: 2""")
+
 # authentication
 authgroup = OptionGroup(parser, "Authentication",
 """Any number of authentication options can be supplied, and they will be
@@ -1573,6 +2546,40 @@ authgroup.add_option("-m", "--pamauth",
 the Python PAM module. The argument is the name of a PAM service, commonly
 "login".""")
 
+authgroup.add_option("--auth-cache-ttl",
+                     type="int", default=0, metavar="SECONDS",
+                     dest="auth_cache_ttl",
+                     help= \
+"""Remember a successful authentication for SECONDS seconds, and accept
+the same username and password (from a client connected to the same
+local address) again during that time without checking them. This
+avoids e.g, a login to the remote server of -R for each connection from
+a client which reconnects frequently. Only a salted hash of the
+credentials is kept in memory. Default: 0 (don't remember)""")
+
+authgroup.add_option("--auth-threads",
+                     type="int", default=4, metavar="NUM",
+                     dest="auth_threads",
+                     help= \
+"""Check up to NUM authentication attempts at the same time, in
+background threads, so that a slow authentication method doesn't hold
+up the other connections. Default: 4""")
+
+authgroup.add_option("--remote-auth-timeout",
+                     type="float", default=30, metavar="SECONDS",
+                     dest="remote_auth_timeout",
+                     help= \
+"""Give up on a remote authentication server (see -R) that hasn't
+responded after SECONDS seconds. Default: 30""")
+
+authgroup.add_option("--remote-auth-pool",
+                     type="int", default=2, metavar="NUM",
+                     dest="remote_auth_pool",
+                     help= \
+"""Keep up to NUM idle connections to each remote authentication server
+for reuse. This only applies to LDAP; IMAP and POP3 connections can't
+be reused after a login. Default: 2""")
+
 # virtual domains
 virtgroup = OptionGroup(parser, "Virtual Domains")
 
@@ -1612,6 +2619,13 @@ def handle_opts():
     global _authenticator
     global ipauthmapfile
     global ssl_context
+    global inject_pool
+    global message_executor
+    global auth_executor
+    global hostname_cache
+    global rate_limiter
+    global remote_auth_timeout
+    global remote_auth_pool_size
 
     (opts, args) = parser.parse_args()
 
@@ -1620,15 +2634,60 @@ def handle_opts():
         sys.exit()
     if opts.vhomescript and opts.configdir:
         parser.error("options '--vhome-script' and '--configdir' are incompatible!")
+    if opts.workers < 1:
+        parser.error('--workers must be a positive integer')
+    if opts.workers > 1 and opts.one_session:
+        parser.error("options '--workers' and '--one-session' are incompatible!")
     if opts.log:
         logger.setLevel(logging.INFO)
     if opts.debug:
         logger.setLevel(logging.DEBUG)
 
-    _authenticator = auth_options.authenticator()
+    _authenticator = auth_options.cached_authenticator(opts.auth_cache_ttl)
     if _authenticator is None:
         parser.error('missing authentication option(s)')
 
+    if opts.auth_threads < 1:
+        parser.error('--auth-threads must be a positive integer')
+    auth_executor = concurrent.futures.ThreadPoolExecutor(opts.auth_threads)
+    if opts.remote_auth_timeout <= 0 or opts.remote_auth_pool < 0:
+        parser.error('--remote-auth-timeout must be positive and '
+                     '--remote-auth-pool must not be negative')
+    remote_auth_timeout = opts.remote_auth_timeout
+    remote_auth_pool_size = opts.remote_auth_pool
+
+    if opts.message_threads < 1:
+        parser.error('--message-threads must be a positive integer')
+    message_executor = concurrent.futures.ThreadPoolExecutor(
+        opts.message_threads)
+
+    if opts.rate_limit_messages or opts.rate_limit_bytes:
+        if (opts.rate_limit_messages < 0 or opts.rate_limit_bytes < 0
+            or opts.rate_limit_period < 1):
+            parser.error('--rate-limit-messages and --rate-limit-bytes must '
+                         'not be negative, and --rate-limit-period must be '
+                         'a positive integer')
+        rate_limiter = RateLimiter(opts.rate_limit_db or ':memory:',
+                                   opts.rate_limit_messages,
+                                   opts.rate_limit_bytes,
+                                   opts.rate_limit_period)
+
+    if opts.spool_size < 0:
+        parser.error('--spool-size must not be negative')
+
+    if opts.reverse_dns:
+        if opts.reverse_dns_ttl < 0 or opts.reverse_dns_timeout < 0:
+            parser.error('--reverse-dns-ttl and --reverse-dns-timeout '
+                         'must not be negative')
+        hostname_cache = HostnameCache(opts.reverse_dns_ttl)
+
+    if opts.inject_pool:
+        if opts.inject_max_messages < 1 or opts.inject_max_idle < 1:
+            parser.error('--inject-max-messages and --inject-max-idle '
+                         'must be positive integers')
+        inject_pool = InjectPool(opts.inject_max_messages,
+                                 opts.inject_max_idle)
+
     if running_as_root:
         if not opts.username:
             opts.username = 'tofmipd'
@@ -1641,19 +2700,20 @@ def handle_opts():
         if opts.ssl and opts.tls:
             raise ValueError("Can't do SSL and TLS at the same time")
 
-        try:
-            import OpenSSL.SSL as SSL
-        except ImportError:
-            raise ImportError('Python OpenSSL '
-                '(http://pyopenssl.sourceforge.net/) required.')
-
         if not (opts.ssl_cert and opts.ssl_key):
             raise ValueError('--ssl-cert and --ssl-key are required when using --ssl or --tls')
 
-        ssl_context = SSL.Context(SSL.SSLv23_METHOD)
-        ssl_context.set_cipher_list(opts.ciphers)
-        ssl_context.use_certificate_chain_file(os.path.expanduser(opts.ssl_cert))
-        ssl_context.use_privatekey_file(os.path.expanduser(opts.ssl_key))
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.set_ciphers(opts.ciphers)
+        ssl_context.load_cert_chain(os.path.expanduser(opts.ssl_cert),
+                                    os.path.expanduser(opts.ssl_key))
+        # The context is created before the --workers are forked, so they
+        # all share the key which protects the session tickets.
+        if opts.ssl_tickets < 0:
+            parser.error('--ssl-tickets must not be negative')
+        ssl_context.num_tickets = opts.ssl_tickets
+        if opts.ssl_tickets == 0:
+            ssl_context.options |= ssl.OP_NO_TICKET
 
 # provide disclaimer if running as root
 if running_as_root:
@@ -1672,10 +2732,12 @@ def make_session_factory(process_msg_func):
         else:
             start_mode = opts.tls
 
-        return lambda conn: SecureSMTPSession(conn, ssl_context,
-                                              process_msg_func, start_mode)
+        return lambda reader, writer: SecureSMTPSession(reader, writer,
+                                                        ssl_context,
+                                                        process_msg_func,
+                                                        start_mode)
 
-    return lambda conn: SMTPSession(conn, process_msg_func)
+    return lambda reader, writer: SMTPSession(reader, writer, process_msg_func)
 
 def main():
     handle_opts()
@@ -1685,9 +2747,7 @@ def main():
     else:
         session_factory = make_session_factory(process_message_sysuser)
 
-    if opts.one_session:
-        create_smtp_session_from_stdin(session_factory)
-    else:
+    if not opts.one_session:
         # Add a default address if none were given.
         if opts.proxyport == opts.ipv6proxyport == []:
             opts.proxyport = ["%s:8025" % FQDN]
@@ -1745,9 +2805,20 @@ def main():
 
     # Start the event loop
     try:
-        asyncore.loop()
+        if inject_pool and opts.workers == 1:
+            # Each worker process starts its own.
+            inject_pool.start()
+        if opts.one_session:
+            asyncio.run(create_smtp_session_from_stdin(session_factory))
+        elif opts.workers > 1:
+            supervise_workers(opts.workers)
+        else:
+            asyncio.run(run_servers())
     except KeyboardInterrupt:
         pass
+    finally:
+        if inject_pool:
+            inject_pool.close()
 
 
 # This is the end my friend.
@@ -74,6 +74,9 @@ parser.trailer = \
   (immediately release any messages with `foobar' in them)
   $ tmda-pending -b -T | grep foobar | awk '{print $1}' | $ tmda-pending -b -r -
 
+  (release all pending messages, reinjecting them four at a time)
+  $ tmda-pending -b -r --jobs=4
+
   (immediately delete all messages from the pending queue)
   $ tmda-pending -b -d
 
@@ -82,6 +85,9 @@ parser.trailer = \
 
   (mail a summary report of all new pending messages)
   $ tmda-pending -C -b -s | mail -s 'TMDA pending summary' jason
+
+  (check the metadata index against the pending queue)
+  $ tmda-pending --verify-index
 """
 
 parser.add_option("-V",
@@ -92,6 +98,7 @@ parser.add_option("-V",
 gengroup = OptionGroup(parser, "General")
 actngroup = OptionGroup(parser, "Actions")
 msggroup = OptionGroup(parser, "Messages")
+idxgroup = OptionGroup(parser, "Metadata index")
 
 # general
 gengroup.add_option("--vhome-script",
@@ -151,6 +158,16 @@ gengroup.add_option("-b", "--batch",
                     help= \
 """Operate non-interactively in batch mode. Use with caution.""")
 
+gengroup.add_option("-j", "--jobs",
+                    type="int", metavar="N", dest="jobs",
+                    help= \
+"""In batch mode, release messages by reinjecting up to N of them at
+once, each of N threads keeping its own connection to the SMTP server
+when MAIL_TRANSPORT is 'smtp'.  Addresses are also added to the
+PENDING_*_APPEND files all at once, after all messages have been
+processed.  Messages which can't be reinjected are listed, and
+tmda-pending then exits with status 1.""")
+
 gengroup.add_option("-C", "--cache",
                     action="store_true", dest="cache",
                     help= \
@@ -228,7 +245,24 @@ msggroup.add_option("-O", "--older",
 seconds (s), minutes (m), hours (h), days (d), weeks (w), months (M),
 or years (Y).""")
 
-for g in (gengroup, actngroup, msggroup):
+# metadata index
+
+idxgroup.add_option("--rebuild-index",
+                    action="store_const", const="rebuild", dest="index",
+                    help= \
+"""Rebuild the pending queue's metadata index, which holds the headers
+used to list pending messages, by parsing every message in the queue.""")
+
+idxgroup.add_option("--verify-index",
+                    action="store_const", const="verify", dest="index",
+                    help= \
+"""Check the pending queue's metadata index against the messages in the
+queue, listing any messages missing from it, and any out of date
+entries.  Exits with status 1 if there are any.  Out of date entries
+are harmless, since they are ignored or replaced as needed, but
+'--rebuild-index' will remove them.""")
+
+for g in (gengroup, actngroup, msggroup, idxgroup):
     parser.add_option_group(g)
 
 (opts, args) = parser.parse_args()
@@ -243,6 +277,12 @@ if opts.config_file:
 if opts.pretend or opts.interactive:
     opts.verbose = True
 
+if opts.jobs is not None:
+    if opts.interactive:
+        parser.error("'--jobs' requires '--batch'")
+    if opts.jobs < 1:
+        parser.error("'--jobs' must be at least 1")
+
 if opts.younger:
     threshold = opts.younger
 elif opts.older:
@@ -287,7 +327,34 @@ from . import Pending
 from . import Errors
 
 
+def index():
+    Q = Pending.Q
+    if not Q.exists():
+        raise Errors.QueueError('Pending Queue does not exist, exiting.')
+    if opts.index == 'rebuild':
+        count = Q.rebuild_index()
+        if opts.verbose:
+            print('indexed %d messages' % count)
+        return 0
+    missing, stale, changed = Q.verify_index()
+    if opts.verbose:
+        for msgid in missing:
+            print('%s: not indexed' % msgid)
+        for msgid in stale:
+            print('%s: indexed but not in the queue' % msgid)
+        for msgid in changed:
+            print('%s: index entry out of date' % msgid)
+    if missing or stale or changed:
+        return 1
+    return 0
+
 def main():
+    if opts.index:
+        try:
+            sys.exit(index())
+        except Errors.QueueError as obj:
+            print(obj)
+            sys.exit(1)
     if opts.interactive:
         QueueObject = Pending.InteractiveQueue
     else:
@@ -305,12 +372,15 @@ def main():
             threshold = threshold,
             verbose = opts.verbose,
             younger = opts.younger,
-            pretend = opts.pretend
+            pretend = opts.pretend,
+            jobs = opts.jobs
             ).initQueue()
         q.mainLoop()
     except Errors.QueueError as obj:
         print(obj)
         sys.exit(1)
+    if q.failed:
+        sys.exit(1)
 
 # This is the end my friend.
 if __name__ == '__main__':
@@ -114,6 +114,23 @@ incoming filter and then exit. The first address given should be the
 message recipient (you), and the second is the sender. This option
 will also check for parsing errors in the filter file."""),
 
+    make_option("-b", "--batch",
+                action="store_true", default=False, dest="batch",
+                help= \
+"""Match every message in the files and directories given as arguments
+against your incoming filter, without delivering anything, and then
+exit.  Each argument may be a message file, an mbox file, a Maildir or
+a directory of message files.  One line of JSON is printed per message,
+giving the action and the matching filter line.  The sender is taken
+from the mbox From_ line or the Return-Path header, and the recipient
+from $RECIPIENT or the message headers.  FILTER_STATS isn't updated."""),
+
+    make_option("--rule-stats",
+                action="store_true", default=False, dest="rule_stats",
+                help= \
+"""Print the per-rule statistics gathered in FILTER_STATS, slowest
+rules first, and then exit."""),
+
     make_option("-V",
                 action="store_true", default=False, dest="full_version",
                 help="show full TMDA version information and exit"),
@@ -177,6 +194,22 @@ if opts.filter_match:
     Util.filter_match(Defaults.FILTER_INCOMING, recip, sender)
     sys.exit()
 
+# Report the rule statistics in Defaults.FILTER_STATS, and then exit.
+if opts.rule_stats:
+    if not Defaults.FILTER_STATS:
+        parser.error('FILTER_STATS is not set')
+    Util.filter_stats(Defaults.FILTER_STATS)
+    sys.exit()
+
+# Match a batch of messages against Defaults.FILTER_INCOMING, and then
+# exit.
+if opts.batch:
+    if not args:
+        parser.error('--batch needs at least one file or directory')
+    Util.filter_batch(Defaults.FILTER_INCOMING, args,
+                      os.environ.get('RECIPIENT'))
+    sys.exit()
+
 if opts.act_as_filter:
     Defaults.DELIVERY = '_filter_'
 
@@ -198,23 +231,11 @@ stdin = BytesIO(sys.stdin.buffer.read())
 # The incoming message as an email.Message object.
 msgin = Util.msg_from_file(stdin, isBytes=True)
 
-# Original message contents as a string.
-orig_msgin_as_string = Util.msg_as_string(msgin)
-
-# Original message headers as a string.
-orig_msgin_headers_as_string = Util.headers_as_string(msgin)
-
-# Original message headers as a raw string.
-orig_msgin_headers_as_raw_string = Util.headers_as_raw_string(msgin)
-
-# Original message body.
-orig_msgin_body = msgin.get_payload()
-
-# Original message body as a raw string.
-orig_msgin_body_as_raw_string = Util.body_as_raw_string(msgin)
-
-# Calculate the incoming message size.
-orig_msgin_size = len(orig_msgin_as_string)
+# Original message contents, headers, body and size as strings.
+# These are only computed if a filter rule, log file or template
+# needs them, since many messages are dealt with on the envelope
+# addresses alone.
+orig_msgin = Util.MessageText(stdin.getvalue())
 
 # Collect the three essential environment variables, and defer if they
 # are missing.
@@ -332,7 +353,7 @@ def logit(action, msg):
                                              msgin,
                                              envsender = envelope_sender,
                                              envrecip = recipient_address,
-                                             msg_size = orig_msgin_size,
+                                             msg_size = orig_msgin.size(),
                                              action_msg = action_msg)
         logger.write()
     if Defaults.ACTION_HEADER_INCOMING:
@@ -682,10 +703,10 @@ def bouncegen(mode, template=None):
     confirm_append_address = Util.confirm_append_address(x_primary_address,
                                                          envelope_sender)
     subject = globals().get('subject')
-    original_message_body = globals().get('orig_msgin_body_as_raw_string')
-    original_message_headers = globals().get('orig_msgin_headers_as_raw_string')
-    original_message_size = globals().get('orig_msgin_size')
-    original_message = globals().get('orig_msgin_as_string')
+    original_message_body = orig_msgin.body_as_raw_string()
+    original_message_headers = orig_msgin.headers_as_raw_string()
+    original_message_size = orig_msgin.size()
+    original_message = orig_msgin.as_string()
     pending_lifetime = Util.format_timeout(Defaults.PENDING_LIFETIME)
     # Optional 'dated' address variables.
     if Defaults.DATED_TEMPLATE_VARS:
@@ -792,13 +813,17 @@ def main():
     if (cookie_type in Defaults.TAGS_CONFIRM) and cookie_value:
         verify_confirm_cookie(cookie_value, 'accept')
     # Parse the incoming filter file.
-    infilter = FilterParser.FilterParser(Defaults.DB_CONNECTION)
+    infilter = FilterParser.FilterParser(Defaults.DB_CONNECTION,
+                                         Defaults.FILTER_STATS)
     infilter.read(Defaults.FILTER_INCOMING)
-    (actions, matching_line) = infilter.firstmatch(recipient_address,
-                                                   sender_list,
-                                                   orig_msgin_body_as_raw_string,
-                                                   orig_msgin_headers_as_raw_string,
-                                                   orig_msgin_size)
+    # Pass functions rather than strings, so the message is only
+    # serialized if a rule looks at its contents.
+    (actions, matching_line) = infilter.firstmatch(
+        recipient_address, sender_list,
+        msg_body=orig_msgin.body_as_raw_string,
+        msg_headers=orig_msgin.headers_as_raw_string,
+        msg_size=orig_msgin.size)
+    infilter.close()
     (action, option) = actions.get('incoming', (None, None))
     # Dispose of the message now if there was a filter file match.
     # Log the action along with and the matching line in the filter
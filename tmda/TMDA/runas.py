@@ -0,0 +1,54 @@
+# -*- python -*-
+#
+# Copyright (C) 2001-2007 Jason R. Mastaler <jason@mastaler.com>
+#
+# This file is part of TMDA.
+#
+# TMDA is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.  A copy of this license should
+# be included in the file COPYING.
+#
+# TMDA is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TMDA; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+
+"""Run a command as another user.
+
+Usage: python -m TMDA.runas user command [argument ...]
+
+When started as root, tmda-ofmipd keeps root as its real UID, so that
+it can run tmda-inject as each authenticated user.  Changing UID in a
+forked copy of the multi-threaded server isn't safe, so it runs the
+command through this instead, which switches to user and then
+executes the command from the root directory.  tmda-ofmipd runs Python
+isolated (-I) for this, so that nothing but TMDA itself is imported
+before the switch (see ofmipd.runas_cmd).
+"""
+
+
+import os
+import sys
+
+from . import Util
+
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write(__doc__.split('\n\n')[1] + '\n')
+        sys.exit(2)
+    Util.switch_user(sys.argv[1])
+    # The command mustn't pick up anything from wherever the server
+    # happened to be started.
+    os.chdir('/')
+    os.execvp(sys.argv[2], sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,7 @@ classifiers = ['Development Status :: 4 - Beta',
                'Operating System :: MacOS :: MacOS X',
                'Operating System :: Microsoft :: Windows',
                'Operating System :: POSIX',
-               'Programming Language :: Python :: 3.4',
+               'Programming Language :: Python :: 3.11',
                'Programming Language :: Python :: Implementation :: CPython',
                'Topic :: Communications :: Email :: Filters',
                'Topic :: Internet :: Proxy Servers',
@@ -46,11 +46,12 @@ setup( author = 'Jason R. Mastaler, Kevin Goodsell, Paul Jimenez, and others'
      , url = 'http://tmda.net/'
      , version = '1.0.3'
      , zip_safe = False
-     , install_requires = ['pyOpenSSL>=0.14',
-                           'python-pam>=1.8.2'
+     , python_requires = '>=3.11'
+     , install_requires = ['python-pam>=1.8.2'
                            ]
      , extras_require = { }
      , tests_require = ['virtualenv>=1.11',
                         'pytest',
+                        'pyOpenSSL>=0.14',
                         ]
       )
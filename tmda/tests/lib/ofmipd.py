@@ -4,6 +4,7 @@ import base64
 import socket
 import subprocess
 import re
+import time
 
 import OpenSSL.SSL as SSL
 
@@ -18,12 +19,12 @@ keyFile = os.path.join(filesDir, 'test-ofmipd.key')
 
 def b64_encode(s):
     """base64 encoding without the trailing newline."""
-    return base64.encodestring(bytes(s, 'ascii'))[:-1]
+    return base64.encodebytes(bytes(s, 'ascii'))[:-1]
 
 
 def b64_decode(s):
     """base64 decoding."""
-    return base64.decodestring(bytes(s, 'ascii'))
+    return base64.decodebytes(bytes(s, 'ascii'))
 
 
 class TestOfmipdServer(object):
@@ -41,6 +42,7 @@ class TestOfmipdServer(object):
         self._ssl = ''
         self._authOpts = []
         self._extraOpts = []
+        self._logFile = None
 
         self._serverProc = None
         self._v4addrs = []
@@ -81,19 +83,29 @@ class TestOfmipdServer(object):
         serverOpts.extend(bindOpts)
         serverOpts.extend(self._extraOpts)
 
-        self._serverProc = subprocess.Popen(serverOpts, env=newEnv)
+        if self._logFile:
+            with open(self._logFile, 'w') as log:
+                self._serverProc = subprocess.Popen(serverOpts, env=newEnv,
+                                                    stderr=log)
+        else:
+            self._serverProc = subprocess.Popen(serverOpts, env=newEnv)
 
         # Wait for server availability
         addr = (self._v6addrs + self._v4addrs)[0]
         family = socket.AF_INET6 if ':' in addr[0] else socket.AF_INET
-        s = socket.socket(family, socket.SOCK_STREAM)
         while True:
+            if self._serverProc.poll() is not None:
+                raise RuntimeError('tmda-ofmipd exited with status %d '
+                                   'before listening'
+                                   % self._serverProc.returncode)
+            s = socket.socket(family, socket.SOCK_STREAM)
             try:
                 s.connect(addr)
-                s.close()
                 break
             except socket.error:
-                pass
+                time.sleep(0.05)
+            finally:
+                s.close()
 
     def stop(self):
         import signal
@@ -122,6 +134,10 @@ class TestOfmipdServer(object):
     def tls(self, option='on'):
         self._ssl = '--tls=%s' % option
 
+    def logTo(self, filename):
+        # The server logs to stderr.
+        self._logFile = filename
+
     def addOptions(self, opts):
         if isinstance(opts, str):
             opts = [opts]
@@ -141,15 +157,17 @@ class TestOfmipdServer(object):
     def addRemoteAuth(self, url):
         self._authOpts.append('--remoteauth=%s' % url)
 
-    def makeClient(self, addr=None):
+    def address(self, addr=None):
         if addr is None:
             addr = (self._v6addrs + self._v4addrs)[0]
         elif addr == 'v6':
             addr = self._v6addrs[0]
         elif addr == 'v4':
             addr = self._v4addrs[0]
+        return addr
 
-        client = TestOfmipdClient(addr)
+    def makeClient(self, addr=None):
+        client = TestOfmipdClient(self.address(addr))
 
         if self._ssl == '--ssl':
             client.ssl()
@@ -231,11 +249,14 @@ class TestOfmipdClient(object):
     def send(self, data):
         self._sock.send(bytes(data, 'utf-8', 'replace'))
 
-    def exchange(self, msg):
-        self.send(msg)
+    def receive(self):
         response = self.receiveUntil(self._completeResponse)
         return self._splitResponse(response)
 
+    def exchange(self, msg):
+        self.send(msg)
+        return self.receive()
+
     # Helpers, etc.
 
     _responseMatcher = re.compile(r'^\d{3} .*\r\n', re.MULTILINE)
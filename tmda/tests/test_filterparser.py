@@ -0,0 +1,465 @@
+import unittest
+import io
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import FilterParser
+
+class FilterTestMixin(object):
+    '''
+    Creates a scratch directory to hold filter and list files.
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeFile(self, name, lines):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def parse(self, path):
+        parser = FilterParser.FilterParser()
+        parser.read(path)
+        return parser
+
+class FilterCacheTest(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        Defaults.FILTER_CACHE = True
+        self.include = self.writeFile('include', ['from jdoe@example.com ok'])
+        self.filter = self.writeFile('incoming', [
+            'macro BAD(addr) from addr drop',
+            'BAD(spammer@example.com)',
+            'include %s' % self.include,
+            'include -optional %s' % os.path.join(self.tmpdir, 'later'),
+        ])
+
+    def tearDown(self):
+        Defaults.FILTER_CACHE = False
+        FilterTestMixin.tearDown(self)
+
+    def touch(self, path, lines):
+        # Make sure the new mtime differs even on coarse filesystems.
+        self.writeFile(os.path.basename(path), lines)
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def testCacheWritten(self):
+        parser = self.parse(self.filter)
+        self.assertTrue(os.path.exists(self.filter + '.cache'))
+        cached = self.parse(self.filter)
+        self.assertEqual(cached.filterlist, parser.filterlist)
+
+    def testCacheUsed(self):
+        self.parse(self.filter)
+        # A cached load must not parse anything.
+        def noParse(parser, fp):
+            raise AssertionError('filter was parsed')
+        saved = FilterParser.FilterParser._FilterParser__parse
+        FilterParser.FilterParser._FilterParser__parse = noParse
+        try:
+            parser = self.parse(self.filter)
+        finally:
+            FilterParser.FilterParser._FilterParser__parse = saved
+        self.assertEqual(len(parser.filterlist), 2)
+
+    def testWritableCacheIgnored(self):
+        # A cache others could have tampered with mustn't be unpickled.
+        self.parse(self.filter)
+        os.chmod(self.filter + '.cache', 0o666)
+        def noLoad(fp):
+            raise AssertionError('cache was loaded')
+        saved = FilterParser.pickle.load
+        FilterParser.pickle.load = noLoad
+        try:
+            parser = self.parse(self.filter)
+        finally:
+            FilterParser.pickle.load = saved
+        self.assertEqual(len(parser.filterlist), 2)
+
+    def testFilterChanged(self):
+        self.parse(self.filter)
+        self.touch(self.filter, ['from other@example.com ok'])
+        parser = self.parse(self.filter)
+        self.assertEqual([r[2] for r in parser.filterlist],
+                         ['other@example.com'])
+
+    def testIncludeChanged(self):
+        self.parse(self.filter)
+        self.touch(self.include, ['from jdoe@example.com drop',
+                                  'from jane@example.com ok'])
+        parser = self.parse(self.filter)
+        self.assertEqual(len(parser.filterlist), 3)
+
+    def testOptionalIncludeAppears(self):
+        self.parse(self.filter)
+        self.writeFile('later', ['from late@example.com ok'])
+        parser = self.parse(self.filter)
+        self.assertEqual(parser.filterlist[-1][2], 'late@example.com')
+
+    def testVariableChanged(self):
+        os.environ['TMDA_TEST_ADDR'] = 'one@example.com'
+        try:
+            path = self.writeFile('vars', ['from ${TMDA_TEST_ADDR} ok'])
+            self.parse(path)
+            os.environ['TMDA_TEST_ADDR'] = 'two@example.com'
+            parser = self.parse(path)
+            self.assertEqual(parser.filterlist[0][2], 'two@example.com')
+        finally:
+            del os.environ['TMDA_TEST_ADDR']
+
+    def testParseErrorNotCached(self):
+        path = self.writeFile('broken', ['bogus rule here'])
+        self.assertRaises(FilterParser.ParsingError, self.parse, path)
+        self.assertFalse(os.path.exists(path + '.cache'))
+
+class ListCacheTest(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.list = self.writeFile('whitelist', ['JDoe@Example.com',
+                                                 '*@=example.org drop'])
+        self.filter = self.writeFile('incoming', [
+            'from-file %s ok' % self.list])
+
+    def firstmatch(self, sender):
+        parser = self.parse(self.filter)
+        return parser.firstmatch('me@here.dom', [sender])[0]
+
+    def testMatch(self):
+        self.assertEqual(self.firstmatch('jdoe@example.com'),
+                         {'incoming': ('ok', None)})
+        self.assertEqual(self.firstmatch('x@mail.example.org'),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch('x@example.net'), {})
+
+    def testReused(self):
+        self.firstmatch('jdoe@example.com')
+        cached = FilterParser._listcache[self.list]
+        self.firstmatch('jdoe@example.com')
+        self.assertTrue(FilterParser._listcache[self.list] is cached)
+
+    def testReloaded(self):
+        self.assertEqual(self.firstmatch('x@example.net'), {})
+        self.writeFile('whitelist', ['x@example.net'])
+        st = os.stat(self.list)
+        os.utime(self.list, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.firstmatch('x@example.net'),
+                         {'incoming': ('ok', None)})
+
+class RuleTest(FilterTestMixin, unittest.TestCase):
+    def testRuleClasses(self):
+        path = self.writeFile('incoming', [
+            'from jdoe@example.com ok',
+            'TO-FILE %s ok' % os.path.join(self.tmpdir, 'list'),
+            'size >100 hold',
+            'headers "^x-spam: yes" drop',
+        ])
+        parser = self.parse(path)
+        self.assertEqual([rule.__class__.__name__ for rule in parser.rules],
+                         ['AddressRule', 'FileRule', 'SizeRule', 'RegexRule'])
+        self.assertEqual(parser.rules[1].source, 'to-file')
+
+    def testBadSize(self):
+        path = self.writeFile('incoming', ['size >lots drop'])
+        self.assertRaises(FilterParser.ParsingError, self.parse, path)
+
+    def testSize(self):
+        path = self.writeFile('incoming', ['size >100 hold', 'size <10 drop'])
+        parser = self.parse(path)
+        self.assertEqual(parser.firstmatch('me@here.dom', [], msg_size=200),
+                         ({'incoming': ('hold', None)}, 'size >100 hold'))
+        self.assertEqual(parser.firstmatch('me@here.dom', [], msg_size=50),
+                         ({}, None))
+
+    def testKeys(self):
+        lists = [ self.writeFile('list%d' % i, ['nobody@example.net'])
+                  for i in range(3) ]
+        domains = self.writeFile('domains', ['example.com hold'])
+        path = self.writeFile('incoming',
+                              [ 'from-file %s ok' % l for l in lists ] +
+                              [ 'from example.com drop',
+                                'from-file %s ok' % domains ])
+        senders = ['jdoe@example.com', 'jane@mail.example.com']
+        actions, line = self.parse(path).firstmatch('me@here.dom', senders)
+        self.assertEqual(actions, {'incoming': ('hold', None)})
+        self.assertEqual(line, 'from-file %s hold' % domains)
+        # The caller's list is left alone.
+        self.assertEqual(senders, ['jdoe@example.com', 'jane@mail.example.com'])
+        ctx = FilterParser.MatchContext(None, 'me@here.dom', senders,
+                                        None, None, None)
+        self.assertEqual(ctx.dbkeys('from'), senders + ['example.com',
+                                                        'mail.example.com'])
+        self.assertEqual(ctx.dbkeys('to'), ['me@here.dom', 'here.dom'])
+
+class BatchTest(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.list = self.writeFile('list', ['jdoe@example.com'])
+        self.filter = self.writeFile('incoming', [
+            'from-file %s ok' % self.list,
+            'body cheap hold'])
+
+    def testFirstmatchMany(self):
+        parser = self.parse(self.filter)
+        messages = [{'senders': ['jdoe@example.com']},
+                    {'senders': ['x@example.com'], 'msg_body': 'cheap'},
+                    {'senders': ['x@example.com'], 'msg_body': 'dear'}]
+        results = list(parser.firstmatch_many(iter(messages)))
+        self.assertTrue(results[0][0] is messages[0])
+        self.assertTrue(self.list in FilterParser._listcache)
+        self.assertEqual([r[1:] for r in results],
+            [({'incoming': ('ok', None)}, 'from-file %s ok' % self.list),
+             ({'incoming': ('hold', None)}, 'body "cheap" hold'),
+             ({}, None)])
+
+    def testFilterBatch(self):
+        import json
+        from TMDA import Util
+        mbox = self.writeFile('mbox', [
+            'From jdoe@example.com Mon Jan  1 00:00:00 2024',
+            'To: me@here.dom',
+            '',
+            '>From here, it looks cheap',
+            '',
+            'From x@example.com Mon Jan  1 00:00:00 2024',
+            'Subject: hi',
+            '',
+            'cheap'])
+        self.assertEqual([m[:2] for m in Util.iter_messages([mbox])],
+                         [(mbox + ':1', 'jdoe@example.com'),
+                          (mbox + ':2', 'x@example.com')])
+        out = io.StringIO()
+        Util.filter_batch(self.filter, [mbox], out=out)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([(r['recipient'], r['action']) for r in results],
+                         [('me@here.dom', 'ok'), ('', 'hold')])
+
+    def testIterMessagesUnquotesFrom(self):
+        from TMDA import Util
+        mbox = self.writeFile('mbox', [
+            'From jdoe@example.com Mon Jan  1 00:00:00 2024',
+            'Subject: quoting',
+            '',
+            '>From here',
+            '>>From there',
+            ' >From nowhere'])
+        [(name, sender, raw)] = Util.iter_messages([mbox])
+        self.assertEqual(raw.split(b'\n\n', 1)[1],
+                         b'From here\n>From there\n >From nowhere\n')
+
+class StatsTest(FilterTestMixin, unittest.TestCase):
+    def testStats(self):
+        statsfile = os.path.join(self.tmpdir, 'stats')
+        path = self.writeFile('incoming', ['from jdoe@example.com ok',
+                                           'body cheap\thold'])
+        for i in range(2):
+            parser = FilterParser.FilterParser(statsfile=statsfile)
+            parser.read(path)
+            parser.firstmatch('me@here.dom', ['jdoe@example.com'])
+            parser.firstmatch('me@here.dom', ['x@example.com'],
+                              msg_body='cheap')
+            parser.firstmatch('me@here.dom', ['x@example.com'],
+                              msg_body='dear')
+            parser.close()
+        stats = FilterParser.load_stats(statsfile)
+        self.assertEqual(sorted(stats), [(path, 1), (path, 2)])
+        self.assertEqual(stats[(path, 1)][:3],
+                         ['from jdoe@example.com ok', 6, 2])
+        self.assertEqual(stats[(path, 2)][:3], ['body "cheap" hold', 4, 2])
+        self.assertTrue(stats[(path, 2)][3] > 0)
+
+    def testNoStats(self):
+        path = self.writeFile('incoming', ['from jdoe@example.com ok'])
+        parser = self.parse(path)
+        parser.firstmatch('me@here.dom', ['jdoe@example.com'])
+        self.assertEqual(parser.stats, None)
+
+class ListIndexTest(FilterTestMixin, unittest.TestCase):
+    lines = [
+        'jdoe@example.com',
+        '*@=example.org drop',
+        'boss@example.org confirm',
+        'JANE@Example.com hold',
+        '# comment',
+        'jdoe@example.com bounce',
+        '<>',
+    ]
+
+    tests = ['jdoe@example.com', 'jane@example.com', 'x@a.example.org',
+             'boss@example.org', '<>', 'nobody@example.net']
+
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.list = self.writeFile('list', self.lines)
+
+    def testSameAsTextFile(self):
+        from TMDA import ListIndex
+        self.assertTrue(ListIndex.build(self.list))
+        index = ListIndex.ListIndex(self.list + '.idx')
+        try:
+            for addr in self.tests:
+                self.assertEqual(index.match([addr]),
+                                 FilterParser._listmatcher(self.list)
+                                 .match([addr]), addr)
+        finally:
+            index.close()
+
+    def testBuildFails(self):
+        from TMDA import ListIndex
+        missing = os.path.join(self.tmpdir, 'missing')
+        with self.assertLogs('tmda.listindex', 'WARNING'):
+            self.assertFalse(ListIndex.build(missing))
+        self.assertFalse(os.path.exists(missing + '.idx'))
+
+    def testAutoIndexRule(self):
+        path = self.writeFile('incoming', [
+            'from-file -autoindex %s ok' % self.list])
+        actions = self.parse(path).firstmatch('me@here.dom',
+                                              ['JDoe@Example.com'])[0]
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+        self.assertTrue(os.path.exists(self.list + '.idx'))
+        actions = self.parse(path).firstmatch('me@here.dom',
+                                              ['x@example.org'])[0]
+        self.assertEqual(actions, {'incoming': ('drop', None)})
+
+class PatternTest(FilterTestMixin, unittest.TestCase):
+    body = 'Hello,\nBuy CHEAP watches now!\nBye\n'
+
+    def firstmatch(self, lines, body=None):
+        path = self.writeFile('incoming', lines)
+        return self.parse(path).firstmatch('me@here.dom', ['x@example.com'],
+                                           msg_body=body or self.body)[0]
+
+    def testBody(self):
+        self.assertEqual(self.firstmatch(['body "^buy cheap" drop']),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(['body -case "^buy cheap" drop']),
+                         {})
+
+    def testBadExpression(self):
+        path = self.writeFile('incoming', ['body "(unclosed" drop'])
+        self.assertRaises(FilterParser.ParsingError, self.parse, path)
+
+    def testPatternFile(self):
+        self.writeFile('phrases', ['viagra', '"cheap (\\w+)"',
+                                   '(?s)hello.*bye', '"nothing here"'])
+        patterns = FilterParser._patternfile(
+            os.path.join(self.tmpdir, 'phrases'), re.I | re.M)
+        self.assertEqual(patterns.search(self.body), 'cheap (\\w+)')
+        self.assertEqual(patterns.search('Nothing Here'), 'nothing here')
+        self.assertEqual(patterns.search('hello\nbye'), '(?s)hello.*bye')
+        self.assertEqual(patterns.search('clean'), None)
+
+    def testPatternFileAnyLine(self):
+        # Any of the matching lines may be returned.
+        self.writeFile('any', ['watches', 'cheap', 'buy', 'goodbye'])
+        patterns = FilterParser._patternfile(
+            os.path.join(self.tmpdir, 'any'), re.I | re.M)
+        self.assertIn(patterns.search(self.body), ['watches', 'cheap', 'buy'])
+        self.assertEqual(patterns.search('bye'), None)
+
+    def testBodyFile(self):
+        phrases = self.writeFile('phrases', ['viagra', 'cheap watches'])
+        self.assertEqual(self.firstmatch(['body-file %s drop' % phrases]),
+                         {'incoming': ('drop', None)})
+        self.assertEqual(self.firstmatch(['body-file %s drop' % phrases],
+                                         'clean\n'), {})
+        self.assertEqual(self.firstmatch(
+            ['body-file -optional %s drop' % os.path.join(self.tmpdir, 'no')]),
+                         {})
+
+class LazyContentTest(FilterTestMixin, unittest.TestCase):
+    raw = b'From: x@example.com\nSubject: hi\n\nBuy cheap watches\n'
+
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.calls = []
+
+    def firstmatch(self, lines, text):
+        path = self.writeFile('incoming', lines)
+        def body():
+            self.calls.append('body')
+            return text.body_as_raw_string()
+        return self.parse(path).firstmatch('me@here.dom', ['x@example.com'],
+                                           msg_body=body,
+                                           msg_headers=text.headers_as_raw_string,
+                                           msg_size=text.size)[0]
+
+    def testNotSerialized(self):
+        from TMDA import Util
+        text = Util.MessageText(self.raw)
+        actions = self.firstmatch(['from x@example.com ok',
+                                   'body cheap drop'], text)
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+        self.assertEqual(self.calls, [])
+        self.assertTrue(text._MessageText__text is None)
+
+    def testSerializedOnce(self):
+        from TMDA import Util
+        text = Util.MessageText(self.raw)
+        actions = self.firstmatch(['body nothing ok', 'body-file -optional '
+                                   '/nonexistent ok', 'size >10000 ok',
+                                   'body cheap drop'], text)
+        self.assertEqual(actions, {'incoming': ('drop', None)})
+        self.assertEqual(self.calls, ['body'])
+        msg = Util.msg_from_file(io.BytesIO(self.raw), isBytes=True)
+        self.assertEqual(text.as_string(), Util.msg_as_string(msg))
+        self.assertEqual(text.headers_as_raw_string(),
+                         Util.headers_as_raw_string(msg))
+        self.assertEqual(text.body_as_raw_string(),
+                         Util.body_as_raw_string(msg))
+
+class HandlePoolTest(FilterTestMixin, unittest.TestCase):
+    def setUp(self):
+        FilterTestMixin.setUp(self)
+        self.db = os.path.join(self.tmpdir, 'list')
+        self.makeDb({'jdoe@example.com': 'drop'})
+        path = self.writeFile('incoming', ['from-dbm %s ok' % self.db])
+        self.parser = self.parse(path)
+
+    def tearDown(self):
+        self.parser.close()
+        FilterTestMixin.tearDown(self)
+
+    def makeDb(self, entries):
+        import dbm
+        db = dbm.open(self.db, 'n')
+        for (key, value) in entries.items():
+            db[key] = value
+        db.close()
+
+    def handles(self):
+        return self.parser._FilterParser__handles
+
+    def testReused(self):
+        actions = self.parser.firstmatch('me@here.dom', ['jdoe@example.com'])[0]
+        self.assertEqual(actions, {'incoming': ('drop', None)})
+        handle = list(self.handles().values())[0][1]
+        # A miss must not close the handle either.
+        self.parser.firstmatch('me@here.dom', ['x@example.com'])
+        self.parser.firstmatch('me@here.dom', ['jdoe@example.com'])
+        self.assertTrue(list(self.handles().values())[0][1] is handle)
+        self.parser.close()
+        self.assertEqual(self.handles(), {})
+
+    def testRebuilt(self):
+        self.parser.firstmatch('me@here.dom', ['jdoe@example.com'])
+        time.sleep(0.01)
+        self.makeDb({'jane@example.com': ''})
+        actions = self.parser.firstmatch('me@here.dom', ['jane@example.com'])[0]
+        self.assertEqual(actions, {'incoming': ('ok', None)})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+import lib.util
+lib.util.testPrep()
+
+import TMDA.Util as Util
+
+class FindMatch(unittest.TestCase):
+    patterns = [
+        'jdoe@example.com',
+        '*@=spam.example.com drop',
+        'boss@=example.com ok',
+        '*@example.org confirm',
+        'j?e*@*.example.net drop',
+        '<> bounce',
+        '*@example.* hold',
+    ]
+
+    tests = [
+        (['JDoe@Example.COM'], 1),
+        (['anyone@spam.example.com'], 'drop'),
+        (['anyone@deep.spam.example.com'], 'drop'),
+        (['anyone@notspam.example.com'], None),
+        (['boss@example.com'], 'ok'),
+        (['boss@mail.example.com'], 'ok'),
+        (['boss2@example.com'], 'hold'),
+        (['someone@example.org'], 'confirm'),
+        (['someone@sub.example.org'], None),
+        (['joe@a.example.net'], 'drop'),
+        (['<>'], 'bounce'),
+        (['nobody@nowhere.dom'], None),
+        # Addresses are tried in order, then patterns in order.
+        (['nobody@nowhere.dom', 'x@example.org', 'jdoe@example.com'],
+         'confirm'),
+        ([None, ''], None),
+    ]
+
+    def testLinearEquivalence(self):
+        # Make sure the expected results are those of the original
+        # pattern-by-pattern search.
+        for (addrs, expected) in self.tests:
+            if len(addrs) == 1:
+                result = Util._findmatch_linear(self.patterns,
+                                                addrs[0].lower())
+                self.assertEqual(result, expected, addrs)
+
+    def testMatcher(self):
+        matcher = Util.AddressMatcher(self.patterns)
+        for (addrs, expected) in self.tests:
+            self.assertEqual(matcher.match(addrs), expected, addrs)
+            self.assertEqual(Util.findmatch(self.patterns, addrs), expected)
+
+    def testMatcherReused(self):
+        patterns = ['jdoe@example.com ok']
+        self.assertEqual(Util.findmatch(patterns, ['jdoe@example.com']), 'ok')
+        matcher = Util._matchercache[id(patterns)][2]
+        Util.findmatch(patterns, ['jdoe@example.com'])
+        self.assertTrue(Util._matchercache[id(patterns)][2] is matcher)
+        # A changed list gets a new matcher.
+        patterns.append('jane@example.com drop')
+        self.assertEqual(Util.findmatch(patterns, ['jane@example.com']),
+                         'drop')
+
+    def testFirstPatternWins(self):
+        matcher = Util.AddressMatcher(['*@example.com ok',
+                                       'jdoe@example.com drop'])
+        self.assertEqual(matcher.match(['jdoe@example.com']), 'ok')
+        matcher = Util.AddressMatcher(['jd*@example.com ok',
+                                       '*@=example.com drop'])
+        self.assertEqual(matcher.match(['jdoe@example.com']), 'ok')
+
+    def testMultipleAts(self):
+        matcher = Util.AddressMatcher(['a@=example.com ok'])
+        self.assertEqual(matcher.match(['a@b@c.example.com']), 'ok')
+
+if __name__ == '__main__':
+    unittest.main()
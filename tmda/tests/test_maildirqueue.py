@@ -0,0 +1,169 @@
+import unittest
+import sys
+import os
+import shutil
+import socket
+import tempfile
+from email.message import Message
+
+import lib.util
+lib.util.testPrep()
+
+from TMDA import Defaults
+from TMDA import Util
+from TMDA.Queue.MaildirQueue import MaildirQueue, MaildirIndex
+from TMDA.Queue.Metadata import MetadataIndex
+
+class MaildirQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.saved_pending_dir = Defaults.PENDING_DIR
+        self.tmpdir = tempfile.mkdtemp()
+        Defaults.PENDING_DIR = os.path.join(self.tmpdir, 'pending')
+        self.queue = MaildirQueue()
+        self.queue.insert_message(self.makeMessage('one'),
+                                  '1243439251.12345', 'testuser@nowhere.com')
+        self.queue.insert_message(self.makeMessage('two'),
+                                  '1303349951.12346', 'testuser@nowhere.com')
+
+    def tearDown(self):
+        Defaults.PENDING_DIR = self.saved_pending_dir
+        shutil.rmtree(self.tmpdir)
+
+    def makeMessage(self, subject):
+        msg = Message()
+        msg['Subject'] = subject
+        msg.set_payload('Test message.\n')
+        return msg
+
+    def pendingPath(self, *names):
+        return os.path.join(Defaults.PENDING_DIR, *names)
+
+    def moveToCur(self, mailid):
+        name = '%s.%s' % (mailid, socket.gethostname())
+        os.rename(self.pendingPath('new', name),
+                  self.pendingPath('cur', name + ':2,S'))
+
+    def testFetch(self):
+        msg = self.queue.fetch_message('1303349951.12346')
+        self.assertEqual(msg['Subject'], 'two')
+        self.assertEqual(msg['X-TMDA-Recipient'], 'testuser@nowhere.com')
+
+    def testFetchMissing(self):
+        self.assertRaises(IOError, self.queue.fetch_message,
+                          '1303349951.99999')
+
+    def testFind(self):
+        self.assertTrue(self.queue.find_message('1243439251.12345'))
+        self.assertFalse(self.queue.find_message('1243439251.1234'))
+
+    def testIndexedOnInsert(self):
+        index = MaildirIndex(Defaults.PENDING_DIR)
+        self.assertEqual(index.get('1243439251.12345'),
+                         os.path.join('new', '1243439251.12345.%s'
+                                      % socket.gethostname()))
+
+    def testMovedByMua(self):
+        # The index heals itself when the message isn't where it says.
+        self.moveToCur('1243439251.12345')
+        msg = self.queue.fetch_message('1243439251.12345')
+        self.assertEqual(msg['Subject'], 'one')
+        index = MaildirIndex(Defaults.PENDING_DIR)
+        self.assertEqual(index.get('1243439251.12345'),
+                         os.path.join('cur', '1243439251.12345.%s:2,S'
+                                      % socket.gethostname()))
+
+    def testMissingIndex(self):
+        self.moveToCur('1303349951.12346')
+        os.unlink(self.pendingPath(MaildirIndex.FILENAME))
+        queue = MaildirQueue()
+        self.assertTrue(queue.find_message('1303349951.12346'))
+        self.assertEqual(queue.fetch_message('1303349951.12346')['Subject'],
+                         'two')
+
+    def testDelete(self):
+        self.moveToCur('1243439251.12345')
+        self.queue.delete_message('1243439251.12345')
+        self.queue.delete_message('1303349951.12346')
+        self.assertEqual(os.listdir(self.pendingPath('new')), [])
+        self.assertEqual(os.listdir(self.pendingPath('cur')), [])
+        index = MaildirIndex(Defaults.PENDING_DIR)
+        self.assertEqual(index.get('1243439251.12345'), None)
+        self.assertEqual(index.get('1303349951.12346'), None)
+        self.assertEqual(self.queue.fetch_metadata(['1243439251.12345']), {})
+
+    def testMetadata(self):
+        records = self.queue.fetch_metadata(['1303349951.12346'])
+        self.assertEqual(list(records.keys()), ['1303349951.12346'])
+        record = records['1303349951.12346']
+        self.assertEqual(record['headers']['subject'], 'two')
+        self.assertEqual(record['headers']['x-tmda-recipient'],
+                         'testuser@nowhere.com')
+        self.assertEqual(record['headers']['from'], None)
+        msg = self.queue.fetch_message('1303349951.12346')
+        self.assertEqual(record['size'], len(Util.msg_as_string(msg)))
+        self.assertEqual(record['flags'], '')
+        self.assertEqual(self.queue.verify_index(), ([], [], []))
+
+    def testMetadataFlags(self):
+        self.moveToCur('1243439251.12345')
+        self.queue.find_message('1243439251.12345')
+        records = self.queue.fetch_metadata(['1243439251.12345'])
+        self.assertEqual(records['1243439251.12345']['flags'], 'S')
+
+    def testMetadataStale(self):
+        # Messages missing from the index are parsed; records of
+        # messages that have gone are ignored.
+        os.unlink(self.pendingPath(MetadataIndex.FILENAME))
+        queue = MaildirQueue()
+        queue._metadata.set('1303349951.99999',
+                            queue.fetch_metadata(['1303349951.12346'])
+                            ['1303349951.12346'])
+        self.assertEqual(queue.verify_index(),
+                         (['1243439251.12345'], ['1303349951.99999'], []))
+        records = queue.fetch_metadata(['1243439251.12345',
+                                        '1303349951.99999'])
+        self.assertEqual(list(records.keys()), ['1243439251.12345'])
+        self.assertEqual(records['1243439251.12345']['headers']['subject'],
+                         'one')
+        self.assertEqual(queue.verify_index(), ([], [], []))
+
+    def testRebuildIndex(self):
+        index = MetadataIndex(Defaults.PENDING_DIR)
+        record = index.fetch()['1243439251.12345']
+        record['headers']['subject'] = 'changed'
+        index.set('1243439251.12345', record)
+        self.assertEqual(self.queue.verify_index(),
+                         ([], [], ['1243439251.12345']))
+        self.assertEqual(self.queue.rebuild_index(), 2)
+        self.assertEqual(self.queue.verify_index(), ([], [], []))
+        self.assertEqual(index.fetch()['1243439251.12345']
+                         ['headers']['subject'], 'one')
+
+    def testSetManyAtomic(self):
+        # A failed rebuild leaves the old index alone.
+        index = MetadataIndex(Defaults.PENDING_DIR)
+        before = index.fetch()
+        self.assertRaises(KeyError, index.set_many,
+                          {'1303349951.99999': {'headers': {}}}, clear=True)
+        self.assertEqual(index.fetch(), before)
+
+    def testUnusableIndex(self):
+        # Messages are still delivered if the index can't be written.
+        with open(self.pendingPath(MaildirIndex.FILENAME), 'w') as f:
+            f.write('not a database\n')
+        queue = MaildirQueue()
+        with self.assertLogs('tmda.queue', 'WARNING') as cm:
+            queue.insert_message(self.makeMessage('three'),
+                                 '1303349952.12347', 'testuser@nowhere.com')
+        self.assertEqual(len(cm.output), 2)
+        self.assertEqual(queue.fetch_message('1303349952.12347')['Subject'],
+                         'three')
+        records = queue.fetch_metadata(['1303349952.12347'])
+        self.assertEqual(records['1303349952.12347']['headers']['subject'],
+                         'three')
+
+if __name__ == '__main__':
+    if '-v' in sys.argv:
+        verbose = True
+    runner = unittest.TextTestRunner(verbosity=2)
+    unittest.main(testRunner=runner)
@@ -1,6 +1,12 @@
 import unittest
+import asyncio
 import hmac
+import shutil
+import socket
+import ssl
 import sys
+import tempfile
+import threading
 from hashlib import md5
 import os
 
@@ -89,6 +95,16 @@ class PreStartTlsServerResponses(ServerResponseTestMixin, unittest.TestCase):
     def checkAuthTypes(self, authTypes):
         self.assertEqual(len(authTypes), 0)
 
+    def testStartTlsPipelined(self):
+        # A command sent along with STARTTLS is dropped, not run after
+        # the handshake.
+        (code, lines) = self.client.exchange('STARTTLS\r\nMAIL FROM:<x>\r\n')
+        self.assertEqual(code, 554)
+        (code, lines) = self.client.exchange('MAIL FROM:<x>\r\n')
+        self.assertEqual(code, 530)
+        (code, lines) = self.client.exchange('STARTTLS\r\n')
+        self.assertEqual(code, 220)
+
 class PostStartTlsServerResponses(ServerResponseTestMixin, unittest.TestCase):
     expectedStartTlsCode = 503
     expectedAuthCode = 334
@@ -124,7 +140,7 @@ class OptionalStartTlsServerResponses(ServerResponseTestMixin,
 
 def b64_encode(s):
     """base64 encoding without the trailing newline."""
-    return base64.encodestring(bytes(s, 'ascii'))[:-1]
+    return base64.encodebytes(bytes(s, 'ascii'))[:-1]
 
 def b64_encodes(s):
     return b64_encode(s).decode('ascii')
@@ -132,7 +148,7 @@ def b64_encodes(s):
 
 def b64_decode(s):
     """base64 decoding."""
-    return base64.decodestring(bytes(s, 'ascii'))
+    return base64.decodebytes(bytes(s, 'ascii'))
 
 
 
@@ -278,6 +294,255 @@ class SslSendV4Test(SslSendTestMixin, unittest.TestCase):
 class TlsSendV4Test(TlsSendTestMixin, unittest.TestCase):
     client_addr = 'v4'
 
+# Injection through the pre-forked worker pool:
+
+class InjectPoolSendTest(SendTestMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions('--inject-pool')
+
+class InjectPoolSpooledSendTest(SendTestMixin, unittest.TestCase):
+    # A message spooled to disk is passed to the worker by descriptor.
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions(['--inject-pool', '--spool-size=0'])
+
+# Connections accepted by several worker processes:
+
+class WorkersSendTest(SendTestMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions(['--workers', '2'])
+
+# Messages spooled to disk:
+
+class SpooledSendTest(SendTestMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions('--spool-size=0')
+
+# Overlong lines:
+
+class LongLineTest(SendMailMixin, unittest.TestCase):
+    def testLongDataLine(self):
+        # Longer than the server reads at a time, so spooled in parts.
+        self.client.signOn()
+        self.beginSend()
+        self.sendLine('X-nothing: nothing')
+        self.sendLine('')
+        self.sendLine('..' + 'x' * 200000)
+        self.finishSend()
+
+    def testLongCommand(self):
+        (code, lines) = self.client.exchange('NOOP %s\r\n' % ('x' * 200000))
+        self.assertEqual(code, 500)
+        (code, lines) = self.client.exchange('NOOP\r\n')
+        self.assertEqual(code, 250)
+
+class ReadDataTest(unittest.TestCase):
+    def setUp(self):
+        from TMDA import ofmipd
+        self.module = ofmipd
+        self.saved = ofmipd.opts
+        ofmipd.opts = ofmipd.parser.get_default_values()
+
+    def tearDown(self):
+        self.module.opts = self.saved
+
+    def readData(self, data):
+        # Just what read_data() needs of a session, with a small limit
+        # so that lines overrun it.
+        session = self.module.SMTPSession.__new__(self.module.SMTPSession)
+        async def run():
+            session._reader = asyncio.StreamReader(limit=16)
+            session._reader.feed_data(data)
+            return (await session.read_data()).read()
+        return asyncio.run(run())
+
+    def testUnstuffing(self):
+        self.assertEqual(self.readData(b'a\r\n..b\r\n\r\n.\r\n'),
+                         b'a\n.b\n\n')
+
+    def testLongLines(self):
+        # Only a dot at the start of a line is unstuffed, not one at the
+        # start of a later part of it.
+        long = b'x' * 15 + b'.' * 50
+        self.assertEqual(self.readData(b'..' + long + b'\r\n' + long +
+                                       b'\r\n.\r\n'),
+                         b'.' + long + b'\n' + long + b'\n')
+
+# Sessions served at the same time:
+
+class ConcurrentSessionsTest(SendMailMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendMailMixin.serverAddOptions(self)
+        self.server.addOptions(['--message-threads', '2'])
+
+    def newClient(self):
+        self.client = self.server.makeClient(self.client_addr)
+        self.client.connect(self.client_starttls_on_connect)
+        return self.client
+
+    def testInterleaved(self):
+        # A second session sends a whole message while the first is in
+        # the middle of one.
+        first = self.client
+        first.signOn()
+        self.beginSend()
+        self.sendLine('X-Test: first')
+
+        self.newClient().signOn()
+        self.beginSend()
+        self.sendLine('X-Test: second')
+        self.sendLine('')
+        self.sendLine('Second message.')
+        self.finishSend()
+
+        self.client = first
+        self.sendLine('')
+        self.sendLine('First message.')
+        self.finishSend()
+
+    def testSimultaneousMessages(self):
+        # Finish every message before reading any of the replies, so that
+        # they are all processed at once, more of them than there are
+        # message threads.
+        clients = [self.client] + [self.newClient() for i in range(3)]
+        for (i, client) in enumerate(clients):
+            self.client = client
+            client.signOn()
+            self.beginSend()
+            self.sendLine('X-Test: %d' % i)
+            self.sendLine('')
+            self.sendLine('Message %d.' % i)
+        for client in clients:
+            client.send('.\r\n')
+        for client in clients:
+            (code, lines) = client.receive()
+            self.assertEqual(code, 250)
+            (code, lines) = client.exchange('QUIT\r\n')
+            self.assertEqual(code, 221)
+
+# Client host name lookups:
+
+class NoReverseDnsSendTest(SendTestMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions('--no-reverse-dns')
+
+class ReverseDnsTimeoutSendTest(SendTestMixin, unittest.TestCase):
+    # The message mustn't wait for a host name that's slow to arrive.
+    def serverAddOptions(self):
+        SendTestMixin.serverAddOptions(self)
+        self.server.addOptions('--reverse-dns-timeout=0')
+
+class HostnameCacheTest(unittest.TestCase):
+    def setUp(self):
+        from TMDA import ofmipd
+        self.module = ofmipd
+        self.lookups = []
+        self.saved = socket.getfqdn
+        socket.getfqdn = self.getfqdn
+        self.release = threading.Event()
+        self.release.set()
+
+    def tearDown(self):
+        socket.getfqdn = self.saved
+
+    def getfqdn(self, ip):
+        self.lookups.append(ip)
+        self.release.wait(5)
+        return 'host%d.example.com' % len(self.lookups)
+
+    def lookup(self, cache, *ips):
+        async def run():
+            return [await cache.lookup(ip) for ip in ips]
+        return asyncio.run(run())
+
+    def testHit(self):
+        cache = self.module.HostnameCache(60)
+        self.assertEqual(self.lookup(cache, '192.0.2.1', '192.0.2.1'),
+                         ['host1.example.com', 'host1.example.com'])
+        self.assertEqual(self.lookups, ['192.0.2.1'])
+
+    def testExpiry(self):
+        cache = self.module.HostnameCache(0)
+        self.assertEqual(self.lookup(cache, '192.0.2.1', '192.0.2.1'),
+                         ['host1.example.com', 'host2.example.com'])
+        self.assertEqual(self.lookups, ['192.0.2.1', '192.0.2.1'])
+
+    def testAsync(self):
+        # The lookup runs outside the event loop, and sessions waiting
+        # for the same address share it.
+        self.release.clear()
+        cache = self.module.HostnameCache(60)
+        async def run():
+            first = cache.lookup('192.0.2.1')
+            second = cache.lookup('192.0.2.1')
+            await asyncio.sleep(0.1)
+            self.assertFalse(first.done())
+            self.release.set()
+            return [await first, await second]
+        self.assertEqual(asyncio.run(run()),
+                         ['host1.example.com', 'host1.example.com'])
+        self.assertEqual(self.lookups, ['192.0.2.1'])
+
+# TLS session resumption:
+
+class SslResumptionTest(FileAuthServerClientMixin, unittest.TestCase):
+    # The client is Python's ssl module, which can resume sessions.
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.logFile = os.path.join(self.tmpdir, 'ofmipd.log')
+        self.serverSetUp()
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def tearDown(self):
+        FileAuthServerClientMixin.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def serverAddOptions(self):
+        FileAuthServerClientMixin.serverAddOptions(self)
+        self.server.ssl()
+        self.server.debug()
+        self.server.logTo(self.logFile)
+
+    def connect(self, session=None):
+        sock = socket.create_connection(self.server.address('v4'))
+        sslSock = self.context.wrap_socket(sock, session=session)
+        # Session tickets arrive after the handshake, with the greeting.
+        sslSock.recv(200)
+        result = (sslSock.session, sslSock.session_reused)
+        sslSock.close()
+        return result
+
+    def log(self):
+        with open(self.logFile) as f:
+            return f.read()
+
+    def testResumed(self):
+        (session, reused) = self.connect()
+        self.assertFalse(reused)
+        (session, reused) = self.connect(session)
+        self.assertTrue(reused)
+        log = self.log()
+        self.assertIn('resumed session', log)
+        self.assertIn('TLS handshakes: 2, resumed: 1 (50%)', log)
+
+class SslNoTicketsTest(SslResumptionTest):
+    def serverAddOptions(self):
+        SslResumptionTest.serverAddOptions(self)
+        self.server.addOptions(['--ssl-tickets', '0'])
+
+    def testResumed(self):
+        (session, reused) = self.connect()
+        (session, reused) = self.connect(session)
+        self.assertFalse(reused)
+        log = self.log()
+        self.assertNotIn('resumed session', log)
+        self.assertIn('TLS handshakes: 2, resumed: 0 (0%)', log)
 
 class QuotaTest(SendMailMixin, unittest.TestCase):
     def serverAddOptions(self):
@@ -302,6 +567,23 @@ class QuotaTest(SendMailMixin, unittest.TestCase):
     def testOverQuota(self):
         self.sendMessage('overquota', 'quotapassword', 450)
 
+class RateLimitTest(SendMailMixin, unittest.TestCase):
+    def serverAddOptions(self):
+        SendMailMixin.serverAddOptions(self)
+        self.server.addOptions(['--rate-limit-messages', '1'])
+
+    def sendMessage(self, expectedCode):
+        self.beginSend()
+        self.sendLine('X-Test: Rate limit')
+        self.sendLine('')
+        self.sendLine('Short message.')
+        self.finishSend(expectedCode)
+
+    def testRateLimit(self):
+        self.client.signOn()
+        self.sendMessage(250)
+        self.sendMessage(450)
+
 # Test for the undocumented ipauthmap file.
 class IpAuthMapTest(unittest.TestCase):
     def setUp(self):
@@ -1,9 +1,11 @@
 import unittest
+import socket
 import sys
+import time
 
 import lib.util
 lib.util.testPrep()
-from lib.ofmipd import TestOfmipdServer, ServerClientMixin
+from lib.ofmipd import TestOfmipdServer, ServerClientMixin, b64_encode
 
 verbose = False
 
@@ -94,6 +96,20 @@ class AuthProgTest(LocalAuthTestMixin, unittest.TestCase):
     def addAuth(self):
         self.server.addProgAuth('bin/checkpassword.py')
 
+class AuthProgCachedTest(AuthProgTest):
+    def addAuth(self):
+        AuthProgTest.addAuth(self)
+        self.server.addOptions(['--auth-cache-ttl', '60'])
+
+    def testAuthenticationCached(self):
+        # The first sign-on is cached; a wrong password must still fail.
+        self.client.signOn(self.username, self.password)
+        self.clientSetUp()
+        self.client.signOn(self.username, self.password)
+        self.clientSetUp()
+        self.assertRaises(AssertionError, self.client.signOn,
+                          self.username, 'wrong' + self.password)
+
 # (These notes may be Linux-specific)
 # In general, testuser needs to exist as a real system user (possibly in a
 # chrooted system) for the PAM tests to work. In addition, the user running the
@@ -231,6 +247,57 @@ class RemoteAuthMissingLdapTest(RemoteAuthMissingMixin, unittest.TestCase):
     protocol = 'ldap'
     path = 'uid=%s,ou=people,dc=nodomain'
 
+# Tests for remote authenticators that don't respond
+
+class RemoteAuthTimeoutTest(RemoteAuthMixin, unittest.TestCase):
+    # The authenticator accepts connections, but never says anything.
+    protocol = 'imap'
+    host = '127.0.0.1'
+    port = 8143
+    timeout = 2
+
+    def serverSetUp(self):
+        self.silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.silent.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.silent.bind((self.host, self.port))
+        self.silent.listen(5)
+        RemoteAuthMixin.serverSetUp(self)
+
+    def tearDown(self):
+        RemoteAuthMixin.tearDown(self)
+        self.silent.close()
+
+    def addAuth(self):
+        RemoteAuthMixin.addAuth(self)
+        self.server.addOptions(['--remote-auth-timeout', str(self.timeout)])
+
+    def testTimeout(self):
+        start = time.time()
+        self.assertRaises(AssertionError, self.client.signOn,
+                          self.username, self.password)
+        self.assertLess(time.time() - start, self.timeout + 5)
+
+    def testOtherSessions(self):
+        # Other sessions are served while one waits for the authenticator.
+        userpass = '%s\x00%s\x00%s' % (self.username, self.username,
+                                       self.password)
+        self.client.send('AUTH PLAIN %s\r\n'
+                         % b64_encode(userpass).decode('ascii'))
+        other = self.server.makeClient(self.client_addr)
+        start = time.time()
+        other.connect(True)
+        (code, lines) = other.exchange('EHLO test.example.com\r\n')
+        self.assertEqual(code, 250)
+        self.assertLess(time.time() - start, self.timeout)
+        (code, lines) = self.client.receive()
+        self.assertEqual(code, 535)
+
+class RemoteAuthTimeoutThreadTest(RemoteAuthTimeoutTest):
+    # A single auth thread is still enough for other sessions to go on.
+    def addAuth(self):
+        RemoteAuthTimeoutTest.addAuth(self)
+        self.server.addOptions(['--auth-threads', '1'])
+
 # Tests for ipauthmap file
 
 class AuthMapMixin(RemoteAuthMixin):
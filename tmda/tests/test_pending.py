@@ -2,6 +2,8 @@ import unittest
 import sys
 import time
 import os
+import shutil
+import tempfile
 from io import StringIO
 from email.parser import Parser
 
@@ -11,6 +13,7 @@ lib.util.testPrep()
 from TMDA import Pending
 from TMDA import Defaults
 from TMDA import Util
+from TMDA.Queue.Metadata import make_record
 
 verbose = False
 
@@ -71,6 +74,27 @@ class MockMailQueue(object):
     def delete_message(self, msgid):
         self._msgs.pop(msgid, None)
 
+    def fetch_metadata(self, msgids):
+        return {}
+
+class MockIndexedMailQueue(MockMailQueue):
+    def __init__(self):
+        MockMailQueue.__init__(self)
+        self.fetched = []
+        self.indexed = []
+
+    def fetch_message(self, msgid, fullParse=False):
+        self.fetched.append(msgid)
+        return MockMailQueue.fetch_message(self, msgid, fullParse)
+
+    def fetch_metadata(self, msgids):
+        records = {}
+        for msgid in msgids:
+            self.indexed.append(msgid)
+            msg = MockMailQueue.fetch_message(self, msgid)
+            records[msgid] = make_record(msg, len(Util.msg_as_string(msg)))
+        return records
+
 class QueueInitTests(unittest.TestCase):
     '''
     Basic tests for initializing TMDA.Pending.Queue.
@@ -117,6 +141,204 @@ class QueueInitTests(unittest.TestCase):
         self.assertEqual(pending.msgs, ['1243439251.12345', '1303349951.12346',
                                         '1303433207.12347'])
 
+class QueueIndexTests(unittest.TestCase):
+    '''
+    Listing the queue should use the metadata index, not the messages.
+    '''
+
+    def setUp(self):
+        Pending.Q = MockIndexedMailQueue()
+        self.saved_summary_headers = Defaults.SUMMARY_HEADERS
+        Defaults.SUMMARY_HEADERS = ['return-path', 'subject']
+
+    def tearDown(self):
+        Defaults.SUMMARY_HEADERS = self.saved_summary_headers
+
+    def testTerse(self):
+        queue = Pending.Queue(terse=True)
+        queue.initQueue()
+        queue.stdout = StringIO()
+        queue.mainLoop()
+        self.assertEqual(Pending.Q.fetched, [])
+        lines = queue.stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1].split('\t'),
+                         ['1303349951.12346', 'None',
+                          'Test message number TWO!'])
+
+    def testSkippedNotRead(self):
+        # Messages skipped because of their age or the cache are never
+        # looked up.
+        threshold = "%ds" % (time.time() - 1280000000)
+        saved_cache = Defaults.PENDING_CACHE
+        Defaults.PENDING_CACHE = os.path.join(Defaults.DATADIR,
+                                              '.pendingcache-index-test')
+        try:
+            queue = Pending.Queue(['1303349951.12346'], cache=True,
+                                  verbose=verbose)
+            queue.initQueue()
+            queue.mainLoop()
+            queue._saveCache()
+
+            queue = Pending.Queue(cache=True, threshold=threshold,
+                                  younger=True, verbose=verbose)
+            queue.initQueue()
+            Pending.Q.indexed = []
+            queue.stdout = StringIO()
+            queue.mainLoop()
+            self.assertEqual(Pending.Q.indexed, ['1303433207.12347'])
+            self.assertEqual(Pending.Q.fetched, [])
+        finally:
+            os.remove(Defaults.PENDING_CACHE)
+            Defaults.PENDING_CACHE = saved_cache
+
+    def testSummary(self):
+        msg = Pending.Message('1243439251.12345',
+                              metadata=Pending.Q.fetch_metadata(
+                                  ['1243439251.12345'])['1243439251.12345'])
+        summary = msg.summary()
+        self.assertEqual(Pending.Q.fetched, [])
+        self.assertTrue(summary.startswith('1243439251.12345 (%d bytes)'
+                                           % len(msg.show())))
+        self.assertEqual(Pending.Q.fetched, ['1243439251.12345'])
+
+class PendingCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'pendingcache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def readLog(self):
+        with open(self.filename) as f:
+            return f.read().split()
+
+    def testAddRemove(self):
+        cache = Pending.PendingCache(self.filename, 3).load()
+        self.assertTrue(cache.add('1.1'))
+        self.assertFalse(cache.add('1.1'))
+        self.assertEqual(cache.add_many(['1.2', '1.1', '1.3', '1.4']), 3)
+        # Only the newest three are kept.
+        self.assertEqual(list(cache), ['1.4', '1.3', '1.2'])
+        self.assertFalse('1.1' in cache)
+        cache.remove('1.3')
+        cache.remove('1.3')
+        self.assertEqual(list(cache), ['1.4', '1.2'])
+
+    def testAppend(self):
+        cache = Pending.PendingCache(self.filename, 10).load()
+        cache.add_many(['1.1', '1.2'])
+        cache.save()
+        cache.add('1.3')
+        cache.remove('1.1')
+        cache.save()
+        cache.save()
+        self.assertEqual(self.readLog(), ['1.1', '1.2', '1.3', '-1.1'])
+        cache = Pending.PendingCache(self.filename, 10).load()
+        self.assertEqual(list(cache), ['1.3', '1.2'])
+
+    def testCompact(self):
+        cache = Pending.PendingCache(self.filename, 2).load()
+        for msgid in ['1.1', '1.2', '1.3', '1.4']:
+            cache.add(msgid)
+            cache.save()
+        self.assertEqual(self.readLog(), ['1.1', '1.2', '1.3', '1.4'])
+        cache.add('1.5')
+        cache.save()
+        self.assertEqual(self.readLog(), ['1.4', '1.5'])
+        cache = Pending.PendingCache(self.filename, 2).load()
+        self.assertEqual(list(cache), ['1.5', '1.4'])
+
+    def testPickled(self):
+        # Caches written by older versions are read, and rewritten.
+        Util.pickleit(['1.3', '1.2', '1.1'], self.filename, 0)
+        cache = Pending.PendingCache(self.filename, 10).load()
+        self.assertEqual(list(cache), ['1.3', '1.2', '1.1'])
+        cache.save()
+        self.assertEqual(self.readLog(), ['1.1', '1.2', '1.3'])
+
+class QueueBulkTests(unittest.TestCase):
+    '''
+    Bulk disposal (--jobs).
+    '''
+
+    def setUp(self):
+        self.sent = []
+        self.appends = []
+        self.saved = (Util.sendmail, Util.append_many_to_file,
+                      Defaults.PENDING_RELEASE_APPEND,
+                      Defaults.PENDING_DELETE_APPEND)
+        Util.sendmail = self.recordSendmail
+        Util.append_many_to_file = self.recordAppends
+        Defaults.PENDING_RELEASE_APPEND = 'release_file'
+        Defaults.PENDING_DELETE_APPEND = 'delete_file'
+        Pending.Q = MockMailQueue()
+
+    def tearDown(self):
+        (Util.sendmail, Util.append_many_to_file,
+         Defaults.PENDING_RELEASE_APPEND,
+         Defaults.PENDING_DELETE_APPEND) = self.saved
+
+    def recordSendmail(self, msgstr, envrecip, envsender, connection=None):
+        if envsender == 'message2@return.path.com':
+            raise IOError('refused')
+        self.sent.append(envsender)
+
+    def recordAppends(self, addresses, filename):
+        self.appends.append((sorted(addresses), filename))
+
+    def testRelease(self):
+        queue = Pending.Queue(dispose='release', verbose=verbose, jobs=2)
+        queue.stdout = StringIO()
+        queue.initQueue()
+        queue.mainLoop()
+        self.assertEqual(sorted(self.sent), ['message1@return.path.com',
+                                             'message3@return.path.com'])
+        self.assertEqual(queue.failed, ['1303349951.12346'])
+        self.assertTrue('release 1303349951.12346 failed: refused'
+                        in queue.stdout.getvalue())
+        self.assertEqual(self.appends,
+                         [(['message1@return.path.com',
+                            'message2@return.path.com',
+                            'message3@return.path.com'], 'release_file')])
+
+    def testReleaseCached(self):
+        # A message which couldn't be released must come up again.
+        queue = Pending.Queue(cache=True, dispose='release', verbose=verbose,
+                              jobs=2)
+        queue.initQueue()
+        try:
+            queue.mainLoop()
+            cached = list(Pending.PendingCache(Defaults.PENDING_CACHE,
+                                               10).load())
+        finally:
+            os.remove(Defaults.PENDING_CACHE)
+        self.assertEqual(sorted(cached), ['1243439251.12345',
+                                          '1303433207.12347'])
+
+    def testFinishQuitFails(self):
+        class BrokenConnection:
+            def quit(self):
+                raise OSError('connection reset')
+        reinjector = Pending.Reinjector(2)
+        reinjector.connections = [BrokenConnection()]
+        reinjector.submit('1303349951.12346', 'message', 'recip@nowhere.com',
+                          'message2@return.path.com')
+        results = reinjector.finish()
+        self.assertEqual([msgid for (msgid, error) in results],
+                         ['1303349951.12346'])
+        self.assertTrue(isinstance(results[0][1], IOError))
+
+    def testDelete(self):
+        queue = Pending.Queue(dispose='delete', verbose=verbose, jobs=2)
+        queue.initQueue()
+        queue.mainLoop()
+        self.assertEqual(list(Pending.Q.fetch_ids()), [])
+        self.assertEqual(self.sent, [])
+        self.assertEqual(queue.failed, [])
+        self.assertEqual(len(self.appends), 1)
+
 class QueueLoopTestMixin(object):
     expected_addrs = ['message1@return.path.com', 'message2@return.path.com',
                       'message3@return.path.com']
@@ -280,7 +502,7 @@ class QueueLoopTestAppendingMixin(QueueLoopTestMixin):
 
         queue.mainLoop()
         # Make sure the cached IDs are as expected.
-        self.assertEqual(queue.msgcache, list(reversed(cache_ids)))
+        self.assertEqual(list(queue.msgcache), list(reversed(cache_ids)))
 
         # Revisit the loop, this time expected only the non-cached IDs to be
         # handled.